@@ -1 +1,4 @@
 VERSION = '0.9.5'
+
+# Only used by Django 1.7+
+default_app_config = 'paypal.apps.PayPalConfig'
@@ -99,8 +99,8 @@ def confirm_transaction(payer_id, pay_key, amount, currency):
 
 
 def refund_transaction(token, amount, currency, note=None):
-    txn = Transaction.objects.get(token=token,
-                                  method=DO_EXPRESS_CHECKOUT)
+    txn = Transaction.objects.without_request().get(
+        token=token, method=DO_EXPRESS_CHECKOUT)
     is_partial = amount < txn.amount
     return refund_txn(txn.value('PAYMENTINFO_0_TRANSACTIONID'), is_partial, amount, currency)
 
@@ -109,8 +109,8 @@ def capture_authorization(token, note=None):
     """
     Capture a previous authorization.
     """
-    txn = Transaction.objects.get(token=token,
-                                  method=DO_EXPRESS_CHECKOUT)
+    txn = Transaction.objects.without_request().get(
+        token=token, method=DO_EXPRESS_CHECKOUT)
     return do_capture(txn.value('PAYMENTINFO_0_TRANSACTIONID'),
                       txn.amount, txn.currency, note=note)
 
@@ -119,6 +119,6 @@ def void_authorization(token, note=None):
     """
     Void a previous authorization.
     """
-    txn = Transaction.objects.get(token=token,
-                                  method=DO_EXPRESS_CHECKOUT)
+    txn = Transaction.objects.without_request().get(
+        token=token, method=DO_EXPRESS_CHECKOUT)
     return do_void(txn.value('PAYMENTINFO_0_TRANSACTIONID'), note=note)
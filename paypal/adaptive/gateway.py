@@ -2,16 +2,13 @@ from __future__ import unicode_literals
 from collections import namedtuple
 import logging
 from decimal import Decimal as D
-import urllib
-import urlparse
 
 from django.conf import settings
 from django.template.defaultfilters import truncatewords, striptags
-import requests
-import time
 
 from paypal.adaptive import models
-from paypal import exceptions
+from paypal import exceptions, gateway
+from paypal.ledger.models import LedgerEntry
 from paypal.express import exceptions as express_exceptions
 
 from django.utils.translation import ugettext_lazy as _
@@ -71,43 +68,6 @@ def _format_currency(amt):
     return amt.quantize(D('0.01'))
 
 
-def _post(url, params, headers=None):
-    """
-    Make a POST request to the URL using the key-value pairs.  Return
-    a set of key-value pairs.
-    :url: URL to post to
-    :params: Dict of parameters to include in post payload
-    :headers: Dict of headers
-    """
-    if headers is None:
-        headers = {}
-
-    payload = urllib.urlencode(params)
-
-    # Ensure correct headers are present
-    if 'Content-type' not in headers:
-        headers['Content-type'] = 'application/x-www-form-urlencoded'
-    if 'Accepts' not in headers:
-        headers['Accepts'] = 'text/plain'
-
-    start_time = time.time()
-    response = requests.post(url, payload, headers=headers)
-    if response.status_code != requests.codes.ok:
-        raise exceptions.PayPalError("Unable to communicate with PayPal")
-
-    # Convert response into a simple key-value format
-    pairs = {}
-    for key, values in urlparse.parse_qs(response.content).items():
-        pairs[key] = values[0]
-
-    # Add audit information
-    pairs['_raw_request'] = payload
-    pairs['_raw_response'] = response.content
-    pairs['_response_time'] = (time.time() - start_time) * 1000.0
-
-    return pairs
-
-
 def _fetch_response(method, params):
     """
     Fetch the response from PayPal and return a transaction object
@@ -118,12 +78,29 @@ def _fetch_response(method, params):
     else:
         url = URLS[method].production
 
+    headers = _get_auth_headers()
+    logger.debug("Making %s request to %s with headers: %s", method, url,
+                 gateway.redact(headers))
+
     # Make HTTP request
-    pairs = _post(url, params, _get_auth_headers())
+    pairs = gateway.post(url, params, headers)
 
     return pairs
 
 
+def _record_ledger_entry(txn, basket_id=None):
+    LedgerEntry.objects.record(
+        gateway=LedgerEntry.ADAPTIVE,
+        operation=txn.method,
+        audit_txn=txn,
+        basket_id=basket_id,
+        reference=txn.pay_key,
+        amount=txn.amount,
+        currency=txn.currency,
+        status=txn.ack,
+        is_successful=txn.is_successful)
+
+
 def set_txn(basket, shipping_methods, currency, return_url, cancel_url, update_url=None,
             action=SALE, user=None, user_address=None, shipping_method=None,
             shipping_address=None, no_shipping=False, paypal_params=None):
@@ -183,6 +160,7 @@ def set_txn(basket, shipping_methods, currency, return_url, cancel_url, update_u
         txn.error_message = txn.value('error(0).message')
 
     txn.save()
+    _record_ledger_entry(txn, basket_id=basket.id)
 
     if not txn.is_successful:
         msg = "Error %s - %s" % (txn.error_code, txn.error_message)
@@ -227,6 +205,7 @@ def get_txn(pay_key):
         txn.error_message = txn.value('error(0).message')
 
     txn.save()
+    _record_ledger_entry(txn)
 
     if not txn.is_successful:
         msg = "Error %s - %s" % (txn.error_code, txn.error_message)
@@ -261,6 +240,7 @@ def do_txn(payer_id, token, amount, currency, action=SALE):
         txn.error_message = txn.value('error(0).message')
 
     txn.save()
+    _record_ledger_entry(txn)
 
     if not txn.is_successful:
         msg = "Error %s - %s" % (txn.error_code, txn.error_message)
@@ -25,6 +25,7 @@ from paypal.adaptive.exceptions import (
     EmptyBasketException, MissingShippingAddressException,
     MissingShippingMethodException, InvalidBasket)
 from paypal.exceptions import PayPalError
+from paypal.ledger.models import LedgerEntry
 
 # Load views dynamically
 PaymentDetailsView = get_class('checkout.views', 'PaymentDetailsView')
@@ -200,6 +201,8 @@ class SuccessResponseView(PlaceOrderView):
         # the order on a different request).
         order_number = self.generate_order_number(basket)
         self.checkout_session.set_order_number(order_number)
+        LedgerEntry.objects.link_order(
+            LedgerEntry.ADAPTIVE, self.pay_key, order_number)
         logger.info("Order #%s: beginning submission process for basket #%d", order_number, basket.id)
 
         # Freeze the basket so it cannot be manipulated while the customer is
@@ -1,2 +1,3 @@
 from paypal.express.admin import *
-from paypal.payflow.admin import *
\ No newline at end of file
+from paypal.payflow.admin import *
+from paypal.ledger.admin import *
@@ -0,0 +1,17 @@
+from django.apps import AppConfig
+from django.utils.translation import ugettext_lazy as _
+
+
+class PayPalConfig(AppConfig):
+    name = 'paypal'
+    verbose_name = _('PayPal')
+
+    def ready(self):
+        # Build the settings snapshots up-front so that misconfiguration is
+        # reported at start-up rather than on the first payment.
+        from paypal.express import conf as express_conf
+        from paypal.payflow import conf as payflow_conf
+        if express_conf.is_configured():
+            express_conf.get_settings()
+        if payflow_conf.is_configured():
+            payflow_conf.get_settings()
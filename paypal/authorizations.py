@@ -0,0 +1,180 @@
+"""
+Sweeping up authorizations that are about to expire.
+
+Express authorizations are only honoured for 3 days and Payflow holds lapse
+after around a week.  The sweeper finds authorizations that haven't been
+captured, voided or renewed and either voids them (releasing the hold on the
+customer's funds) or reauthorizes them, depending on the policy.
+
+Transactions are read in keyset pages (by primary key) so the sweep scales to
+large tables, and the calls are made concurrently through ``paypal.bulk``.
+"""
+from __future__ import unicode_literals
+import datetime
+import itertools
+from collections import namedtuple
+
+from django.conf import settings
+from django.db.models import Max
+from django.utils import timezone
+
+from paypal import bulk
+from paypal.express import gateway as express_gateway
+from paypal.express.models import ExpressTransaction
+from paypal.ledger.models import LedgerEntry
+from paypal.payflow import codes, gateway as payflow_gateway
+from paypal.payflow.models import PayflowTransaction
+
+VOID, REAUTHORIZE = 'void', 'reauthorize'
+
+PAGE_SIZE = 500
+
+# An authorization that hasn't been captured or voided
+Hold = namedtuple(
+    'Hold', 'gateway order_number transaction_id amount currency '
+    'date_created')
+
+
+def get_policy():
+    return getattr(settings, 'PAYPAL_AUTHORIZATION_POLICY', VOID)
+
+
+def _paginate(queryset, page_size=PAGE_SIZE):
+    """
+    Yield pages of a queryset ordered by primary key.  Each page is a separate
+    query starting after the last key of the previous page.
+    """
+    last_pk = 0
+    while True:
+        page = list(
+            queryset.filter(pk__gt=last_pk).order_by('pk')[:page_size])
+        if not page:
+            return
+        yield page
+        last_pk = page[-1].pk
+
+
+def find_express_holds(before, after, page_size=PAGE_SIZE):
+    """
+    Yield pages of Express authorizations made between ``after`` and
+    ``before`` that are still open.
+    """
+    qs = ExpressTransaction.objects.without_request().filter(
+        method=express_gateway.DO_EXPRESS_CHECKOUT,
+        date_created__lt=before, date_created__gte=after,
+        ack__in=(ExpressTransaction.SUCCESS,
+                 ExpressTransaction.SUCCESS_WITH_WARNING))
+    for page in _paginate(qs, page_size):
+        holds = {}
+        for txn in page:
+            # Each payment of a parallel checkout has its own authorization.
+            # Sales are settled straight away so only pending authorizations
+            # are of interest.
+            for payment in express_gateway.get_payment_info(txn):
+                if payment.pending_reason != 'authorization':
+                    continue
+                holds[payment.transaction_id] = Hold(
+                    LedgerEntry.EXPRESS, None, payment.transaction_id,
+                    payment.amount, payment.currency or txn.currency,
+                    txn.date_created)
+
+        # A reauthorized hold is captured or voided using the ID of its
+        # latest reauthorization.
+        chains = express_gateway.get_authorization_chains(holds)
+        original_ids = dict((chain_id, txn_id)
+                            for txn_id, chain in chains.items()
+                            for chain_id in chain)
+
+        # Use the ledger to find which have been captured, voided or
+        # reauthorized since.
+        entries = LedgerEntry.objects.filter(
+            gateway=LedgerEntry.EXPRESS,
+            transaction_id__in=list(original_ids),
+            is_successful=True).values_list(
+                'transaction_id', 'operation', 'order_number', 'date_created')
+        for txn_id, operation, order_number, date_created in entries:
+            txn_id = original_ids[txn_id]
+            hold = holds.get(txn_id)
+            if hold is None:
+                continue
+            if operation in (express_gateway.DO_CAPTURE,
+                             express_gateway.DO_VOID):
+                del holds[txn_id]
+            elif operation == express_gateway.DO_REAUTHORIZATION:
+                if date_created >= before:
+                    del holds[txn_id]
+            elif order_number:
+                holds[txn_id] = hold._replace(order_number=order_number)
+        if holds:
+            yield [hold._replace(transaction_id=chains[txn_id][-1])
+                   for txn_id, hold in holds.items()]
+
+
+def find_payflow_holds(before, after, page_size=PAGE_SIZE):
+    """
+    Yield pages of Payflow authorizations made between ``after`` and
+    ``before`` that are still open.
+    """
+    approved = ('0', '126')
+    qs = PayflowTransaction.objects.summary().filter(
+        trxtype=codes.AUTHORIZATION, result__in=approved,
+        date_created__lt=before, date_created__gte=after)
+    for page in _paginate(qs, page_size):
+        # An authorization is closed by a later capture, void or (reference)
+        # authorization for the same order.
+        # The default ordering is cleared as it would be added to the GROUP
+        # BY.
+        latest = dict(PayflowTransaction.objects.filter(
+            comment1__in=set(txn.comment1 for txn in page),
+            trxtype__in=(codes.AUTHORIZATION, codes.DELAYED_CAPTURE,
+                         codes.VOID),
+            result__in=approved).order_by().values_list(
+                'comment1').annotate(latest_id=Max('id')))
+        holds = [Hold(LedgerEntry.PAYFLOW, txn.comment1, txn.pnref,
+                      txn.amount, None, txn.date_created)
+                 for txn in page if latest.get(txn.comment1) == txn.pk]
+        if holds:
+            yield holds
+
+
+def sweep(policy=None, days=3, max_days=29, workers=None, rate=None):
+    """
+    Void or reauthorize the open authorizations that are between ``days``
+    and ``max_days`` old, yielding a ``bulk.Result`` (with the ``Hold`` as
+    its item) for each.
+
+    Authorizations older than ``max_days`` can no longer be captured so are
+    ignored.
+    """
+    if policy is None:
+        policy = get_policy()
+    if policy not in (VOID, REAUTHORIZE):
+        raise ValueError("Unknown policy '%s'" % policy)
+    now = timezone.now()
+    before = now - datetime.timedelta(days=days)
+    after = now - datetime.timedelta(days=max_days)
+
+    def process(hold):
+        # Called from a worker thread so mustn't touch the database
+        if hold.gateway == LedgerEntry.EXPRESS:
+            if policy == VOID:
+                return express_gateway.do_void(
+                    hold.transaction_id, commit=False)
+            return express_gateway.do_reauthorization(
+                hold.transaction_id, hold.amount, hold.currency,
+                commit=False)
+        if policy == VOID:
+            return payflow_gateway.void(
+                hold.order_number, hold.transaction_id, commit=False)
+        return payflow_gateway.reference_authorization(
+            hold.order_number, hold.transaction_id, hold.amount,
+            commit=False)
+
+    pages = itertools.chain(find_express_holds(before, after),
+                            find_payflow_holds(before, after))
+    for page in pages:
+        results = [bulk.check(result) for result in bulk.run_concurrently(
+            process, page, workers=workers, rate=rate)]
+        bulk.save_results(results)
+        for result in results:
+            yield result
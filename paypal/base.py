@@ -4,6 +4,39 @@ from django.utils.translation import ugettext_lazy as _
 
 from django.db import models
 
+# The raw audit columns can be large and are only needed when showing a single
+# transaction.
+AUDIT_FIELDS = ('raw_request', 'raw_response')
+
+
+class ResponseQuerySet(models.query.QuerySet):
+
+    def summary(self):
+        """
+        Defer loading of the raw request/response data - use this for lists of
+        transactions.
+        """
+        return self.defer(*AUDIT_FIELDS)
+
+    def without_request(self):
+        """
+        Defer loading of the raw request only.  The response is still needed
+        to look up values with ``value()``.
+        """
+        return self.defer('raw_request')
+
+
+class ResponseManager(models.Manager):
+
+    def get_queryset(self):
+        return ResponseQuerySet(self.model, using=self._db)
+
+    def summary(self):
+        return self.get_queryset().summary()
+
+    def without_request(self):
+        return self.get_queryset().without_request()
+
 
 class ResponseModel(models.Model):
 
@@ -13,7 +46,9 @@ class ResponseModel(models.Model):
 
     response_time = models.FloatField(help_text=_("Response time in milliseconds"))
 
-    date_created = models.DateTimeField(auto_now_add=True)
+    date_created = models.DateTimeField(auto_now_add=True, db_index=True)
+
+    objects = ResponseManager()
 
     class Meta:
         abstract = True
@@ -0,0 +1,161 @@
+"""
+Helpers for making large numbers of PayPal calls (eg capturing a batch of
+authorizations).
+
+The calls are made by a pool of threads as they spend nearly all their time
+waiting on PayPal.  An optional rate limit keeps us within PayPal's
+throttling limits.
+"""
+from __future__ import unicode_literals
+import itertools
+import logging
+import threading
+import time
+from collections import namedtuple
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+from django.db import transaction
+
+from paypal import ratelimit
+from paypal.exceptions import PayPalError
+from paypal.express import gateway as express_gateway
+from paypal.payflow import gateway as payflow_gateway
+from paypal.payflow.models import PayflowTransaction
+
+logger = logging.getLogger('paypal.bulk')
+
+# The outcome of calling a function for one item.  Only one of result and
+# error is set.
+Result = namedtuple('Result', 'item result error')
+
+
+def get_workers():
+    return getattr(settings, 'PAYPAL_BULK_WORKERS', 4)
+
+
+def get_rate_limit():
+    return getattr(settings, 'PAYPAL_BULK_RATE_LIMIT', None)
+
+
+class RateLimiter(object):
+    """
+    Space out calls so there are no more than ``rate`` per second across all
+    threads.
+    """
+
+    def __init__(self, rate=None):
+        self.interval = 1.0 / rate if rate else 0
+        self.next_call = 0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval:
+            return
+        with self.lock:
+            now = time.time()
+            delay = self.next_call - now
+            self.next_call = max(now, self.next_call) + self.interval
+        if delay > 0:
+            time.sleep(delay)
+
+
+def chunked(iterable, size):
+    """
+    Split an iterable into lists of at most ``size`` items, without loading
+    the whole iterable into memory.
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def run_concurrently(func, items, workers=None, rate=None):
+    """
+    Call ``func`` for each item using a pool of threads and yield a
+    ``Result`` for each one as it completes.  ``items`` can be any iterable,
+    including a generator reading from a file.
+
+    PayPal errors are returned as the result's error rather than raised so
+    that one failure doesn't stop the batch.  The function shouldn't touch
+    the database as each thread would need its own connection - save the
+    results from the calling thread instead.
+
+    :workers: Number of threads (defaults to PAYPAL_BULK_WORKERS)
+    :rate: Maximum number of calls per second (defaults to
+           PAYPAL_BULK_RATE_LIMIT, None means no limit)
+    """
+    if workers is None:
+        workers = get_workers()
+    if rate is None:
+        rate = get_rate_limit()
+    limiter = RateLimiter(rate)
+
+    def call(item):
+        limiter.wait()
+        try:
+            # Bulk calls yield to interactive ones when the shared rate
+            # limit is reached
+            with ratelimit.batch():
+                return Result(item, func(item), None)
+        except PayPalError as e:
+            return Result(item, None, e)
+        except Exception as e:
+            logger.exception("Error processing %r", item)
+            return Result(item, None, e)
+
+    workers = max(workers, 1)
+    pool = ThreadPool(workers)
+    try:
+        # The pool would queue up every item in one go, so feed it a chunk at
+        # a time to keep memory use constant for large inputs.
+        for chunk in chunked(items, workers * 10):
+            for result in pool.imap_unordered(call, chunk):
+                yield result
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def is_successful(txn):
+    # Payflow transactions have a RESULT, Express ones an ACK
+    if isinstance(txn, PayflowTransaction):
+        return txn.is_approved
+    return txn.is_successful
+
+
+def check(result):
+    """
+    Return the result with its error set if PayPal rejected the call.  This
+    is needed for transactions fetched with ``commit=False`` as they don't
+    raise an exception.
+    """
+    txn = result.result
+    if txn is None or is_successful(txn):
+        return result
+    if isinstance(txn, PayflowTransaction):
+        msg = "Error %s - %s" % (txn.result, txn.respmsg)
+    else:
+        msg = "Error %s - %s" % (txn.error_code, txn.error_message)
+    return result._replace(error=PayPalError(msg))
+
+
+def save_results(results):
+    """
+    Save the transactions of a batch of results in one database transaction.
+    If the result's item has an order number, it is recorded in the ledger.
+    """
+    with transaction.atomic():
+        for result in results:
+            txn = result.result
+            if txn is None:
+                continue
+            if isinstance(txn, PayflowTransaction):
+                payflow_gateway.save_transaction(txn)
+            else:
+                express_gateway.save_transaction(
+                    txn, order_number=getattr(
+                        result.item, 'order_number', None))
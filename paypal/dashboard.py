@@ -0,0 +1,162 @@
+"""
+Shared parts of the Express and Payflow dashboard transaction lists.
+
+The audit tables grow with every call made to PayPal, so the lists are never
+counted or paged with OFFSET.  Instead, each page starts after the creation
+date and primary key of the last transaction of the previous one (newest
+first).  This matches the ``(filter, date_created)`` indexes, so deep pages
+are as quick to load as the first, filtered or not.
+"""
+from __future__ import unicode_literals
+import datetime
+
+from django import forms
+from django.conf import settings
+from django.db.models import Q
+from django.utils import six, timezone
+from django.utils.dateparse import parse_datetime
+from django.utils.translation import ugettext_lazy as _
+from django.views import generic
+
+# Number of transactions shown per page
+PAGE_SIZE = 25
+
+
+def _start_of_day(date):
+    value = datetime.datetime.combine(date, datetime.time())
+    if settings.USE_TZ:
+        value = timezone.make_aware(value, timezone.get_current_timezone())
+    return value
+
+
+class TransactionSearchForm(forms.Form):
+    """
+    Filters common to both gateways.  Subclasses add their own fields and
+    list the fields searched with ``search_fields``.
+    """
+    date_from = forms.DateField(label=_("From"), required=False)
+    date_to = forms.DateField(label=_("To"), required=False)
+    amount_min = forms.DecimalField(label=_("Minimum amount"), required=False)
+    amount_max = forms.DecimalField(label=_("Maximum amount"), required=False)
+    q = forms.CharField(label=_("Search"), required=False)
+
+    search_fields = ()
+
+    def filter(self, queryset):
+        """
+        Apply the filters to a queryset of transactions.  Only call this once
+        the form has been validated.
+        """
+        data = self.cleaned_data
+        if data['date_from']:
+            queryset = queryset.filter(
+                date_created__gte=_start_of_day(data['date_from']))
+        if data['date_to']:
+            # The end date is inclusive
+            queryset = queryset.filter(date_created__lt=_start_of_day(
+                data['date_to'] + datetime.timedelta(days=1)))
+        if data['amount_min'] is not None:
+            queryset = queryset.filter(amount__gte=data['amount_min'])
+        if data['amount_max'] is not None:
+            queryset = queryset.filter(amount__lte=data['amount_max'])
+        query = data['q'].strip()
+        if query:
+            queryset = queryset.filter(self.get_search_filter(query))
+        return queryset
+
+    def get_search_filter(self, query):
+        # Exact matches only, so that each field's index can be used
+        search = Q()
+        for field in self.search_fields:
+            search |= Q(**{field: query})
+        return search
+
+
+class TransactionListView(generic.ListView):
+    """
+    Lists the transactions matching ``form_class``, newest first.  The
+    ``before`` and ``after`` query parameters hold the creation date and
+    primary key of the transaction that the page starts after.  Nothing is
+    listed while the form has errors.
+    """
+    context_object_name = 'transactions'
+    form_class = TransactionSearchForm
+    page_size = PAGE_SIZE
+
+    def get_queryset(self):
+        queryset = self.model.objects.summary()
+        self.form = self.form_class(self.request.GET)
+        if not self.form.is_valid():
+            return queryset.none()
+        return self.form.filter(queryset)
+
+    def get_cursor(self, name):
+        """
+        Return the (date created, primary key) pair from a query parameter,
+        or None if it is missing or invalid.
+        """
+        date_created, __, pk = self.request.GET.get(name, '').rpartition('_')
+        try:
+            date_created = parse_datetime(date_created)
+            pk = int(pk)
+        except ValueError:
+            return None
+        if date_created is None:
+            return None
+        return date_created, pk
+
+    def format_cursor(self, txn):
+        return '%s_%s' % (txn.date_created.isoformat(), txn.pk)
+
+    def get_page(self, queryset):
+        """
+        Return the page of transactions along with the cursors to use for
+        the newer and older pages (None if there isn't one).
+        """
+        after = self.get_cursor('after')
+        before = self.get_cursor('before')
+        # One extra row is fetched to tell whether there's another page
+        if after is not None:
+            date_created, pk = after
+            rows = list(queryset.filter(
+                Q(date_created__gt=date_created) |
+                Q(date_created=date_created, pk__gt=pk)).order_by(
+                    'date_created', 'pk')[:self.page_size + 1])
+            has_newer = len(rows) > self.page_size
+            transactions = rows[:self.page_size][::-1]
+            has_older = True
+        else:
+            if before is not None:
+                date_created, pk = before
+                queryset = queryset.filter(
+                    Q(date_created__lt=date_created) |
+                    Q(date_created=date_created, pk__lt=pk))
+            rows = list(queryset.order_by(
+                '-date_created', '-pk')[:self.page_size + 1])
+            has_older = len(rows) > self.page_size
+            transactions = rows[:self.page_size]
+            has_newer = before is not None
+        if not transactions:
+            return transactions, None, None
+        return (transactions,
+                self.format_cursor(transactions[0]) if has_newer else None,
+                self.format_cursor(transactions[-1]) if has_older else None)
+
+    def get_page_url(self, name, value):
+        params = self.request.GET.copy()
+        for key in ('before', 'after'):
+            params.pop(key, None)
+        params[name] = six.text_type(value)
+        return '?%s' % params.urlencode()
+
+    def get_context_data(self, **kwargs):
+        transactions, newer, older = self.get_page(self.object_list)
+        kwargs['object_list'] = transactions
+        kwargs['form'] = self.form
+        if newer is not None:
+            kwargs['newer_url'] = self.get_page_url('after', newer)
+        if older is not None:
+            kwargs['older_url'] = self.get_page_url('before', older)
+        kwargs['is_filtered'] = any(self.request.GET.get(name)
+                                    for name in self.form.fields)
+        return super(TransactionListView, self).get_context_data(**kwargs)
@@ -0,0 +1,99 @@
+"""
+Process-local index of countries, plus the address normalisation used when
+building requests and handling PayPal's callbacks.
+
+Countries hardly ever change so they are loaded once per process and looked
+up in memory.  The index is rebuilt when a country is saved or deleted.
+"""
+from __future__ import unicode_literals
+import threading
+import time
+
+from django.db.models.signals import post_delete, post_save
+from localflavor.us import us_states
+from oscar.core.loading import get_model
+
+Country = get_model('address', 'Country')
+
+# Map of lower-cased US state names/abbreviations to their 2 letter code.
+# localflavor's map doesn't include the codes themselves.
+US_STATES = dict(us_states.STATES_NORMALIZED)
+US_STATES.update((code.lower(), code) for code, __ in us_states.STATE_CHOICES)
+
+_countries = None
+_lock = threading.Lock()
+
+# Codes that aren't countries, so that repeated lookups (eg from PayPal's
+# callbacks) don't query each time.  Cleared when full as the codes come
+# from outside.  The signals that reset the index only fire in the process
+# that changed the country, so misses expire after MISS_TIMEOUT seconds in
+# case another process has added it.
+MAX_MISSES = 1000
+MISS_TIMEOUT = 300
+_misses = {}
+
+
+def _get_index():
+    global _countries
+    countries = _countries
+    if countries is None:
+        with _lock:
+            if _countries is None:
+                _countries = dict(
+                    (country.iso_3166_1_a2, country)
+                    for country in Country._default_manager.all())
+            countries = _countries
+    return countries
+
+
+def get_country(code):
+    """
+    Return the country for an ISO 3166-1 alpha-2 code, or None if there isn't
+    one.  Only codes that aren't in the index need a query, and unknown codes
+    are remembered for MISS_TIMEOUT seconds or until the index is next
+    rebuilt.
+
+    The instances are shared between requests so they mustn't be modified.
+    """
+    if not code:
+        return None
+    code = code.strip().upper()
+    countries = _get_index()
+    if code not in countries:
+        if _misses.get(code, 0) > time.time():
+            return None
+        # The country may have been added by another process
+        try:
+            countries[code] = Country._default_manager.get(
+                iso_3166_1_a2=code)
+        except Country.DoesNotExist:
+            if len(_misses) >= MAX_MISSES:
+                _misses.clear()
+            _misses[code] = time.time() + MISS_TIMEOUT
+            return None
+    return countries[code]
+
+
+def normalise_state(country_code, state):
+    """
+    Return the state in the form PayPal expects.  US states are converted to
+    their 2 letter code, otherwise PayPal can reject the address (error
+    10736) as the state and zipcode don't match.
+    """
+    state = (state or '').strip()
+    if (country_code or '').strip().upper() == 'US':
+        return US_STATES.get(state.lower(), state)
+    return state
+
+
+def normalise_postcode(postcode):
+    return (postcode or '').replace(' ', '').upper()
+
+
+def reset(**kwargs):
+    global _countries
+    _countries = None
+    _misses.clear()
+
+post_save.connect(reset, sender=Country, dispatch_uid='paypal-countries')
+post_delete.connect(reset, sender=Country, dispatch_uid='paypal-countries')
@@ -1,7 +1,17 @@
 from django.contrib import admin
+from django.contrib.admin.views.main import ChangeList
+
 from paypal import models
 
 
+class TransactionChangeList(ChangeList):
+
+    def get_queryset(self, request):
+        # The raw audit data isn't shown in the list so don't load it
+        return super(TransactionChangeList, self).get_queryset(
+            request).summary()
+
+
 class ExpressTransactionAdmin(admin.ModelAdmin):
     list_display = ['method', 'amount', 'currency', 'correlation_id', 'ack',
                     'token', 'error_code', 'error_message', 'date_created']
@@ -22,5 +32,18 @@ class ExpressTransactionAdmin(admin.ModelAdmin):
         'request',
         'response']
 
+    def get_changelist(self, request, **kwargs):
+        return TransactionChangeList
+
 
 admin.site.register(models.ExpressTransaction, ExpressTransactionAdmin)
+
+
+class PendingPaymentAdmin(admin.ModelAdmin):
+    list_display = ['order_number', 'token', 'amount', 'currency', 'status',
+                    'date_created', 'date_updated']
+    list_filter = ['status']
+    raw_id_fields = ['txn']
+
+
+admin.site.register(models.PendingPayment, PendingPaymentAdmin)
@@ -0,0 +1,159 @@
+"""
+Taking Express payments in the background.
+
+When PAYPAL_ASYNC_PAYMENT is enabled, the DoExpressCheckoutPayment call is
+made by a pool of worker threads rather than by the web request placing the
+order.  The customer is shown a status page while the payment is taken, and
+the order is placed once it is complete.
+"""
+from __future__ import unicode_literals
+import datetime
+import logging
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils import timezone
+
+from paypal.exceptions import PayPalError
+from paypal.express.facade import confirm_transaction
+from paypal.express.gateway import GET_EXPRESS_CHECKOUT
+from paypal.express.models import ExpressTransaction, PendingPayment
+
+logger = logging.getLogger('paypal.express')
+
+# How long a worker waits for the request that queued a payment to commit it
+COMMIT_WAIT = 5
+POLL_INTERVAL = 0.1
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def is_enabled():
+    return getattr(settings, 'PAYPAL_ASYNC_PAYMENT', False)
+
+
+def get_timeout():
+    return getattr(settings, 'PAYPAL_ASYNC_TIMEOUT', 30)
+
+
+def _get_pool():
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ThreadPool(getattr(settings, 'PAYPAL_ASYNC_WORKERS', 4))
+    return _pool
+
+
+def _queue(payment_id):
+    _get_pool().apply_async(take_payment, (payment_id,))
+
+
+def confirm_payment(payment):
+    """
+    Queue a pending payment to be confirmed by a worker thread, once the
+    current database transaction has committed.
+    """
+    on_commit = getattr(transaction, 'on_commit', None)
+    if on_commit is not None:
+        on_commit(lambda: _queue(payment.pk))
+    else:
+        # Django < 1.9 has no commit hook, so the worker waits for the row
+        # to be committed instead (see _get_payment)
+        _queue(payment.pk)
+
+
+def recover(payment):
+    """
+    Queue a pending payment again if no worker has finished it within
+    PAYPAL_ASYNC_TIMEOUT seconds (eg because the process that queued it was
+    restarted).  Returns True if it was queued.
+
+    This is safe as the DoExpressCheckoutPayment call is made with the same
+    idempotency key each time, so payment is only taken once.
+    """
+    now = timezone.now()
+    if payment.date_updated > now - datetime.timedelta(
+            seconds=get_timeout()):
+        return False
+    # Only one request may queue it again
+    updated = PendingPayment.objects.filter(
+        pk=payment.pk, status=PendingPayment.PENDING,
+        date_updated=payment.date_updated).update(date_updated=now)
+    if not updated:
+        return False
+    logger.warning("Payment for token %s timed out, queuing it again",
+                   payment.token)
+    _queue(payment.pk)
+    return True
+
+
+def _get_payment(payment_id):
+    deadline = time.time() + COMMIT_WAIT
+    while True:
+        try:
+            return PendingPayment.objects.get(pk=payment_id)
+        except PendingPayment.DoesNotExist:
+            if time.time() >= deadline:
+                return None
+            time.sleep(POLL_INTERVAL)
+
+
+def get_msg_sub_id(payment):
+    """
+    Return the idempotency key for a pending payment's
+    DoExpressCheckoutPayment call.
+    """
+    return 'paypal-pending-%d' % payment.pk
+
+
+def take_payment(payment_id):
+    """
+    Make the DoExpressCheckoutPayment call for a pending payment and record
+    the outcome.
+    """
+    try:
+        payment = _get_payment(payment_id)
+        if payment is None:
+            # The request that queued it was rolled back, or is very slow to
+            # commit (in which case the status page will queue it again)
+            logger.warning("Pending payment #%s not found", payment_id)
+            return
+        if payment.status != PendingPayment.PENDING:
+            return
+        # The checkout details are needed for parallel payments
+        details = ExpressTransaction.objects.filter(
+            token=payment.token, method=GET_EXPRESS_CHECKOUT,
+            ack__in=(ExpressTransaction.SUCCESS,
+                     ExpressTransaction.SUCCESS_WITH_WARNING)).first()
+        txn = None
+        try:
+            txn = confirm_transaction(
+                payment.payer_id, payment.token, payment.amount,
+                payment.currency, order_number=payment.order_number,
+                details=details, msg_sub_id=get_msg_sub_id(payment))
+        except PayPalError as e:
+            logger.warning("Unable to take payment for token %s: %s",
+                           payment.token, e)
+            status = PendingPayment.FAILED
+        else:
+            status = (PendingPayment.COMPLETE if txn.is_successful
+                      else PendingPayment.FAILED)
+        # Only pending payments are updated, so that a repeated call can't
+        # undo the order being placed
+        PendingPayment.objects.filter(
+            pk=payment.pk, status=PendingPayment.PENDING).update(
+                status=status, txn=txn, date_updated=timezone.now())
+        logger.info("Payment for token %s is %s", payment.token, status)
+    except Exception:
+        # Exceptions are swallowed by the pool so make sure they're logged
+        logger.exception("Error taking payment #%s", payment_id)
+        PendingPayment.objects.filter(
+            pk=payment_id, status=PendingPayment.PENDING).update(
+                status=PendingPayment.FAILED)
+    finally:
+        # Each worker thread has its own database connection
+        connection.close()
@@ -0,0 +1,182 @@
+"""
+Bulk operations on Express transactions, eg capturing the authorizations for
+a batch of orders that have shipped.
+"""
+from __future__ import unicode_literals
+from collections import namedtuple
+
+from django.db import transaction
+
+from paypal import bulk
+from paypal.exceptions import PayPalError
+from paypal.express.gateway import (
+    DO_CAPTURE, DO_EXPRESS_CHECKOUT, do_capture, get_latest_authorization_ids,
+    get_payment_info, save_transactions)
+from paypal.express.models import ExpressTransaction
+from paypal.ledger.models import LedgerEntry
+
+# Number of tokens/order numbers looked up per query
+BATCH_SIZE = 500
+
+# Number of results saved per database transaction
+FLUSH_SIZE = 50
+
+# An authorization to capture
+Authorization = namedtuple(
+    'Authorization',
+    'token order_number authorization_id amount currency')
+
+
+def get_tokens_for_orders(order_numbers):
+    """
+    Return a dict mapping order numbers to the token of their successful
+    DoExpressCheckoutPayment call.
+    """
+    return dict(LedgerEntry.objects.filter(
+        gateway=LedgerEntry.EXPRESS, operation=DO_EXPRESS_CHECKOUT,
+        is_successful=True, order_number__in=order_numbers,
+    ).values_list('order_number', 'reference'))
+
+
+def get_authorizations(tokens, order_numbers=None):
+    """
+    Return a dict mapping tokens to their authorizations, loading their
+    DoExpressCheckoutPayment transactions in a single query.  A parallel
+    checkout has an authorization for each payment.  Reauthorized payments
+    have the ID of their latest reauthorization.
+
+    :order_numbers: Optional dict mapping tokens to order numbers
+    """
+    if order_numbers is None:
+        order_numbers = {}
+    txns = ExpressTransaction.objects.without_request().filter(
+        token__in=tokens, method=DO_EXPRESS_CHECKOUT,
+        ack__in=(ExpressTransaction.SUCCESS,
+                 ExpressTransaction.SUCCESS_WITH_WARNING))
+    authorizations = {}
+    for txn in txns:
+        authorizations[txn.token] = [Authorization(
+            token=txn.token,
+            order_number=order_numbers.get(txn.token),
+            authorization_id=payment.transaction_id,
+            amount=payment.amount,
+            currency=payment.currency or txn.currency)
+            for payment in get_payment_info(txn)]
+    latest_ids = get_latest_authorization_ids(
+        [a.authorization_id for token_authorizations in authorizations.values()
+         for a in token_authorizations])
+    for token, token_authorizations in authorizations.items():
+        authorizations[token] = [
+            a._replace(authorization_id=latest_ids[a.authorization_id])
+            for a in token_authorizations]
+    return authorizations
+
+
+def get_captured_ids(authorization_ids):
+    """
+    Return the IDs of the authorizations that have already been captured.
+    """
+    return set(LedgerEntry.objects.filter(
+        gateway=LedgerEntry.EXPRESS, operation=DO_CAPTURE,
+        is_successful=True, transaction_id__in=authorization_ids,
+    ).values_list('transaction_id', flat=True))
+
+
+def capture_authorizations(tokens=(), order_numbers=(), note=None,
+                           workers=None, rate=None):
+    """
+    Capture the authorizations for the given tokens and/or order numbers.
+
+    The DoCapture calls are made concurrently (see ``paypal.bulk``) and the
+    results saved in batches, with one insert for the transactions and one
+    for their ledger entries.  A ``bulk.Result`` is yielded for each
+    authorization as it completes, with the ``Authorization`` as its item.
+
+    Authorizations that have already been captured are skipped (yielded with
+    neither a result nor an error), so an interrupted run can be restarted
+    with the same input.  Repeated tokens and order numbers are ignored, and
+    an authorization given both by token and by order number is only
+    captured once.
+
+    :tokens: Iterable of Express tokens
+    :order_numbers: Iterable of order numbers
+    :workers: Number of concurrent calls (defaults to PAYPAL_BULK_WORKERS)
+    :rate: Maximum calls per second (defaults to PAYPAL_BULK_RATE_LIMIT)
+    """
+    pending = []
+
+    def flush():
+        saved = [result for result in pending if result.result is not None]
+        with transaction.atomic():
+            save_transactions(
+                [result.result for result in saved],
+                [result.item.order_number for result in saved])
+        del pending[:]
+
+    def capture(authorization):
+        return do_capture(authorization.authorization_id,
+                          authorization.amount, authorization.currency,
+                          note=note, commit=False)
+
+    # IDs of the authorizations dispatched so far in this run
+    dispatched = set()
+    try:
+        for batch in _get_batches(_unique(tokens), _unique(order_numbers)):
+            captured_ids = get_captured_ids(
+                [a.authorization_id for a in batch if a.authorization_id])
+            to_capture = []
+            for authorization in batch:
+                if authorization.authorization_id is None:
+                    yield bulk.Result(authorization, None, PayPalError(
+                        "No authorization found"))
+                elif (authorization.authorization_id in captured_ids or
+                      authorization.authorization_id in dispatched):
+                    yield bulk.Result(authorization, None, None)
+                else:
+                    dispatched.add(authorization.authorization_id)
+                    to_capture.append(authorization)
+
+            for result in bulk.run_concurrently(capture, to_capture,
+                                                workers=workers, rate=rate):
+                result = bulk.check(result)
+                pending.append(result)
+                if len(pending) >= FLUSH_SIZE:
+                    flush()
+                yield result
+    finally:
+        # Save whatever has been captured, even if the run is interrupted
+        flush()
+
+
+def _unique(values):
+    seen = set()
+    for value in values:
+        if value not in seen:
+            seen.add(value)
+            yield value
+
+
+def _get_batches(tokens, order_numbers):
+    """
+    Yield lists of authorizations for the tokens and order numbers, looking
+    up BATCH_SIZE at a time.  Missing authorizations have no ID.
+    """
+    for chunk in bulk.chunked(tokens, BATCH_SIZE):
+        authorizations = get_authorizations(chunk)
+        batch = []
+        for token in chunk:
+            batch.extend(authorizations.get(token) or [Authorization(
+                token, None, None, None, None)])
+        yield batch
+
+    for chunk in bulk.chunked(order_numbers, BATCH_SIZE):
+        order_tokens = get_tokens_for_orders(chunk)
+        token_orders = dict((t, n) for n, t in order_tokens.items())
+        authorizations = get_authorizations(list(token_orders),
+                                            token_orders)
+        batch = []
+        for order_number in chunk:
+            token = order_tokens.get(order_number)
+            batch.extend(authorizations.get(token) or [Authorization(
+                token, order_number, None, None, None)])
+        yield batch
@@ -0,0 +1,130 @@
+"""
+Snapshot of the PAYPAL_* settings used by Express.
+
+The settings are read and validated once per process rather than on every
+request.  The snapshot is rebuilt if a PAYPAL_* setting is changed (eg by
+``override_settings`` in tests).
+"""
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+try:
+    from django.core.signals import setting_changed
+except ImportError:
+    # Django < 1.8
+    from django.test.signals import setting_changed
+
+SALE, AUTHORIZATION, ORDER = 'Sale', 'Authorization', 'Order'
+
+VALID_LOCALES = ('AU', 'DE', 'FR', 'GB', 'IT', 'ES', 'JP', 'US')
+
+
+def clean_params(params):
+    """
+    Validate and tidy a dict of SetExpressCheckout parameters: booleans become
+    integers and None values are removed.
+    """
+    locale = params.get('LOCALECODE', None)
+    if locale and locale not in VALID_LOCALES:
+        raise ImproperlyConfigured(
+            "'%s' is not a valid locale code" % locale)
+    return dict((k, int(v) if isinstance(v, bool) else v)
+                for k, v in params.items() if v is not None)
+
+
+def get_api_version():
+    # The latest version of the PayPal Express API can be found here:
+    # https://developer.paypal.com/docs/classic/release-notes/
+    return getattr(settings, 'PAYPAL_API_VERSION', '119')
+
+
+class ExpressSettings(object):
+
+    def __init__(self):
+        self.api_version = get_api_version()
+
+        if getattr(settings, 'PAYPAL_SANDBOX_MODE', True):
+            self.api_url = 'https://api-3t.sandbox.paypal.com/nvp'
+            self.redirect_url = 'https://www.sandbox.paypal.com/webscr'
+        else:
+            self.api_url = 'https://api-3t.paypal.com/nvp'
+            self.redirect_url = 'https://www.paypal.com/webscr'
+
+        # Included in every request
+        self.credentials = {
+            'VERSION': self.api_version,
+            'USER': settings.PAYPAL_API_USERNAME,
+            'PWD': settings.PAYPAL_API_PASSWORD,
+            'SIGNATURE': settings.PAYPAL_API_SIGNATURE,
+        }
+
+        # PayPal supports 3 actions: 'Sale', 'Authorization', 'Order'
+        self.payment_action = getattr(settings, 'PAYPAL_PAYMENT_ACTION', SALE)
+        if self.payment_action not in (SALE, AUTHORIZATION, ORDER):
+            raise ImproperlyConfigured(
+                "'%s' is not a valid payment action" % self.payment_action)
+
+        self.currency = getattr(settings, 'PAYPAL_CURRENCY', 'GBP')
+        use_https = getattr(settings, 'PAYPAL_CALLBACK_HTTPS', True)
+        self.callback_scheme = 'https' if use_https else 'http'
+        self.confirm_shipping = getattr(
+            settings, 'PAYPAL_CONFIRM_SHIPPING', None)
+
+        # Line item compaction for large baskets
+        self.merge_line_items = getattr(
+            settings, 'PAYPAL_MERGE_LINE_ITEMS', False)
+        self.max_line_items = getattr(settings, 'PAYPAL_MAX_LINE_ITEMS', None)
+
+        # Split multi-seller baskets into parallel payments
+        self.parallel_payments = getattr(
+            settings, 'PAYPAL_PARALLEL_PAYMENTS', False)
+
+        # Default SetExpressCheckout parameters.  These can be overridden and
+        # customised using the paypal_params parameter of set_txn.
+        self.set_txn_defaults = clean_params({
+            'CUSTOMERSERVICENUMBER': getattr(
+                settings, 'PAYPAL_CUSTOMER_SERVICES_NUMBER', None),
+            'SOLUTIONTYPE': getattr(settings, 'PAYPAL_SOLUTION_TYPE', None),
+            'LANDINGPAGE': getattr(settings, 'PAYPAL_LANDING_PAGE', None),
+            'BRANDNAME': getattr(settings, 'PAYPAL_BRAND_NAME', None),
+
+            # Display settings
+            'PAGESTYLE': getattr(settings, 'PAYPAL_PAGESTYLE', None),
+            'HDRIMG': getattr(settings, 'PAYPAL_HEADER_IMG', None),
+            'PAYFLOWCOLOR': getattr(settings, 'PAYPAL_PAYFLOW_COLOR', None),
+
+            # Think these settings maybe deprecated in latest version of
+            # PayPal's API
+            'HDRBACKCOLOR': getattr(
+                settings, 'PAYPAL_HEADER_BACK_COLOR', None),
+            'HDRBORDERCOLOR': getattr(
+                settings, 'PAYPAL_HEADER_BORDER_COLOR', None),
+
+            'LOCALECODE': getattr(settings, 'PAYPAL_LOCALE', None),
+
+            'ALLOWNOTE': getattr(settings, 'PAYPAL_ALLOW_NOTE', True),
+            'CALLBACKTIMEOUT': getattr(settings, 'PAYPAL_CALLBACK_TIMEOUT', 3)
+        })
+
+
+_settings = None
+
+
+def get_settings():
+    global _settings
+    if _settings is None:
+        _settings = ExpressSettings()
+    return _settings
+
+
+def is_configured():
+    return hasattr(settings, 'PAYPAL_API_USERNAME')
+
+
+def reset(**kwargs):
+    global _settings
+    if kwargs.get('setting', '').startswith('PAYPAL_'):
+        _settings = None
+
+setting_changed.connect(reset)
@@ -0,0 +1,51 @@
+from __future__ import unicode_literals
+
+from django import forms
+from django.db.models import Q
+from django.utils.translation import ugettext_lazy as _
+
+from paypal.dashboard import TransactionSearchForm
+from paypal.express import gateway
+from paypal.express.models import ExpressTransaction
+from paypal.ledger.models import LedgerEntry
+
+METHOD_CHOICES = [('', _("All"))] + [(method, method) for method in (
+    gateway.SET_EXPRESS_CHECKOUT, gateway.GET_EXPRESS_CHECKOUT,
+    gateway.DO_EXPRESS_CHECKOUT, gateway.DO_CAPTURE, gateway.DO_VOID,
+    gateway.DO_REAUTHORIZATION, gateway.REFUND_TRANSACTION,
+    gateway.TRANSACTION_SEARCH)]
+
+ACK_CHOICES = [('', _("All"))] + [(ack, ack) for ack in (
+    ExpressTransaction.SUCCESS, ExpressTransaction.SUCCESS_WITH_WARNING,
+    ExpressTransaction.FAILURE)]
+
+
+class ExpressTransactionSearchForm(TransactionSearchForm):
+    method = forms.ChoiceField(label=_("Method"), choices=METHOD_CHOICES,
+                               required=False)
+    ack = forms.ChoiceField(label=_("Result"), choices=ACK_CHOICES,
+                            required=False)
+    currency = forms.CharField(label=_("Currency"), max_length=8,
+                               required=False)
+
+    search_fields = ('token', 'correlation_id', 'transaction_id')
+
+    def filter(self, queryset):
+        queryset = super(ExpressTransactionSearchForm, self).filter(queryset)
+        data = self.cleaned_data
+        if data['method']:
+            queryset = queryset.filter(method=data['method'])
+        if data['ack']:
+            queryset = queryset.filter(ack=data['ack'])
+        if data['currency']:
+            queryset = queryset.filter(currency=data['currency'].upper())
+        return queryset
+
+    def get_search_filter(self, query):
+        # Express transactions only know their token, so orders are found
+        # through the ledger
+        tokens = LedgerEntry.objects.filter(
+            gateway=LedgerEntry.EXPRESS, order_number=query,
+            reference__isnull=False).values('reference')
+        return super(ExpressTransactionSearchForm, self).get_search_filter(
+            query) | Q(token__in=tokens)
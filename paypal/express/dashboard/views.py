@@ -1,13 +1,15 @@
 from django.views import generic
 from django.conf import settings
 
+from paypal import dashboard
 from paypal.express import models
+from paypal.express.dashboard.forms import ExpressTransactionSearchForm
 
 
-class TransactionListView(generic.ListView):
+class TransactionListView(dashboard.TransactionListView):
     model = models.ExpressTransaction
     template_name = 'paypal/express/dashboard/transaction_list.html'
-    context_object_name = 'transactions'
+    form_class = ExpressTransactionSearchForm
 
 
 class TransactionDetailView(generic.DetailView):
@@ -2,24 +2,32 @@
 Responsible for briding between Oscar and the PayPal gateway
 """
 from __future__ import unicode_literals
+import hashlib
+import logging
+
+from django.core.cache import cache
 from django.core.urlresolvers import reverse
 from django.contrib.sites.models import Site
 from django.conf import settings
-from django.core.exceptions import ImproperlyConfigured
+from django.utils.crypto import constant_time_compare, salted_hmac
 
+from paypal import singleflight
+from paypal.exceptions import PayPalError
+from paypal.express.conf import get_settings
 from paypal.express.models import ExpressTransaction as Transaction
 from paypal.express.gateway import (
     set_txn, get_txn, do_txn, SALE, AUTHORIZATION, ORDER,
-    do_capture, DO_EXPRESS_CHECKOUT, do_void, refund_txn
+    do_capture, DO_EXPRESS_CHECKOUT, GET_EXPRESS_CHECKOUT, do_void,
+    refund_txn, get_payments, get_payment_info, get_latest_authorization_ids
 )
 
+logger = logging.getLogger('paypal.express')
+
 
 def _get_payment_action():
-    # PayPal supports 3 actions: 'Sale', 'Authorization', 'Order'
-    action = getattr(settings, 'PAYPAL_PAYMENT_ACTION', SALE)
-    if action not in (SALE, AUTHORIZATION, ORDER):
-        raise ImproperlyConfigured("'%s' is not a valid payment action" % action)
-    return action
+    # PayPal supports 3 actions: 'Sale', 'Authorization', 'Order'.  The
+    # setting is validated when the settings snapshot is built.
+    return get_settings().payment_action
 
 
 def get_paypal_url(basket, shipping_methods, user=None, shipping_address=None,
@@ -33,12 +41,12 @@ def get_paypal_url(basket, shipping_methods, user=None, shipping_address=None,
     given to PayPal directly - this is used within when using PayPal as a
     payment method.
     """
-    currency = getattr(settings, 'PAYPAL_CURRENCY', 'GBP')
+    config = get_settings()
+    currency = config.currency
     if host is None:
         host = Site.objects.get_current().domain
     if scheme is None:
-        use_https = getattr(settings, 'PAYPAL_CALLBACK_HTTPS', True)
-        scheme = 'https' if use_https else 'http'
+        scheme = config.callback_scheme
     return_url = '%s://%s%s' % (
         scheme, host, reverse('paypal-success-response', kwargs={
             'basket_id': basket.id}))
@@ -83,35 +91,126 @@ def get_paypal_url(basket, shipping_methods, user=None, shipping_address=None,
                    paypal_params=paypal_params)
 
 
-def fetch_transaction_details(token):
+def fetch_transaction_details(token, payer_id=None):
     """
     Fetch the completed details about the PayPal transaction.
+
+    The details are cached for a short time (PAYPAL_DETAILS_CACHE_TIMEOUT).
+    If a payer ID is passed, a cached copy for the same token and payer is
+    used when available - this avoids a second round-trip to PayPal when the
+    order is placed straight after the preview.
     """
-    return get_txn(token)
+    if payer_id is not None:
+        txn = _get_cached_details(token, payer_id)
+        if txn is not None:
+            return txn
+
+    def fetch():
+        txn = get_txn(token)
+        _cache_details(txn)
+        return txn
 
+    # Concurrent requests for the same token (eg a double-click) share a
+    # single call to PayPal.
+    return singleflight.do((GET_EXPRESS_CHECKOUT, token), fetch)
 
-def confirm_transaction(payer_id, token, amount, currency):
+
+def confirm_transaction(payer_id, token, amount, currency, order_number=None,
+                        details=None, msg_sub_id=None):
     """
     Confirm the payment action.
+
+    :details: The GetExpressCheckoutDetails transaction.  This is needed to
+              take parallel payments, which are confirmed with the amount
+              for each seller.
+    :msg_sub_id: Idempotency key, so that the call can be safely repeated.
     """
+    # The details will be out of date once payment has been taken
+    cache.delete(_get_details_cache_key(token, payer_id))
+    payments = get_payments(details) if details is not None else []
     return do_txn(payer_id, token, amount, currency,
-                  action=_get_payment_action())
+                  action=_get_payment_action(), order_number=order_number,
+                  payments=payments if len(payments) > 1 else None,
+                  msg_sub_id=msg_sub_id)
+
+
+def _get_details_cache_key(token, payer_id):
+    # Both values come from the querystring so hash them to get a safe key
+    digest = hashlib.md5(('%s:%s' % (token, payer_id)).encode('utf8'))
+    return 'paypal-express-details-%s' % digest.hexdigest()
+
+
+def _get_details_digest(txn):
+    return salted_hmac('paypal.express.details', '%s:%s' % (
+        txn.pk, txn.raw_response)).hexdigest()
+
+
+def _cache_details(txn):
+    timeout = getattr(settings, 'PAYPAL_DETAILS_CACHE_TIMEOUT', 300)
+    payer_id = txn.value('PAYERID')
+    if not timeout or not payer_id:
+        return
+    cache.set(_get_details_cache_key(txn.token, payer_id),
+              (txn, _get_details_digest(txn)), timeout)
+
+
+def _get_cached_details(token, payer_id):
+    cached = cache.get(_get_details_cache_key(token, payer_id))
+    if cached is None:
+        return None
+    try:
+        txn, digest = cached
+        is_valid = (isinstance(txn, Transaction) and
+                    txn.token == token and
+                    txn.value('PAYERID') == payer_id and
+                    txn.is_successful and
+                    constant_time_compare(digest, _get_details_digest(txn)))
+    except (TypeError, ValueError, AttributeError):
+        is_valid = False
+    if not is_valid:
+        logger.warning("Discarding invalid cached details for token %s",
+                       token)
+        cache.delete(_get_details_cache_key(token, payer_id))
+        return None
+    return txn
+
+
+def _get_payment(txn):
+    # The single-token helpers below act on one payment, so can't be used
+    # for parallel checkouts.
+    payments = get_payment_info(txn)
+    if len(payments) > 1:
+        raise PayPalError(
+            "Checkout %s has %d payments; use paypal.express.bulk for "
+            "parallel payments" % (txn.token, len(payments)))
+    if not payments:
+        raise PayPalError("Checkout %s has no payment" % txn.token)
+    return payments[0]
 
 
 def refund_transaction(token, amount, currency, note=None):
-    txn = Transaction.objects.get(token=token,
-                                  method=DO_EXPRESS_CHECKOUT)
-    is_partial = amount < txn.amount
-    return refund_txn(txn.value('PAYMENTINFO_0_TRANSACTIONID'), is_partial, amount, currency)
+    txn = Transaction.objects.without_request().get(
+        token=token, method=DO_EXPRESS_CHECKOUT)
+    payment = _get_payment(txn)
+    is_partial = amount < payment.amount
+    return refund_txn(payment.transaction_id, is_partial, amount, currency)
+
+
+def _get_authorization_id(txn):
+    # Use the latest reauthorization, if there's been one
+    authorization_id = _get_payment(txn).transaction_id
+    return get_latest_authorization_ids(
+        [authorization_id])[authorization_id]
 
 
 def capture_authorization(token, note=None):
     """
-    Capture a previous authorization.
+    Capture a previous authorization.  Parallel checkouts have to be
+    captured with ``paypal.express.bulk.capture_authorizations``.
     """
-    txn = Transaction.objects.get(token=token,
-                                  method=DO_EXPRESS_CHECKOUT)
-    return do_capture(txn.value('PAYMENTINFO_0_TRANSACTIONID'),
+    txn = Transaction.objects.without_request().get(
+        token=token, method=DO_EXPRESS_CHECKOUT)
+    return do_capture(_get_authorization_id(txn),
                       txn.amount, txn.currency, note=note)
 
 
@@ -119,6 +218,6 @@ def void_authorization(token, note=None):
     """
     Void a previous authorization.
     """
-    txn = Transaction.objects.get(token=token,
-                                  method=DO_EXPRESS_CHECKOUT)
-    return do_void(txn.value('PAYMENTINFO_0_TRANSACTIONID'), note=note)
+    txn = Transaction.objects.without_request().get(
+        token=token, method=DO_EXPRESS_CHECKOUT)
+    return do_void(_get_authorization_id(txn), note=note)
@@ -1,18 +1,20 @@
 from __future__ import unicode_literals
+from collections import OrderedDict, namedtuple
 import logging
 from decimal import Decimal as D
 
-from django.conf import settings
-from django.core.exceptions import ImproperlyConfigured
+from django.db import transaction
 from django.utils.http import urlencode
-from django.utils import six
+from django.utils import six, timezone
 from django.utils.translation import ugettext as _
 from django.template.defaultfilters import truncatewords, striptags
-from localflavor.us import us_states
 
-from . import models, exceptions as express_exceptions
+from . import addresses, models, exceptions as express_exceptions
+from .conf import (SALE, AUTHORIZATION, ORDER, clean_params,
+                   get_api_version, get_settings)
 from paypal import gateway
 from paypal import exceptions
+from paypal.ledger.models import LedgerEntry
 
 
 # PayPal methods
@@ -21,13 +23,14 @@ GET_EXPRESS_CHECKOUT = 'GetExpressCheckoutDetails'
 DO_EXPRESS_CHECKOUT = 'DoExpressCheckoutPayment'
 DO_CAPTURE = 'DoCapture'
 DO_VOID = 'DoVoid'
+DO_REAUTHORIZATION = 'DoReauthorization'
 REFUND_TRANSACTION = 'RefundTransaction'
+TRANSACTION_SEARCH = 'TransactionSearch'
 
-SALE, AUTHORIZATION, ORDER = 'Sale', 'Authorization', 'Order'
-
-# The latest version of the PayPal Express API can be found here:
-# https://developer.paypal.com/docs/classic/release-notes/
-API_VERSION = getattr(settings, 'PAYPAL_API_VERSION', '119')
+# Kept for code that reads it from here.  It's fixed when the module is
+# imported; the version sent to PayPal is the settings snapshot's, which
+# follows changes to PAYPAL_API_VERSION.
+API_VERSION = get_api_version()
 
 logger = logging.getLogger('paypal.express')
 
@@ -42,27 +45,120 @@ def _format_currency(amt):
     return amt.quantize(D('0.01'))
 
 
-def _fetch_response(method, extra_params):
+# Formatted product descriptions keyed by product and when it was last
+# updated.  Stripping and truncating HTML is relatively expensive and the same
+# products turn up in basket after basket.
+DESCRIPTION_CACHE_SIZE = 1000
+_description_cache = {}
+
+
+def _get_product_description(product):
+    key = (product.pk, getattr(product, 'date_updated', None))
+    try:
+        return _description_cache[key]
+    except KeyError:
+        pass
+    desc = ''
+    if product.description:
+        desc = _format_description(product.description)
+    if len(_description_cache) >= DESCRIPTION_CACHE_SIZE:
+        _description_cache.clear()
+    _description_cache[key] = desc
+    return desc
+
+
+LineItem = namedtuple('LineItem', 'key name number desc amount quantity')
+
+
+def compact_line_items(items, merge=False, max_items=None):
+    """
+    Reduce the number of line items sent to PayPal.
+
+    :merge: Merge items with the same key (ie the same product and unit price)
+            by adding up their quantities.
+    :max_items: Itemise at most this many lines - any further items are rolled
+                into a single aggregate line.
+
+    The total of the items (amount x quantity) is unchanged - the aggregate
+    line carries the exact sum of the items it replaces, so ITEMAMT still
+    matches the line items.
+    """
+    if merge:
+        merged, positions = [], {}
+        for item in items:
+            if item.key is not None and item.key in positions:
+                position = positions[item.key]
+                merged[position] = merged[position]._replace(
+                    quantity=merged[position].quantity + item.quantity)
+                continue
+            if item.key is not None:
+                positions[item.key] = len(merged)
+            merged.append(item)
+        items = merged
+
+    if max_items and len(items) > max_items:
+        num_kept = max(max_items, 1) - 1
+        rest = items[num_kept:]
+        amount = _format_currency(
+            sum((item.amount * item.quantity for item in rest), D('0.00')))
+        # Discounts have no key, so don't count as items
+        num_items = sum(item.quantity for item in rest
+                        if item.key is not None)
+        if all(item.key is not None for item in rest):
+            name = _("%d other items") % num_items
+        elif num_items:
+            name = _("%d other items and discounts") % num_items
+        else:
+            name = _("Other discounts")
+        items = items[:num_kept] + [LineItem(
+            key=None, name=name, number=None, desc='', amount=amount,
+            quantity=1)]
+    return items
+
+
+def _get_inherited_titles(products):
+    """
+    Return a dict mapping product ID to title for child products that take
+    their title from their parent.  The parents are fetched in a single query
+    rather than one per line.
+    """
+    parent_ids = {}
+    for product in products:
+        parent_id = getattr(product, 'parent_id', None)
+        if not product.title and parent_id:
+            parent_ids.setdefault(parent_id, []).append(product.pk)
+    if not parent_ids:
+        return {}
+    manager = type(products[0])._default_manager
+    titles = {}
+    for parent_id, title in manager.filter(
+            id__in=list(parent_ids)).values_list('id', 'title'):
+        for product_id in parent_ids[parent_id]:
+            titles[product_id] = title
+    return titles
+
+
+def _fetch_response(method, extra_params, order_number=None, basket_id=None,
+                    commit=True):
     """
     Fetch the response from PayPal and return a transaction object
+
+    :order_number: Order number to record in the ledger (if known)
+    :basket_id: Basket ID to record in the ledger (if known)
+    :commit: Whether to save the transaction.  If False, the unsaved
+             transaction is returned even if it wasn't successful and the
+             caller is responsible for saving it with ``save_transaction``.
     """
+    config = get_settings()
+
     # Build parameter string
-    params = {
-        'METHOD': method,
-        'VERSION': API_VERSION,
-        'USER': settings.PAYPAL_API_USERNAME,
-        'PWD': settings.PAYPAL_API_PASSWORD,
-        'SIGNATURE': settings.PAYPAL_API_SIGNATURE,
-    }
+    params = dict(config.credentials, METHOD=method)
     params.update(extra_params)
-
-    if getattr(settings, 'PAYPAL_SANDBOX_MODE', True):
-        url = 'https://api-3t.sandbox.paypal.com/nvp'
-    else:
-        url = 'https://api-3t.paypal.com/nvp'
+    url = config.api_url
 
     # Print easy-to-read version of params for debugging
-    param_str = "\n".join(["%s: %s" % x for x in sorted(params.items())])
+    param_str = "\n".join(["%s: %s" % x for x in
+                           sorted(gateway.redact(params))])
     logger.debug("Making %s request to %s with params:\n%s", method, url,
                  param_str)
 
@@ -77,33 +173,54 @@ def _fetch_response(method, extra_params):
     # was successful or not
     txn = models.ExpressTransaction(
         method=method,
-        version=API_VERSION,
+        version=config.api_version,
         ack=pairs['ACK'],
         raw_request=pairs['_raw_request'],
         raw_response=pairs['_raw_response'],
         response_time=pairs['_response_time'],
     )
+    # Failed calls have a correlation ID too, which PayPal asks for when
+    # investigating them
+    txn.correlation_id = pairs.get('CORRELATIONID')
     if txn.is_successful:
-        txn.correlation_id = pairs['CORRELATIONID']
         if method == SET_EXPRESS_CHECKOUT:
-            txn.amount = params['PAYMENTREQUEST_0_AMT']
+            txn.amount = _get_total(params, 'PAYMENTREQUEST')
             txn.currency = params['PAYMENTREQUEST_0_CURRENCYCODE']
             txn.token = pairs['TOKEN']
         elif method == GET_EXPRESS_CHECKOUT:
             txn.token = params['TOKEN']
-            txn.amount = D(pairs['PAYMENTREQUEST_0_AMT'])
+            txn.amount = _get_total(pairs, 'PAYMENTREQUEST')
             txn.currency = pairs['PAYMENTREQUEST_0_CURRENCYCODE']
         elif method == DO_EXPRESS_CHECKOUT:
             txn.token = params['TOKEN']
-            txn.amount = D(pairs['PAYMENTINFO_0_AMT'])
+            txn.amount = _get_total(pairs, 'PAYMENTINFO')
             txn.currency = pairs['PAYMENTINFO_0_CURRENCYCODE']
+            txn.transaction_id = pairs.get('PAYMENTINFO_0_TRANSACTIONID')
+        elif method == DO_CAPTURE:
+            txn.amount = D(pairs['AMT'])
+            txn.currency = pairs['CURRENCYCODE']
+            txn.transaction_id = pairs.get('TRANSACTIONID')
+        elif method == DO_REAUTHORIZATION:
+            # The reauthorization replaces the original authorization, so
+            # later captures and voids must use its ID.
+            txn.amount = D(params['AMT'])
+            txn.currency = params['CURRENCYCODE']
+            txn.transaction_id = pairs.get('AUTHORIZATIONID')
+        elif method == REFUND_TRANSACTION:
+            txn.amount = D(pairs['GROSSREFUNDAMT'])
+            txn.currency = pairs['CURRENCYCODE']
+            txn.transaction_id = pairs.get('REFUNDTRANSACTIONID')
     else:
         # There can be more than one error, each with its own number.
         if 'L_ERRORCODE0' in pairs:
             txn.error_code = pairs['L_ERRORCODE0']
         if 'L_LONGMESSAGE0' in pairs:
             txn.error_message = pairs['L_LONGMESSAGE0']
-    txn.save()
+    if not commit:
+        # Kept for recording the ledger entry when the txn is saved
+        txn.request_params = params
+        return txn
+    save_transaction(txn, params, order_number, basket_id)
 
     if not txn.is_successful:
         msg = "Error %s - %s" % (txn.error_code, txn.error_message)
@@ -113,59 +230,192 @@ def _fetch_response(method, extra_params):
     return txn
 
 
+def _get_total(pairs, prefix):
+    # Parallel payments have an amount for each payment
+    total = D('0.00')
+    number = 0
+    while '%s_%d_AMT' % (prefix, number) in pairs:
+        total += D(pairs['%s_%d_AMT' % (prefix, number)])
+        number += 1
+    return total
+
+
+def save_transaction(txn, params=None, order_number=None, basket_id=None):
+    """
+    Save a transaction and record it in the ledger.  This is needed for
+    transactions fetched with ``commit=False``.
+    """
+    if params is None:
+        params = txn.request_params
+    txn.save()
+    entries = _get_ledger_entries(txn, params, order_number, basket_id)
+    if len(entries) == 1:
+        LedgerEntry.objects.record(**entries[0])
+    else:
+        LedgerEntry.objects.record_many(entries)
+
+
+def save_transactions(txns, order_numbers=None):
+    """
+    Save a batch of transactions fetched with ``commit=False`` in one
+    database transaction, and record them in the ledger with one insert.
+
+    :order_numbers: Optional list of the order number of each transaction
+    """
+    if not txns:
+        return
+    if order_numbers is None:
+        order_numbers = [None] * len(txns)
+    with transaction.atomic():
+        # The transactions are saved one at a time as the ledger's audit
+        # links need their primary keys, which bulk_create doesn't set.
+        for txn in txns:
+            txn.save()
+        entries = []
+        for txn, order_number in zip(txns, order_numbers):
+            entries.extend(
+                _get_ledger_entries(txn, txn.request_params, order_number))
+        LedgerEntry.objects.record_many(entries)
+
+
+def _get_ledger_entries(txn, params, order_number=None, basket_id=None):
+    # Capture, void and refund calls act on a PayPal transaction ID rather
+    # than a token.
+    entry = dict(
+        gateway=LedgerEntry.EXPRESS,
+        operation=txn.method,
+        audit_txn=txn,
+        order_number=order_number,
+        basket_id=basket_id,
+        reference=txn.token,
+        transaction_id=(params.get('AUTHORIZATIONID') or
+                        params.get('TRANSACTIONID')),
+        amount=txn.amount if txn.amount is not None else params.get('AMT'),
+        currency=txn.currency or params.get('CURRENCYCODE'),
+        status=txn.ack,
+        is_successful=txn.is_successful)
+    if txn.method != DO_EXPRESS_CHECKOUT or not txn.is_successful:
+        return [entry]
+    # Each payment of a checkout (more than one for parallel payments) is a
+    # separate PayPal transaction, so has its own entry.
+    entries = []
+    for payment in get_payment_info(txn):
+        entries.append(dict(
+            entry, transaction_id=payment.transaction_id,
+            amount=payment.amount,
+            currency=payment.currency or txn.currency))
+    return entries or [entry]
+
+
+# A payment within a SetExpressCheckout call.  The seller is None for
+# payments to the merchant's own account.
+PaymentRequest = namedtuple('PaymentRequest', 'seller items amount')
+
+# PayPal allows up to 10 payments per checkout (PAYMENTREQUEST_0 to 9)
+MAX_PAYMENT_REQUESTS = 10
+
+
+def group_lines_by_seller(lines):
+    """
+    Return a list of (seller, lines) pairs, where the seller is the PayPal
+    account (``paypal_email``) of the lines' partner, or None for partners
+    without one.  The partners are fetched in a single query rather than one
+    per line.
+    """
+    stockrecords = [line.stockrecord for line in lines]
+    if not stockrecords:
+        return []
+    partner_model = type(stockrecords[0])._meta.get_field('partner').rel.to
+    partners = partner_model._default_manager.in_bulk(
+        set(stockrecord.partner_id for stockrecord in stockrecords))
+    sellers = OrderedDict()
+    for line in lines:
+        partner = partners.get(line.stockrecord.partner_id)
+        seller = getattr(partner, 'paypal_email', None) or None
+        sellers.setdefault(seller, []).append(line)
+    return list(sellers.items())
+
+
+def _get_line_items(lines, inherited_titles):
+    items = []
+    for line in lines:
+        product = line.product
+        title = inherited_titles.get(product.pk)
+        if title is None:
+            title = product.get_title()
+        # Note, we don't include discounts here - they are handled as separate
+        # lines - see _get_discount_items
+        amount = _format_currency(line.unit_price_incl_tax)
+        items.append(LineItem(
+            key=(product.pk, amount),
+            name=title,
+            number=product.upc if product.upc else '',
+            desc=_get_product_description(product),
+            amount=amount,
+            quantity=line.quantity))
+    return items
+
+
+def _get_discount_items(basket):
+    # If the order has discounts associated with it, the way PayPal suggests
+    # using the API is to add a separate item for the discount with the value
+    # as a negative price.  See "Integrating Order Details into the Express
+    # Checkout Flow"
+    # https://cms.paypal.com/us/cgi-bin/?cmd=_render-content&content_ID=developer/e_howto_api_ECCustomizing
+
+    # Iterate over the 3 types of discount that can occur
+    discounts = []
+    for discount in basket.offer_discounts:
+        name = _("Special Offer: %s") % discount['name']
+        discounts.append((name, discount))
+    for discount in basket.voucher_discounts:
+        name = "%s (%s)" % (discount['voucher'].name,
+                            discount['voucher'].code)
+        discounts.append((name, discount))
+    for discount in basket.shipping_discounts:
+        name = _("Shipping Offer: %s") % discount['name']
+        discounts.append((name, discount))
+    return [LineItem(key=None,
+                     name=name,
+                     number=None,
+                     desc=_format_description(name),
+                     amount=_format_currency(-discount['discount']),
+                     quantity=1)
+            for name, discount in discounts]
+
+
 def set_txn(basket, shipping_methods, currency, return_url, cancel_url, update_url=None,
             action=SALE, user=None, user_address=None, shipping_method=None,
-            shipping_address=None, no_shipping=False, paypal_params=None):
+            shipping_address=None, no_shipping=False, paypal_params=None,
+            merge_lines=None, max_lines=None, parallel=None):
     """
     Register the transaction with PayPal to get a token which we use in the
     redirect URL.  This is the 'SetExpressCheckout' from their documentation.
 
     There are quite a few options that can be passed to PayPal to configure
     this request - most are controlled by PAYPAL_* settings.
+
+    :merge_lines: Whether to merge lines for the same product and price.
+                  Defaults to PAYPAL_MERGE_LINE_ITEMS.
+    :max_lines: The maximum number of line items to send - the remainder are
+                rolled into a single line.  Defaults to PAYPAL_MAX_LINE_ITEMS.
+    :parallel: Whether to take a separate (parallel) payment for each seller
+               if the basket has lines from more than one.  Defaults to
+               PAYPAL_PARALLEL_PAYMENTS.
     """
-    # Default parameters (taken from global settings).  These can be overridden
-    # and customised using the paypal_params parameter.
-    _params = {
-        'CUSTOMERSERVICENUMBER': getattr(
-            settings, 'PAYPAL_CUSTOMER_SERVICES_NUMBER', None),
-        'SOLUTIONTYPE': getattr(settings, 'PAYPAL_SOLUTION_TYPE', None),
-        'LANDINGPAGE': getattr(settings, 'PAYPAL_LANDING_PAGE', None),
-        'BRANDNAME': getattr(settings, 'PAYPAL_BRAND_NAME', None),
-
-        # Display settings
-        'PAGESTYLE': getattr(settings, 'PAYPAL_PAGESTYLE', None),
-        'HDRIMG': getattr(settings, 'PAYPAL_HEADER_IMG', None),
-        'PAYFLOWCOLOR': getattr(settings, 'PAYPAL_PAYFLOW_COLOR', None),
-
-        # Think these settings maybe deprecated in latest version of PayPal's
-        # API
-        'HDRBACKCOLOR': getattr(settings, 'PAYPAL_HEADER_BACK_COLOR', None),
-        'HDRBORDERCOLOR': getattr(
-            settings, 'PAYPAL_HEADER_BORDER_COLOR', None),
-
-        'LOCALECODE': getattr(settings, 'PAYPAL_LOCALE', None),
-
-        'ALLOWNOTE': getattr(settings, 'PAYPAL_ALLOW_NOTE', True),
-        'CALLBACKTIMEOUT': getattr(settings, 'PAYPAL_CALLBACK_TIMEOUT', 3)
-    }
-    confirm_shipping_addr = getattr(settings, 'PAYPAL_CONFIRM_SHIPPING', None)
-    if confirm_shipping_addr and not no_shipping:
-        _params['REQCONFIRMSHIPPING'] = 1
+    # Default parameters (taken from global settings and validated once per
+    # process).  These can be overridden and customised using the
+    # paypal_params parameter.
+    config = get_settings()
+    params = dict(config.set_txn_defaults)
+    if config.confirm_shipping and not no_shipping:
+        params['REQCONFIRMSHIPPING'] = 1
     if paypal_params:
-        _params.update(paypal_params)
-
-    locale = _params.get('LOCALECODE', None)
-    if locale:
-        valid_choices = ('AU', 'DE', 'FR', 'GB', 'IT', 'ES', 'JP', 'US')
-        if locale not in valid_choices:
-            raise ImproperlyConfigured(
-                "'%s' is not a valid locale code" % locale)
-
-    # Boolean values become integers
-    _params.update((k, int(v)) for k, v in _params.items() if isinstance(v, bool))
-
-    # Remove None values
-    params = dict((k, v) for k, v in _params.items() if v is not None)
+        # Overrides with a value of None remove the default
+        for key, value in paypal_params.items():
+            if value is None:
+                params.pop(key, None)
+        params.update(clean_params(paypal_params))
 
     # PayPal have an upper limit on transactions.  It's in dollars which is a
     # fiddly to work with.  Lazy solution - only check when dollars are used as
@@ -181,82 +431,100 @@ def set_txn(basket, shipping_methods, currency, return_url, cancel_url, update_u
         logger.error(msg)
         raise express_exceptions.InvalidBasket(_(msg))
 
-    # PAYMENTREQUEST_0_AMT should include tax, shipping and handling
     params.update({
-        'PAYMENTREQUEST_0_AMT': amount,
-        'PAYMENTREQUEST_0_CURRENCYCODE': currency,
         'RETURNURL': return_url,
         'CANCELURL': cancel_url,
-        'PAYMENTREQUEST_0_PAYMENTACTION': action,
     })
 
-    # Add item details
-    index = 0
-    for index, line in enumerate(basket.all_lines()):
-        product = line.product
-        params['L_PAYMENTREQUEST_0_NAME%d' % index] = product.get_title()
-        params['L_PAYMENTREQUEST_0_NUMBER%d' % index] = (product.upc if
-                                                         product.upc else '')
-        desc = ''
-        if product.description:
-            desc = _format_description(product.description)
-        params['L_PAYMENTREQUEST_0_DESC%d' % index] = desc
-        # Note, we don't include discounts here - they are handled as separate
-        # lines - see below
-        params['L_PAYMENTREQUEST_0_AMT%d' % index] = _format_currency(
-            line.unit_price_incl_tax)
-        params['L_PAYMENTREQUEST_0_QTY%d' % index] = line.quantity
-
-    # If the order has discounts associated with it, the way PayPal suggests
-    # using the API is to add a separate item for the discount with the value
-    # as a negative price.  See "Integrating Order Details into the Express
-    # Checkout Flow"
-    # https://cms.paypal.com/us/cgi-bin/?cmd=_render-content&content_ID=developer/e_howto_api_ECCustomizing
+    if merge_lines is None:
+        merge_lines = config.merge_line_items
+    if max_lines is None:
+        max_lines = config.max_line_items
+    if parallel is None:
+        parallel = config.parallel_payments
+
+    lines = list(basket.all_lines())
+    inherited_titles = _get_inherited_titles([line.product for line in lines])
+    sellers = group_lines_by_seller(lines) if parallel else []
+    if len(sellers) > MAX_PAYMENT_REQUESTS:
+        msg = 'PayPal can only take payment for up to %d sellers at once' % (
+            MAX_PAYMENT_REQUESTS)
+        logger.error(msg)
+        raise express_exceptions.InvalidBasket(_(msg))
 
-    # Iterate over the 3 types of discount that can occur
-    for discount in basket.offer_discounts:
-        index += 1
-        name = _("Special Offer: %s") % discount['name']
-        params['L_PAYMENTREQUEST_0_NAME%d' % index] = name
-        params['L_PAYMENTREQUEST_0_DESC%d' % index] = _format_description(name)
-        params['L_PAYMENTREQUEST_0_AMT%d' % index] = _format_currency(
-            -discount['discount'])
-        params['L_PAYMENTREQUEST_0_QTY%d' % index] = 1
-    for discount in basket.voucher_discounts:
-        index += 1
-        name = "%s (%s)" % (discount['voucher'].name,
-                            discount['voucher'].code)
-        params['L_PAYMENTREQUEST_0_NAME%d' % index] = name
-        params['L_PAYMENTREQUEST_0_DESC%d' % index] = _format_description(name)
-        params['L_PAYMENTREQUEST_0_AMT%d' % index] = _format_currency(
-            -discount['discount'])
-        params['L_PAYMENTREQUEST_0_QTY%d' % index] = 1
-    for discount in basket.shipping_discounts:
-        index += 1
-        name = _("Shipping Offer: %s") % discount['name']
-        params['L_PAYMENTREQUEST_0_NAME%d' % index] = name
-        params['L_PAYMENTREQUEST_0_DESC%d' % index] = _format_description(name)
-        params['L_PAYMENTREQUEST_0_AMT%d' % index] = _format_currency(
-            -discount['discount'])
-        params['L_PAYMENTREQUEST_0_QTY%d' % index] = 1
-
-    # We include tax in the prices rather than separately as that's how it's
-    # done on most British/Australian sites.  Will need to refactor in the
-    # future no doubt.
-
-    # Note that the following constraint must be met
-    #
-    # PAYMENTREQUEST_0_AMT = (
-    #     PAYMENTREQUEST_0_ITEMAMT +
-    #     PAYMENTREQUEST_0_TAXAMT +
-    #     PAYMENTREQUEST_0_SHIPPINGAMT +
-    #     PAYMENTREQUEST_0_HANDLINGAMT)
-    #
-    # Hence, if tax is to be shown then it has to be aggregated up to the order
-    # level.
-    params['PAYMENTREQUEST_0_ITEMAMT'] = _format_currency(
-        basket.total_incl_tax)
-    params['PAYMENTREQUEST_0_TAXAMT'] = _format_currency(D('0.00'))
+    shipping_discount = D('0.00')
+    if len(sellers) > 1:
+        payment_requests = []
+        # There's no single list of items to add the shipping discounts to,
+        # so they're taken off the shipping charge instead (see below)
+        shipping_discount = sum(
+            (_format_currency(discount['discount'])
+             for discount in basket.shipping_discounts), D('0.00'))
+        for seller, seller_lines in sellers:
+            items = _get_line_items(seller_lines, inherited_titles)
+            # Discounts are taken from each seller's own lines
+            seller_amount = sum(
+                _format_currency(line.line_price_incl_tax_incl_discounts)
+                for line in seller_lines)
+            discount = seller_amount - sum(
+                item.amount * item.quantity for item in items)
+            if discount:
+                items.append(LineItem(
+                    key=None, name=_("Discount"), number=None, desc='',
+                    amount=discount, quantity=1))
+            payment_requests.append(PaymentRequest(
+                seller, compact_line_items(items, merge_lines, max_lines),
+                seller_amount))
+    else:
+        items = (_get_line_items(lines, inherited_titles) +
+                 _get_discount_items(basket))
+        payment_requests = [PaymentRequest(
+            None, compact_line_items(items, merge_lines, max_lines), amount)]
+
+    for number, payment_request in enumerate(payment_requests):
+        prefix = 'PAYMENTREQUEST_%d_' % number
+        # PAYMENTREQUEST_n_AMT should include tax, shipping and handling
+        params.update({
+            prefix + 'AMT': payment_request.amount,
+            prefix + 'CURRENCYCODE': currency,
+            prefix + 'PAYMENTACTION': action,
+        })
+        if payment_request.seller:
+            params[prefix + 'SELLERPAYPALACCOUNTID'] = payment_request.seller
+            # Identifies the payment in the DoExpressCheckoutPayment response
+            params[prefix + 'PAYMENTREQUESTID'] = '%s-%d' % (basket.id,
+                                                              number)
+
+        for index, item in enumerate(payment_request.items):
+            item_prefix = 'L_PAYMENTREQUEST_%d_' % number
+            params['%sNAME%d' % (item_prefix, index)] = item.name
+            if item.number is not None:
+                params['%sNUMBER%d' % (item_prefix, index)] = item.number
+            params['%sDESC%d' % (item_prefix, index)] = item.desc
+            params['%sAMT%d' % (item_prefix, index)] = item.amount
+            params['%sQTY%d' % (item_prefix, index)] = item.quantity
+
+        # We include tax in the prices rather than separately as that's how
+        # it's done on most British/Australian sites.  Will need to refactor
+        # in the future no doubt.
+
+        # Note that the following constraint must be met
+        #
+        # PAYMENTREQUEST_n_AMT = (
+        #     PAYMENTREQUEST_n_ITEMAMT +
+        #     PAYMENTREQUEST_n_TAXAMT +
+        #     PAYMENTREQUEST_n_SHIPPINGAMT +
+        #     PAYMENTREQUEST_n_HANDLINGAMT)
+        #
+        # Hence, if tax is to be shown then it has to be aggregated up to the
+        # order level.
+        params[prefix + 'ITEMAMT'] = _format_currency(payment_request.amount)
+        params[prefix + 'TAXAMT'] = _format_currency(D('0.00'))
+        if number:
+            # Shipping is charged with the first payment (see below)
+            params[prefix + 'SHIPPINGAMT'] = _format_currency(D('0.00'))
+            params[prefix + 'HANDLINGAMT'] = _format_currency(D('0.00'))
+            params[prefix + 'AMT'] = _format_currency(payment_request.amount)
 
     # Instant update callback information
     if update_url:
@@ -294,10 +562,8 @@ def set_txn(basket, shipping_methods, currency, return_url, cancel_url, update_u
         # For US addresses, we need to try and convert the state into 2 letter
         # code - otherwise we can get a 10736 error as the shipping address and
         # zipcode don't match the state. Very silly really.
-        if params['SHIPTOCOUNTRYCODE'] == 'US':
-            key = params['SHIPTOSTATE'].lower().strip()
-            if key in us_states.STATES_NORMALIZED:
-                params['SHIPTOSTATE'] = us_states.STATES_NORMALIZED[key]
+        params['SHIPTOSTATE'] = addresses.normalise_state(
+            params['SHIPTOCOUNTRYCODE'], params['SHIPTOSTATE'])
 
     elif no_shipping:
         params['NOSHIPPING'] = 1
@@ -333,9 +599,19 @@ def set_txn(basket, shipping_methods, currency, return_url, cancel_url, update_u
         params['PAYMENTREQUEST_0_SHIPPINGAMT'] = _format_currency(charge)
         params['PAYMENTREQUEST_0_AMT'] += charge
 
+    # Shipping is charged with the first payment, so that's where any
+    # shipping discount goes too
+    if shipping_discount:
+        charge = D(params['PAYMENTREQUEST_0_SHIPPINGAMT'])
+        discount = min(shipping_discount, charge)
+        params['PAYMENTREQUEST_0_SHIPPINGAMT'] = _format_currency(
+            charge - discount)
+        params['PAYMENTREQUEST_0_AMT'] -= discount
+
     # Both the old version (MAXAMT) and the new version (PAYMENT...) are needed
     # here - think it's a problem with the API.
-    params['PAYMENTREQUEST_0_MAXAMT'] = _format_currency(amount + max_charge)
+    params['PAYMENTREQUEST_0_MAXAMT'] = _format_currency(
+        payment_requests[0].amount + max_charge)
     params['MAXAMT'] = _format_currency(amount + max_charge)
 
     # Handling set to zero for now - I've never worked on a site that needed a
@@ -346,16 +622,12 @@ def set_txn(basket, shipping_methods, currency, return_url, cancel_url, update_u
     params['PAYMENTREQUEST_0_AMT'] = _format_currency(
         params['PAYMENTREQUEST_0_AMT'])
 
-    txn = _fetch_response(SET_EXPRESS_CHECKOUT, params)
+    txn = _fetch_response(SET_EXPRESS_CHECKOUT, params, basket_id=basket.id)
 
     # Construct return URL
-    if getattr(settings, 'PAYPAL_SANDBOX_MODE', True):
-        url = 'https://www.sandbox.paypal.com/webscr'
-    else:
-        url = 'https://www.paypal.com/webscr'
     params = (('cmd', '_express-checkout'),
               ('token', txn.token),)
-    return '%s?%s' % (url, urlencode(params))
+    return '%s?%s' % (config.redirect_url, urlencode(params))
 
 
 def get_txn(token):
@@ -366,22 +638,88 @@ def get_txn(token):
     return _fetch_response(GET_EXPRESS_CHECKOUT, {'TOKEN': token})
 
 
-def do_txn(payer_id, token, amount, currency, action=SALE):
+# One of the payments of a checkout, as returned by GetExpressCheckoutDetails
+Payment = namedtuple('Payment', 'amount currency seller request_id')
+
+
+def get_payments(txn):
+    """
+    Return the payments of a checkout from its GetExpressCheckoutDetails
+    transaction.  There is more than one for parallel payments.
+    """
+    payments = []
+    number = 0
+    while txn.value('PAYMENTREQUEST_%d_AMT' % number) is not None:
+        prefix = 'PAYMENTREQUEST_%d_' % number
+        payments.append(Payment(
+            amount=D(txn.value(prefix + 'AMT')),
+            currency=txn.value(prefix + 'CURRENCYCODE'),
+            seller=txn.value(prefix + 'SELLERPAYPALACCOUNTID'),
+            request_id=txn.value(prefix + 'PAYMENTREQUESTID')))
+        number += 1
+    return payments
+
+
+# One of the payments taken by DoExpressCheckoutPayment.  The pending reason
+# is 'authorization' or 'order' for payments that haven't been captured.
+PaymentInfo = namedtuple(
+    'PaymentInfo', 'transaction_id amount currency pending_reason')
+
+
+def get_payment_info(txn):
+    """
+    Return the payments taken by a DoExpressCheckoutPayment transaction.
+    There is more than one for parallel payments.  Payments that failed (and
+    so have no transaction ID) aren't included.
+    """
+    payments = []
+    number = 0
+    while txn.value('PAYMENTINFO_%d_AMT' % number) is not None:
+        prefix = 'PAYMENTINFO_%d_' % number
+        if txn.value(prefix + 'TRANSACTIONID'):
+            payments.append(PaymentInfo(
+                transaction_id=txn.value(prefix + 'TRANSACTIONID'),
+                amount=D(txn.value(prefix + 'AMT')),
+                currency=txn.value(prefix + 'CURRENCYCODE'),
+                pending_reason=txn.value(prefix + 'PENDINGREASON')))
+        number += 1
+    return payments
+
+
+def do_txn(payer_id, token, amount, currency, action=SALE, order_number=None,
+           payments=None, msg_sub_id=None):
     """
     DoExpressCheckoutPayment
+
+    :payments: The payments returned by ``get_payments`` for parallel
+               payments.  The amount and currency are ignored if passed.
+    :msg_sub_id: Idempotency key.  If a call is repeated with the same key,
+                 PayPal returns the response to the first call rather than
+                 taking payment again.
     """
     params = {
         'PAYERID': payer_id,
         'TOKEN': token,
-        'PAYMENTREQUEST_0_AMT': amount,
-        'PAYMENTREQUEST_0_CURRENCYCODE': currency,
-        'PAYMENTREQUEST_0_PAYMENTACTION': action,
     }
-    return _fetch_response(DO_EXPRESS_CHECKOUT, params)
+    if msg_sub_id:
+        params['MSGSUBID'] = msg_sub_id
+    if not payments:
+        payments = [Payment(amount, currency, None, None)]
+    for number, payment in enumerate(payments):
+        prefix = 'PAYMENTREQUEST_%d_' % number
+        params[prefix + 'AMT'] = payment.amount
+        params[prefix + 'CURRENCYCODE'] = payment.currency
+        params[prefix + 'PAYMENTACTION'] = action
+        if payment.seller:
+            params[prefix + 'SELLERPAYPALACCOUNTID'] = payment.seller
+        if payment.request_id:
+            params[prefix + 'PAYMENTREQUESTID'] = payment.request_id
+    return _fetch_response(DO_EXPRESS_CHECKOUT, params,
+                           order_number=order_number)
 
 
 def do_capture(txn_id, amount, currency, complete_type='Complete',
-               note=None):
+               note=None, commit=True):
     """
     Capture payment from a previous transaction
 
@@ -395,21 +733,77 @@ def do_capture(txn_id, amount, currency, complete_type='Complete',
     }
     if note:
         params['NOTE'] = note
-    return _fetch_response(DO_CAPTURE, params)
+    return _fetch_response(DO_CAPTURE, params, commit=commit)
 
 
-def do_void(txn_id, note=None):
+def do_void(txn_id, note=None, commit=True):
     params = {
         'AUTHORIZATIONID': txn_id,
     }
     if note:
         params['NOTE'] = note
-    return _fetch_response(DO_VOID, params)
+    return _fetch_response(DO_VOID, params, commit=commit)
+
+
+def do_reauthorization(txn_id, amount, currency, commit=True):
+    """
+    Reauthorize an authorization whose honor period has expired.
+
+    See https://developer.paypal.com/docs/classic/api/merchant/DoReauthorization_API_Operation_NVP/
+    """
+    params = {
+        'AUTHORIZATIONID': txn_id,
+        'AMT': amount,
+        'CURRENCYCODE': currency,
+    }
+    return _fetch_response(DO_REAUTHORIZATION, params, commit=commit)
+
+
+def get_authorization_chains(authorization_ids):
+    """
+    Return a dict mapping each authorization ID to the list of IDs of the
+    authorization and its reauthorizations, oldest first.
+
+    The ledger entry of a reauthorization has the ID of the authorization it
+    replaced, and its audit transaction has the new ID.
+    """
+    chains = dict((txn_id, [txn_id]) for txn_id in authorization_ids)
+    # Maps the IDs to look up to the original authorization IDs
+    pending = dict((txn_id, txn_id) for txn_id in chains)
+    while pending:
+        audit_ids = dict(LedgerEntry.objects.filter(
+            gateway=LedgerEntry.EXPRESS, operation=DO_REAUTHORIZATION,
+            is_successful=True, transaction_id__in=list(pending)).order_by(
+                'id').values_list('transaction_id', 'audit_id'))
+        new_ids = dict(models.ExpressTransaction.objects.filter(
+            pk__in=list(audit_ids.values()),
+            transaction_id__isnull=False).values_list('pk', 'transaction_id'))
+        found = {}
+        for txn_id, audit_id in audit_ids.items():
+            new_id = new_ids.get(audit_id)
+            chain = chains[pending[txn_id]]
+            if new_id and new_id not in chain:
+                chain.append(new_id)
+                found[new_id] = pending[txn_id]
+        # A reauthorization can itself be reauthorized
+        pending = found
+    return chains
+
+
+def get_latest_authorization_ids(authorization_ids):
+    """
+    Return a dict mapping each authorization ID to the ID of its most recent
+    reauthorization, or to itself if it hasn't been reauthorized.  Captures
+    and voids must be made against the latest ID.
+    """
+    return dict((txn_id, chain[-1]) for txn_id, chain in
+                get_authorization_chains(authorization_ids).items())
 
 
 FULL_REFUND = 'Full'
 PARTIAL_REFUND = 'Partial'
-def refund_txn(txn_id, is_partial=False, amount=None, currency=None):
+def refund_txn(txn_id, is_partial=False, amount=None, currency=None,
+               commit=True):
     params = {
         'TRANSACTIONID': txn_id,
         'REFUNDTYPE': PARTIAL_REFUND if is_partial else FULL_REFUND,
@@ -417,4 +811,77 @@ def refund_txn(txn_id, is_partial=False, amount=None, currency=None):
     if is_partial:
         params['AMT'] = amount
         params['CURRENCYCODE'] = currency
-    return _fetch_response(REFUND_TRANSACTION, params)
+    return _fetch_response(REFUND_TRANSACTION, params, commit=commit)
+
+
+# Result returned by TransactionSearch (timestamps are in UTC, as returned)
+SearchResult = namedtuple(
+    'SearchResult', 'transaction_id timestamp type status amount currency')
+
+# Error code returned when a search matched more than 100 transactions
+SEARCH_TRUNCATED = '11002'
+
+
+def _format_timestamp(dt):
+    if timezone.is_aware(dt):
+        dt = timezone.make_naive(dt, timezone.utc)
+    return dt.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def search_transactions(start, end):
+    """
+    Yield a ``SearchResult`` for each transaction PayPal has recorded between
+    two datetimes, most recent first.
+
+    TransactionSearch returns at most 100 results per call, so the search is
+    repeated with the end date moved back to the oldest result seen.  These
+    calls don't belong to a checkout so aren't saved as transactions.
+
+    See https://developer.paypal.com/docs/classic/api/merchant/TransactionSearch_API_Operation_NVP/
+    """
+    config = get_settings()
+    start = _format_timestamp(start)
+    end = _format_timestamp(end)
+    # IDs of the results at the end date, which are returned again when the
+    # search is repeated
+    seen = set()
+    while True:
+        params = dict(config.credentials, METHOD=TRANSACTION_SEARCH,
+                      STARTDATE=start, ENDDATE=end)
+        logger.debug("Searching transactions from %s to %s", start, end)
+        pairs = gateway.post(config.api_url, params)
+        if pairs['ACK'] not in (models.ExpressTransaction.SUCCESS,
+                                models.ExpressTransaction.SUCCESS_WITH_WARNING):
+            msg = "Error %s - %s" % (pairs.get('L_ERRORCODE0'),
+                                     pairs.get('L_LONGMESSAGE0'))
+            logger.error(msg)
+            raise exceptions.PayPalError(msg)
+
+        results = []
+        i = 0
+        while 'L_TRANSACTIONID%d' % i in pairs:
+            results.append(SearchResult(
+                transaction_id=pairs['L_TRANSACTIONID%d' % i],
+                timestamp=pairs.get('L_TIMESTAMP%d' % i),
+                type=pairs.get('L_TYPE%d' % i),
+                status=pairs.get('L_STATUS%d' % i),
+                amount=D(pairs.get('L_AMT%d' % i) or '0'),
+                currency=pairs.get('L_CURRENCYCODE%d' % i)))
+            i += 1
+        new = [r for r in results if r.transaction_id not in seen]
+        for result in new:
+            yield result
+
+        if pairs.get('L_ERRORCODE0') != SEARCH_TRUNCATED:
+            return
+        timestamps = set(r.timestamp for r in results)
+        if len(timestamps) < 2:
+            # Timestamps are to the second, so moving the end date back
+            # would return the same page again and the rest would be missed.
+            msg = ("More than %d transactions were made at %s, so they "
+                   "can't all be found" % (len(results),
+                                           min(timestamps or [end])))
+            logger.error(msg)
+            raise exceptions.PayPalError(msg)
+        end = min(timestamps)
+        seen = set(r.transaction_id for r in results if r.timestamp == end)
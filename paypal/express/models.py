@@ -1,5 +1,4 @@
 from __future__ import unicode_literals
-import re
 
 from django.db import models
 from django.utils.encoding import python_2_unicode_compatible
@@ -23,8 +22,14 @@ class ExpressTransaction(base.ResponseModel):
     SUCCESS, SUCCESS_WITH_WARNING, FAILURE = 'Success', 'SuccessWithWarning', 'Failure'
     ack = models.CharField(max_length=32)
 
-    correlation_id = models.CharField(max_length=32, null=True, blank=True)
-    token = models.CharField(max_length=32, null=True, blank=True)
+    correlation_id = models.CharField(max_length=32, null=True, blank=True,
+                                      db_index=True)
+    token = models.CharField(max_length=32, null=True, blank=True,
+                             db_index=True)
+    # PayPal's ID for the transaction this call created (the payment, capture
+    # or refund), which is what appears in PayPal's reports
+    transaction_id = models.CharField(max_length=32, null=True, blank=True,
+                                      db_index=True)
 
     error_code = models.CharField(max_length=32, null=True, blank=True)
     error_message = models.CharField(max_length=256, null=True, blank=True)
@@ -32,10 +37,9 @@ class ExpressTransaction(base.ResponseModel):
     class Meta:
         ordering = ('-date_created',)
         app_label = 'paypal'
-
-    def save(self, *args, **kwargs):
-        self.raw_request = re.sub(r'PWD=\d+&', 'PWD=XXXXXX&', self.raw_request)
-        return super(ExpressTransaction, self).save(*args, **kwargs)
+        # The indexes after the first are for the dashboard filters
+        index_together = [('method', 'date_created'), ('ack', 'date_created'),
+                          ('currency', 'amount')]
 
     @property
     def is_successful(self):
@@ -45,3 +49,62 @@ class ExpressTransaction(base.ResponseModel):
         return 'method: %s: token: %s' % (
             self.method, self.token)
 
+
+
+@python_2_unicode_compatible
+class PendingPayment(models.Model):
+    """
+    A DoExpressCheckoutPayment call that is being made in the background
+    (when PAYPAL_ASYNC_PAYMENT is enabled).  The order is placed once the
+    payment is complete.
+    """
+    PENDING, COMPLETE, FAILED, PLACED = (
+        'Pending', 'Complete', 'Failed', 'Placed')
+    STATUS_CHOICES = (
+        (PENDING, PENDING),
+        (COMPLETE, COMPLETE),
+        (FAILED, FAILED),
+        (PLACED, PLACED),
+    )
+    token = models.CharField(max_length=32, db_index=True)
+    payer_id = models.CharField(max_length=32)
+    basket_id = models.PositiveIntegerField()
+    order_number = models.CharField(max_length=128)
+    amount = models.DecimalField(max_digits=12, decimal_places=2)
+    currency = models.CharField(max_length=8)
+    status = models.CharField(max_length=16, choices=STATUS_CHOICES,
+                              default=PENDING)
+
+    # The DoExpressCheckoutPayment response
+    txn = models.ForeignKey(ExpressTransaction, null=True, blank=True,
+                            related_name='pending_payments')
+
+    date_created = models.DateTimeField(auto_now_add=True)
+    date_updated = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        ordering = ('-date_created',)
+        app_label = 'paypal'
+
+    def __str__(self):
+        return 'token: %s: %s' % (self.token, self.status)
+
+    def claim(self):
+        """
+        Mark a completed payment as being used to place the order.  Returns
+        False if another request has already claimed it.
+        """
+        updated = PendingPayment.objects.filter(
+            pk=self.pk, status=self.COMPLETE).update(status=self.PLACED)
+        if updated:
+            self.status = self.PLACED
+        return bool(updated)
+
+    def release(self):
+        """
+        Return a claimed payment to the completed state (eg if the order
+        couldn't be placed).
+        """
+        PendingPayment.objects.filter(
+            pk=self.pk, status=self.PLACED).update(status=self.COMPLETE)
+        self.status = self.COMPLETE
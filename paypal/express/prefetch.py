@@ -0,0 +1,67 @@
+"""
+Speculative fetching of Express checkout tokens.
+
+When PAYPAL_PREFETCH_TOKEN is enabled, the basket page can ask for a token in
+the background (see ``PrefetchTokenView``) so that clicking the PayPal button
+doesn't have to wait for SetExpressCheckout.  Prefetched URLs are keyed by the
+basket contents so any change to the basket invalidates them, and they are
+never kept for longer than PayPal's tokens remain valid.
+"""
+from __future__ import unicode_literals
+import hashlib
+
+from django.conf import settings
+from django.core.cache import cache
+
+from paypal.express import quotes
+
+# Express checkout tokens expire after 3 hours
+TOKEN_LIFETIME = 3 * 60 * 60
+
+
+def is_enabled():
+    return getattr(settings, 'PAYPAL_PREFETCH_TOKEN', False)
+
+
+def _get_timeout():
+    timeout = getattr(settings, 'PAYPAL_PREFETCH_TIMEOUT', 60 * 60)
+    return min(timeout, TOKEN_LIFETIME)
+
+
+def _get_key(basket):
+    # The total is included as well as the lines so that applying a voucher
+    # invalidates the prefetched token.
+    return 'paypal-express-prefetch-%s-%s-%s' % (
+        basket.id, quotes.get_basket_revision(basket), basket.total_incl_tax)
+
+
+def has_url(basket):
+    return _get_key(basket) in cache
+
+
+def set_url(basket, url):
+    cache.set(_get_key(basket), url, _get_timeout())
+
+
+def _get_claim_key(url):
+    return 'paypal-express-prefetch-claim-%s' % hashlib.md5(
+        url.encode('utf8')).hexdigest()
+
+
+def pop_url(basket):
+    """
+    Return the prefetched redirect URL for the basket (or None).  Each token
+    can only be used once so it is removed from the cache.
+
+    Reading and deleting the URL isn't atomic, so the URL is claimed with
+    ``cache.add`` first.  Only one request can claim it - any others get None
+    and fetch a new token.
+    """
+    key = _get_key(basket)
+    url = cache.get(key)
+    if url is None:
+        return None
+    if not cache.add(_get_claim_key(url), True, _get_timeout()):
+        return None
+    cache.delete(key)
+    return url
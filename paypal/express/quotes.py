@@ -0,0 +1,139 @@
+"""
+Caching of shipping quotes for PayPal's instant update callback.
+
+PayPal only waits PAYPAL_CALLBACK_TIMEOUT seconds for a response to the
+callback, so quotes are cached per basket revision and normalised address.
+For when there isn't time to calculate them, the latest quotes for each
+country are kept along with a quote for the default shipping method.  Quotes
+that were only partly calculated in time are kept too, so the next callback
+for the address only has to calculate the rest.
+"""
+from __future__ import unicode_literals
+import hashlib
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+from paypal.express import addresses
+
+
+def get_deadline(start_time=None):
+    """
+    Return the time by which a callback response must be ready.  We leave a
+    margin (PAYPAL_CALLBACK_MARGIN seconds) for rendering the response and
+    network latency.
+    """
+    if start_time is None:
+        start_time = time.time()
+    timeout = getattr(settings, 'PAYPAL_CALLBACK_TIMEOUT', 3)
+    margin = getattr(settings, 'PAYPAL_CALLBACK_MARGIN', 1)
+    return start_time + max(timeout - margin, 0)
+
+
+def get_basket_revision(basket):
+    """
+    Return a digest of the basket contents.  This changes whenever a line is
+    added, removed or changed.
+    """
+    lines = basket.lines.order_by('id').values_list(
+        'id', 'quantity', 'stockrecord_id', 'price_incl_tax')
+    content = '%s|%s' % (basket.owner_id, list(lines))
+    return hashlib.md5(content.encode('utf8')).hexdigest()
+
+
+def normalise_address(country_code=None, state=None, postcode=None,
+                      city=None):
+    """
+    Return a tuple of the address fields that shipping charges can depend on,
+    normalised so trivially different addresses share a cache entry.
+    """
+    return ((country_code or '').strip().upper(),
+            addresses.normalise_state(country_code, state).lower(),
+            addresses.normalise_postcode(postcode),
+            (city or '').strip().lower())
+
+
+def _get_timeout():
+    return getattr(settings, 'PAYPAL_CALLBACK_CACHE_TIMEOUT', 3600)
+
+
+def _get_quotes_key(basket_id, revision, address):
+    digest = hashlib.md5(('%s|%s' % (revision, '|'.join(address))).encode(
+        'utf8')).hexdigest()
+    return 'paypal-shipping-quotes-%s-%s' % (basket_id, digest)
+
+
+def _get_partial_key(basket_id, revision, address):
+    return _get_quotes_key(basket_id, revision, address).replace(
+        'paypal-shipping-quotes-', 'paypal-shipping-partial-', 1)
+
+
+def _get_default_key(basket_id, revision, country_code=''):
+    return 'paypal-shipping-default-%s-%s-%s' % (basket_id, revision,
+                                                  country_code)
+
+
+def get_quotes(basket_id, revision, address):
+    """
+    Return the cached list of (name, charge) quotes for the basket revision and
+    address, or None.
+    """
+    return cache.get(_get_quotes_key(basket_id, revision, address))
+
+
+def set_quotes(basket_id, revision, address, quotes):
+    cache.set_many({
+        _get_quotes_key(basket_id, revision, address): quotes,
+        # The latest complete set of quotes for the country also serves as
+        # the fallback for addresses in the same country that can't be
+        # quoted in time.
+        _get_default_key(basket_id, revision, address[0]): quotes,
+    }, _get_timeout())
+
+
+def get_partial_quotes(basket_id, revision, address):
+    """
+    Return the cached list of (name, charge) quotes for the shipping methods
+    that were quoted before a callback ran out of time, or None.
+    """
+    return cache.get(_get_partial_key(basket_id, revision, address))
+
+
+def set_partial_quotes(basket_id, revision, address, quotes):
+    cache.set(_get_partial_key(basket_id, revision, address), quotes,
+              _get_timeout())
+
+
+def merge_quotes(partial, default):
+    """
+    Return the partial quotes followed by the default quotes for the methods
+    that weren't quoted in time.
+    """
+    names = set(name for name, __ in partial)
+    return list(partial) + [(name, charge) for name, charge in default or []
+                            if name not in names]
+
+
+def get_default_quotes(basket_id, revision, address=None):
+    """
+    Return the quotes to fall back on when the address can't be quoted in
+    time.  These are the latest quotes for another address in the same
+    country or, failing that, the quotes set with ``set_default_quotes``.
+    """
+    keys = [_get_default_key(basket_id, revision)]
+    if address is not None and address[0]:
+        keys.insert(0, _get_default_key(basket_id, revision, address[0]))
+    found = cache.get_many(keys)
+    for key in keys:
+        if key in found:
+            return found[key]
+    return None
+
+
+def set_default_quotes(basket_id, revision, quotes):
+    """
+    Set the quotes to fall back on for any address, eg for the default
+    shipping method.
+    """
+    cache.set(_get_default_key(basket_id, revision), quotes, _get_timeout())
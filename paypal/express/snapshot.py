@@ -0,0 +1,111 @@
+"""
+Snapshots of priced baskets.
+
+The basket is frozen while the customer is on PayPal's site so the offers
+that apply to it can't change.  Rather than re-applying all offers each time
+the customer views the preview page or places the order, the discounts are
+recorded when the basket is frozen and restored when the customer returns.
+"""
+from __future__ import unicode_literals
+from collections import OrderedDict
+
+from django.core.cache import cache
+from oscar.core.loading import get_model
+
+from paypal.express import quotes
+from paypal.express.prefetch import TOKEN_LIFETIME
+
+ConditionalOffer = get_model('offer', 'ConditionalOffer')
+
+# The state that applying offers leaves on each basket line
+LINE_ATTRIBUTES = ('_discount_excl_tax', '_discount_incl_tax',
+                   '_affected_quantity')
+
+
+def _get_key(basket_id):
+    return 'paypal-express-basket-snapshot-%s' % basket_id
+
+
+def save(basket):
+    """
+    Record the lines, discounts and totals of a basket that has just been
+    frozen.
+    """
+    lines = {}
+    for line in basket.all_lines():
+        lines[line.id] = dict((attr, getattr(line, attr))
+                              for attr in LINE_ATTRIBUTES
+                              if hasattr(line, attr))
+    snapshot = {
+        'revision': quotes.get_basket_revision(basket),
+        'lines': lines,
+        'applications': list(basket.offer_applications.applications.items()),
+        'total_excl_tax': basket.total_excl_tax,
+        'total_incl_tax': basket.total_incl_tax,
+    }
+    # There's no point keeping the snapshot for longer than the token it
+    # was taken for.
+    cache.set(_get_key(basket.id), snapshot, TOKEN_LIFETIME)
+
+
+def restore(basket):
+    """
+    Apply the snapshotted discounts to a frozen basket.  Returns False if
+    there is no valid snapshot, in which case the offers need to be applied
+    as normal.
+
+    The snapshot is only used if the basket lines haven't changed, all the
+    offers and vouchers are still available to the basket's owner and the
+    restored basket has the same totals.
+    """
+    snapshot = cache.get(_get_key(basket.id))
+    if snapshot is None:
+        return False
+    if snapshot['revision'] != quotes.get_basket_revision(basket):
+        return False
+    if not _are_available(snapshot['applications'], basket):
+        return False
+
+    for line in basket.all_lines():
+        for attr, value in snapshot['lines'].get(line.id, {}).items():
+            setattr(line, attr, value)
+    basket.offer_applications.applications = OrderedDict(
+        snapshot['applications'])
+
+    if (basket.total_excl_tax != snapshot['total_excl_tax'] or
+            basket.total_incl_tax != snapshot['total_incl_tax']):
+        # Prices have changed - start again from a clean basket
+        basket.reset_offer_applications()
+        return False
+    return True
+
+
+def _are_available(applications, basket):
+    """
+    Test whether the offers and vouchers of the snapshot could still be
+    applied as many times as they were.  Other orders placed since the basket
+    was frozen may have used up an offer's or voucher's limits.
+    """
+    user = basket.owner
+    offers = ConditionalOffer.active.in_bulk(
+        [offer_id for offer_id, __ in applications])
+    vouchers = dict((voucher.pk, voucher)
+                    for voucher in basket.vouchers.all())
+    for offer_id, application in applications:
+        offer = offers.get(offer_id)
+        if offer is None or not offer.is_available(user=user):
+            return False
+        if application['freq'] > offer.get_max_applications(user):
+            return False
+        if application.get('voucher') is None:
+            continue
+        if user is None:
+            # Vouchers are only applied to baskets with an owner
+            return False
+        voucher = vouchers.get(application['voucher'].pk)
+        if voucher is None or not voucher.is_active():
+            return False
+        is_available, __ = voucher.is_available_to_user(user=user)
+        if not is_available:
+            return False
+    return True
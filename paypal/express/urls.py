@@ -7,6 +7,8 @@ from paypal.express import views
 urlpatterns = patterns('',
     # Views for normal flow that starts on the basket page
     url(r'^redirect/', views.RedirectView.as_view(), name='paypal-redirect'),
+    url(r'^prefetch/$', views.PrefetchTokenView.as_view(),
+        name='paypal-prefetch'),
     url(r'^preview/(?P<basket_id>\d+)/$',
         views.SuccessResponseView.as_view(preview=True),
         name='paypal-success-response'),
@@ -14,6 +16,8 @@ urlpatterns = patterns('',
         name='paypal-cancel-response'),
     url(r'^place-order/(?P<basket_id>\d+)/$', views.SuccessResponseView.as_view(),
         name='paypal-place-order'),
+    url(r'^payment-status/(?P<basket_id>\d+)/$',
+        views.PaymentStatusView.as_view(), name='paypal-payment-status'),
     # Callback for getting shipping options for a specific basket
     url(r'^shipping-options/(?P<basket_id>\d+)/',
         csrf_exempt(views.ShippingOptionsView.as_view()),
@@ -1,10 +1,12 @@
 from __future__ import unicode_literals
 from decimal import Decimal as D
 import logging
+import time
 
 from django.views.generic import RedirectView, View
 from django.conf import settings
-from django.http import HttpResponse
+from django.http import HttpResponse, Http404
+from django.template.response import TemplateResponse
 from django.shortcuts import get_object_or_404
 from django.contrib import messages
 from django.contrib.auth.models import AnonymousUser
@@ -19,12 +21,17 @@ from oscar.apps.payment.exceptions import UnableToTakePayment
 from oscar.core.loading import get_class, get_model
 from oscar.apps.shipping.methods import FixedPrice, NoShippingRequired
 
+from paypal.express import (
+    addresses, background, prefetch, quotes, snapshot)
 from paypal.express.facade import (
     get_paypal_url, fetch_transaction_details, confirm_transaction)
+from paypal.express.gateway import GET_EXPRESS_CHECKOUT
+from paypal.express.models import ExpressTransaction, PendingPayment
 from paypal.express.exceptions import (
     EmptyBasketException, MissingShippingAddressException,
     MissingShippingMethodException, InvalidBasket)
 from paypal.exceptions import PayPalError
+from paypal.payment import PaymentRecordingMixin, get_source_type
 
 # Load views dynamically
 PaymentDetailsView = get_class('checkout.views', 'PaymentDetailsView')
@@ -33,15 +40,27 @@ CheckoutSessionMixin = get_class('checkout.session', 'CheckoutSessionMixin')
 ShippingAddress = get_model('order', 'ShippingAddress')
 Country = get_model('address', 'Country')
 Basket = get_model('basket', 'Basket')
+Order = get_model('order', 'Order')
 Repository = get_class('shipping.repository', 'Repository')
 Applicator = get_class('offer.utils', 'Applicator')
 Selector = get_class('partner.strategy', 'Selector')
 Source = get_model('payment', 'Source')
-SourceType = get_model('payment', 'SourceType')
 
 logger = logging.getLogger('paypal.express')
 
 
+def _calculate_charge(method, basket):
+    if hasattr(method, 'set_basket'):
+        # Oscar < 0.8
+        method.set_basket(basket)
+        return method.charge_incl_tax
+    return method.calculate(basket).incl_tax
+
+
+def _is_late(deadline):
+    return deadline is not None and time.time() > deadline
+
+
 class RedirectView(CheckoutSessionMixin, RedirectView):
     """
     Initiate the transaction with Paypal and redirect the user
@@ -54,6 +73,10 @@ class RedirectView(CheckoutSessionMixin, RedirectView):
     # basket page but True when redirecting from checkout.
     as_payment_method = False
 
+    # Whether to use a token fetched in advance by PrefetchTokenView (when
+    # PAYPAL_PREFETCH_TOKEN is enabled)
+    use_prefetched_token = True
+
     def get_redirect_url(self, **kwargs):
         try:
             basket = self.request.basket
@@ -85,11 +108,29 @@ class RedirectView(CheckoutSessionMixin, RedirectView):
             # basket so it can't be edited while the customer is on the PayPal
             # site.
             basket.freeze()
+            # Keep the discounts so offers don't need to be re-applied when
+            # the customer returns from PayPal.
+            snapshot.save(basket)
 
             logger.info("Basket #%s - redirecting to %s", basket.id, url)
 
+            if getattr(self, 'shipping_methods', None):
+                self.cache_default_shipping_quotes(
+                    basket, self.shipping_methods)
+
             return url
 
+    def cache_default_shipping_quotes(self, basket, shipping_methods):
+        """
+        Store a quote for the default shipping method.  The instant update
+        callback falls back to this when it runs out of time.
+        """
+        method = shipping_methods[0]
+        default_quotes = [(six.text_type(method.name),
+                           _calculate_charge(method, basket))]
+        quotes.set_default_quotes(
+            basket.id, quotes.get_basket_revision(basket), default_quotes)
+
     def _get_redirect_url(self, basket, **kwargs):
         if basket.is_empty:
             raise EmptyBasketException()
@@ -120,6 +161,14 @@ class RedirectView(CheckoutSessionMixin, RedirectView):
             shipping_methods = Repository().get_shipping_methods(
                 user=user, basket=basket)
             params['shipping_methods'] = shipping_methods
+            self.shipping_methods = shipping_methods
+
+            if self.use_prefetched_token and prefetch.is_enabled():
+                url = prefetch.pop_url(basket)
+                if url is not None:
+                    logger.info("Basket #%s - using prefetched token",
+                                basket.id)
+                    return url
 
         if settings.DEBUG:
             # Determine the localserver's hostname to use when
@@ -140,6 +189,36 @@ class RedirectView(CheckoutSessionMixin, RedirectView):
         return {}
 
 
+class PrefetchTokenView(RedirectView):
+    """
+    Register the transaction with PayPal ahead of the customer clicking the
+    PayPal button on the basket page.
+
+    This is intended to be requested in the background once the basket page
+    has rendered.  The redirect URL is cached against the basket contents and
+    used by RedirectView if the basket hasn't changed in the meantime.
+    """
+    http_method_names = ['post']
+    use_prefetched_token = False
+
+    def post(self, request, *args, **kwargs):
+        if not prefetch.is_enabled():
+            raise Http404
+        basket = request.basket
+        if basket.is_empty or prefetch.has_url(basket):
+            return HttpResponse(status=204)
+        try:
+            url = self._get_redirect_url(basket, **kwargs)
+        except (PayPalError, InvalidBasket, EmptyBasketException) as e:
+            # Not a problem - the token will be fetched when the customer
+            # clicks the button.
+            logger.info("Basket #%s - unable to prefetch token: %s",
+                        basket.id, e)
+        else:
+            prefetch.set_url(basket, url)
+        return HttpResponse(status=204)
+
+
 class CancelResponseView(RedirectView):
     permanent = False
 
@@ -159,7 +238,7 @@ class CancelResponseView(RedirectView):
 # Upgrading notes: when we drop support for Oscar 0.6, this class can be
 # refactored to pass variables around more explicitly (instead of assigning
 # things to self so they are accessible in a later method).
-class SuccessResponseView(PaymentDetailsView):
+class SuccessResponseView(PaymentRecordingMixin, PaymentDetailsView):
     template_name_preview = 'paypal/express/preview.html'
     preview = True
 
@@ -224,8 +303,10 @@ class SuccessResponseView(PaymentDetailsView):
         if Selector:
             basket.strategy = Selector().strategy(self.request)
 
-        # Re-apply any offers
-        Applicator().apply(self.request, basket)
+        # Restore the discounts from when the basket was frozen, falling back
+        # to re-applying any offers
+        if not snapshot.restore(basket):
+            Applicator().apply(self.request, basket)
 
         return basket
 
@@ -249,8 +330,9 @@ class SuccessResponseView(PaymentDetailsView):
         """
         Place an order.
 
-        We fetch the txn details again and then proceed with oscar's standard
-        payment details view for placing the order.
+        We fetch the txn details again (normally from the cache populated by
+        the preview page) and then proceed with oscar's standard payment
+        details view for placing the order.
         """
         error_msg = _(
             "A problem occurred communicating with PayPal "
@@ -265,7 +347,9 @@ class SuccessResponseView(PaymentDetailsView):
             return HttpResponseRedirect(reverse('basket:summary'))
 
         try:
-            self.txn = fetch_transaction_details(self.token)
+            # Re-use the details fetched for the preview page if possible
+            self.txn = fetch_transaction_details(
+                self.token, payer_id=self.payer_id)
         except PayPalError:
             # Unable to fetch txn details from PayPal - we have to bail out
             messages.error(self.request, error_msg)
@@ -278,8 +362,36 @@ class SuccessResponseView(PaymentDetailsView):
             return HttpResponseRedirect(reverse('basket:summary'))
 
         submission = self.build_submission(basket=basket)
+        if background.is_enabled():
+            return self.defer_payment(basket, submission)
         return self.submit(**submission)
 
+    def defer_payment(self, basket, submission):
+        """
+        Hand the payment to a background worker and send the customer to the
+        status page.  The order is placed once the payment is complete.
+        """
+        order_number = self.checkout_session.get_order_number()
+        if order_number is None:
+            order_number = self.generate_order_number(basket)
+            self.checkout_session.set_order_number(order_number)
+
+        # A repeated submission (eg a double-click) uses the payment that
+        # is already under way rather than taking payment twice
+        payment = PendingPayment.objects.filter(
+            token=self.token, basket_id=basket.id).exclude(
+                status=PendingPayment.FAILED).first()
+        if payment is None:
+            payment = PendingPayment.objects.create(
+                token=self.token, payer_id=self.payer_id,
+                basket_id=basket.id, order_number=order_number,
+                amount=self.txn.amount, currency=self.txn.currency)
+            background.confirm_payment(payment)
+            logger.info("Order #%s: payment queued (token %s)",
+                        order_number, self.token)
+        return HttpResponseRedirect(get_status_url(basket.id, self.token,
+                                                   self.payer_id))
+
     def build_submission(self, **kwargs):
         submission = super(
             SuccessResponseView, self).build_submission(**kwargs)
@@ -302,19 +414,22 @@ class SuccessResponseView(PaymentDetailsView):
         Complete payment with PayPal - this calls the 'DoExpressCheckout'
         method to capture the money from the initial transaction.
         """
-        try:
-            confirm_txn = confirm_transaction(
-                kwargs['payer_id'], kwargs['token'], kwargs['txn'].amount,
-                kwargs['txn'].currency)
-        except PayPalError:
-            raise UnableToTakePayment()
+        if kwargs.get('payment'):
+            # Payment has already been taken in the background
+            confirm_txn = kwargs['payment'].txn
+        else:
+            try:
+                confirm_txn = confirm_transaction(
+                    kwargs['payer_id'], kwargs['token'], kwargs['txn'].amount,
+                    kwargs['txn'].currency, order_number=order_number,
+                    details=kwargs['txn'])
+            except PayPalError:
+                raise UnableToTakePayment()
         if not confirm_txn.is_successful:
             raise UnableToTakePayment()
 
         # Record payment source and event
-        source_type, is_created = SourceType.objects.get_or_create(
-            name='PayPal')
-        source = Source(source_type=source_type,
+        source = Source(source_type=get_source_type(),
                         currency=confirm_txn.currency,
                         amount_allocated=confirm_txn.amount,
                         amount_debited=confirm_txn.amount)
@@ -346,9 +461,17 @@ class SuccessResponseView(PaymentDetailsView):
             line4=self.txn.value('PAYMENTREQUEST_0_SHIPTOCITY', default=""),
             state=self.txn.value('PAYMENTREQUEST_0_SHIPTOSTATE', default=""),
             postcode=self.txn.value('PAYMENTREQUEST_0_SHIPTOZIP'),
-            country=Country.objects.get(iso_3166_1_a2=self.txn.value('PAYMENTREQUEST_0_SHIPTOCOUNTRYCODE'))
+            country=self.get_country(
+                self.txn.value('PAYMENTREQUEST_0_SHIPTOCOUNTRYCODE'))
         )
 
+    def get_country(self, code):
+        country = addresses.get_country(code)
+        if country is None:
+            raise Country.DoesNotExist(
+                "No country with code '%s'" % code)
+        return country
+
     def get_shipping_method(self, basket, shipping_address=None, **kwargs):
         """
         Return the shipping method used
@@ -374,19 +497,156 @@ class SuccessResponseView(PaymentDetailsView):
         return method
 
 
+def get_status_url(basket_id, token, payer_id):
+    url = reverse('paypal-payment-status', kwargs={'basket_id': basket_id})
+    return '%s?%s' % (url, urlencode({'token': token, 'PayerID': payer_id}))
+
+
+class PaymentStatusView(SuccessResponseView):
+    """
+    Show the progress of a payment that is being taken in the background, and
+    place the order once it is complete.
+
+    The page refreshes itself while the payment is pending.  This only needs
+    a single query so it is cheap to poll.
+    """
+    template_name = 'paypal/express/payment_status.html'
+    http_method_names = ['get']
+    refresh_interval = 2
+
+    def get(self, request, *args, **kwargs):
+        self.token = request.GET.get('token')
+        self.payer_id = request.GET.get('PayerID')
+        payments = list(PendingPayment.objects.filter(
+            basket_id=kwargs['basket_id'], token=self.token,
+            payer_id=self.payer_id).select_related('txn'))
+        if not payments:
+            messages.error(
+                self.request,
+                _("Unable to determine PayPal transaction details"))
+            return HttpResponseRedirect(reverse('basket:summary'))
+        # Earlier attempts may have failed, so show the latest one that
+        # hasn't
+        payment = next((p for p in payments
+                        if p.status != PendingPayment.FAILED), payments[0])
+
+        if payment.status == PendingPayment.PENDING:
+            background.recover(payment)
+            return TemplateResponse(request, self.template_name, {
+                'payment': payment,
+                'refresh_interval': self.refresh_interval})
+        if payment.status == PendingPayment.PLACED:
+            return HttpResponseRedirect(reverse('checkout:thank-you'))
+        if payment.status == PendingPayment.FAILED:
+            messages.error(
+                self.request,
+                _("A problem occurred while processing payment for this "
+                  "order - no payment has been taken.  Please "
+                  "contact customer services if this problem persists"))
+            url = reverse('paypal-success-response',
+                          kwargs={'basket_id': kwargs['basket_id']})
+            return HttpResponseRedirect('%s?%s' % (url, urlencode({
+                'token': self.token, 'PayerID': self.payer_id})))
+        return self.place_order(payment)
+
+    def place_order(self, payment):
+        """
+        Place the order for a completed payment.
+        """
+        # Use the details that were fetched for the preview page
+        try:
+            self.txn = ExpressTransaction.objects.without_request().filter(
+                token=payment.token, method=GET_EXPRESS_CHECKOUT)[0]
+        except IndexError:
+            self.txn = fetch_transaction_details(payment.token)
+        basket = self.load_frozen_basket(payment.basket_id)
+        if not basket:
+            messages.error(self.request, _("No basket was found that "
+                                           "corresponds to your PayPal "
+                                           "transaction"))
+            return HttpResponseRedirect(reverse('basket:summary'))
+
+        # Only one request may place the order
+        if not payment.claim():
+            return HttpResponseRedirect(get_status_url(
+                payment.basket_id, payment.token, payment.payer_id))
+        submission = self.build_submission(basket=basket)
+        submission['payment_kwargs']['payment'] = payment
+        response = self.submit(**submission)
+        if not Order.objects.filter(number=payment.order_number).exists():
+            # The order wasn't placed so allow another attempt
+            payment.release()
+        return response
+
+
 class ShippingOptionsView(View):
 
     def post(self, request, *args, **kwargs):
         """
         We use the shipping address given to use by PayPal to
         determine the available shipping method
+
+        PayPal only waits PAYPAL_CALLBACK_TIMEOUT seconds for a response so
+        quotes are cached per basket revision and address.  If some of the
+        quotes can't be calculated in time, the quotes for another address in
+        the same country, or for the default shipping method, are used for
+        the methods that weren't quoted.
         """
+        deadline = quotes.get_deadline()
+
         # Basket ID is passed within the URL path.  We need to do this as some
         # shipping options depend on the user and basket contents.  PayPal do
         # pass back details of the basket contents but it would be royal pain to
         # reconstitute the basket based on those - easier to just to piggy-back
         # the basket ID in the callback URL.
         basket = get_object_or_404(Basket, id=kwargs['basket_id'])
+
+        address = quotes.normalise_address(
+            country_code=self.request.POST.get(
+                'PAYMENTREQUEST_0_SHIPTOCOUNTRY', None),
+            state=self.request.POST.get('PAYMENTREQUEST_0_SHIPTOSTATE', None),
+            postcode=self.request.POST.get('PAYMENTREQUEST_0_SHIPTOZIP', None),
+            city=self.request.POST.get('PAYMENTREQUEST_0_SHIPTOCITY', None))
+        revision = quotes.get_basket_revision(basket)
+
+        shipping_quotes = quotes.get_quotes(basket.id, revision, address)
+        if shipping_quotes is None:
+            default_quotes = quotes.get_default_quotes(
+                basket.id, revision, address)
+            # Only give up on calculating the quotes if there is something to
+            # fall back on.
+            if default_quotes is None:
+                deadline = None
+            partial_quotes = quotes.get_partial_quotes(
+                basket.id, revision, address)
+            shipping_quotes, is_complete = self.calculate_quotes(
+                basket, deadline, dict(partial_quotes or []))
+            if is_complete:
+                quotes.set_quotes(basket.id, revision, address,
+                                  shipping_quotes)
+            else:
+                # Kept so the next callback only calculates the rest
+                quotes.set_partial_quotes(basket.id, revision, address,
+                                          shipping_quotes)
+                logger.warning(
+                    "Basket #%s - shipping callback deadline reached, "
+                    "returning default quotes for the methods that weren't "
+                    "quoted", basket.id)
+                shipping_quotes = quotes.merge_quotes(
+                    shipping_quotes, default_quotes)
+        return self.render_quotes(shipping_quotes)
+
+    def calculate_quotes(self, basket, deadline=None, known=None):
+        """
+        Return a list of (name, charge) tuples for the shipping methods
+        available for the address PayPal has sent, and whether all of them
+        were quoted.  If the deadline passes, the quotes calculated so far are
+        returned.
+
+        :known: Dict of the charges already calculated for some methods, by
+                name, eg by an earlier callback that ran out of time
+        """
+        known = known or {}
         user = basket.owner
         if not user:
             user = AnonymousUser()
@@ -394,10 +654,11 @@ class ShippingOptionsView(View):
         # Create a shipping address instance using the data passed back
         country_code = self.request.POST.get(
             'PAYMENTREQUEST_0_SHIPTOCOUNTRY', None)
-        try:
-            country = Country.objects.get(iso_3166_1_a2=country_code)
-        except Country.DoesNotExist:
+        country = addresses.get_country(country_code)
+        if country is None:
             country = Country()
+        if _is_late(deadline):
+            return [], False
 
         shipping_address = ShippingAddress(
             line1=self.request.POST.get('PAYMENTREQUEST_0_SHIPTOSTREET', None),
@@ -408,26 +669,32 @@ class ShippingOptionsView(View):
             country=country
         )
         methods = self.get_shipping_methods(user, basket, shipping_address)
-        return self.render_to_response(methods, basket)
+
+        shipping_quotes = []
+        for method in methods:
+            name = six.text_type(method.name)
+            if name in known:
+                shipping_quotes.append((name, known[name]))
+                continue
+            if _is_late(deadline):
+                return shipping_quotes, False
+            shipping_quotes.append((name, _calculate_charge(method, basket)))
+        return shipping_quotes, True
 
     def render_to_response(self, methods, basket):
+        shipping_quotes = [(six.text_type(method.name),
+                            _calculate_charge(method, basket))
+                           for method in methods]
+        return self.render_quotes(shipping_quotes)
+
+    def render_quotes(self, shipping_quotes):
         pairs = [
             ('METHOD', 'CallbackResponse'),
             ('CURRENCYCODE', self.request.POST.get('CURRENCYCODE', 'GBP')),
         ]
-        for index, method in enumerate(methods):
-            if hasattr(method, 'set_basket'):
-                # Oscar < 0.8
-                method.set_basket(basket)
-                charge = method.charge_incl_tax
-            else:
-                cost = method.calculate(basket)
-                charge = cost.incl_tax
-
-            pairs.append(('L_SHIPPINGOPTIONNAME%d' % index,
-                          six.text_type(method.name)))
-            pairs.append(('L_SHIPPINGOPTIONLABEL%d' % index,
-                          six.text_type(method.name)))
+        for index, (name, charge) in enumerate(shipping_quotes):
+            pairs.append(('L_SHIPPINGOPTIONNAME%d' % index, name))
+            pairs.append(('L_SHIPPINGOPTIONLABEL%d' % index, name))
             pairs.append(('L_SHIPPINGOPTIONAMOUNT%d' % index, charge))
             # For now, we assume tax and insurance to be zero
             pairs.append(('L_TAXAMT%d' % index, D('0.00')))
@@ -3,7 +3,57 @@ import time
 import urllib
 import urlparse
 
-from paypal import exceptions
+from django.utils import six
+
+from paypal import exceptions, ratelimit
+
+# Parameters (and headers) whose values must never end up in the audit trail.
+# Redaction works on the key-value pairs before they are encoded so there is
+# no need to scan the encoded payload later on.
+SENSITIVE_KEYS = frozenset([
+    'PWD', 'SIGNATURE', 'ACCT', 'CVV2', 'EXPDATE',
+    # Adaptive payments pass the credentials as headers
+    'X-PAYPAL-SECURITY-PASSWORD', 'X-PAYPAL-SECURITY-SIGNATURE',
+])
+MASK = 'XXXXXX'
+
+
+def redact(params):
+    """
+    Return a list of key-value pairs with any sensitive values masked.
+
+    Bankcard numbers keep their last 4 digits so that transactions can still
+    be matched up with customer queries.
+
+    :params: Dict or sequence of key-value pairs
+    """
+    if hasattr(params, 'items'):
+        params = params.items()
+    pairs = []
+    for key, value in params:
+        if key in SENSITIVE_KEYS and value:
+            if key == 'ACCT':
+                value = six.text_type(value)
+                value = 'X' * max(len(value) - 4, 0) + value[-4:]
+            else:
+                value = MASK
+        pairs.append((key, value))
+    return pairs
+
+
+def _get_rate_limit_key(url, params, headers):
+    """
+    Return the credentials and method of a call, which identify the rate
+    limit it falls under.
+    """
+    # Express uses USER, Payflow VENDOR and USER, and Adaptive a header
+    credentials = ':'.join([
+        params.get('VENDOR') or '', params.get('USER') or '',
+        headers.get('X-PAYPAL-SECURITY-USERID') or ''])
+    # Adaptive methods are part of the URL, eg .../AdaptivePayments/Pay
+    method = (params.get('METHOD') or params.get('TRXTYPE') or
+              url.rstrip('/').rsplit('/', 1)[-1])
+    return credentials, method
 
 
 def post(url, params, headers=None):
@@ -12,16 +62,19 @@ def post(url, params, headers=None):
     a set of key-value pairs.
 
     :url: URL to post to
-    :params: Dict of parameters to include in post payload
+    :params: Dict (or sequence of pairs) of parameters to include in post
+             payload
     :headers: Dict of headers
     """
     if headers is None:
         headers = {}
 
-    for k in params.keys():
-        if type(params[k]) == unicode:
-            params[k] = params[k].encode('utf-8')
-    payload = urllib.urlencode(params.items())
+    if hasattr(params, 'items'):
+        params = params.items()
+    ratelimit.acquire(*_get_rate_limit_key(url, dict(params), headers))
+    params = [(k, v.encode('utf-8') if isinstance(v, six.text_type) else v)
+              for k, v in params]
+    payload = urllib.urlencode(params)
 
     # Ensure correct headers are present
     if 'Content-type' not in headers:
@@ -39,9 +92,10 @@ def post(url, params, headers=None):
     for key, values in urlparse.parse_qs(response.content).items():
         pairs[key] = values[0]
 
-    # Add audit information
-    pairs['_raw_request'] = payload
+    # Add audit information.  The request is re-encoded from the redacted
+    # pairs so credentials and card details are never stored.
+    pairs['_raw_request'] = urllib.urlencode(redact(params))
     pairs['_raw_response'] = response.content
     pairs['_response_time'] = (time.time() - start_time) * 1000.0
 
-    return pairs
\ No newline at end of file
+    return pairs
@@ -0,0 +1,28 @@
+from django.contrib import admin
+
+from paypal.ledger import models
+
+
+class LedgerEntryAdmin(admin.ModelAdmin):
+    list_display = ['order_number', 'basket_id', 'gateway', 'operation',
+                    'amount', 'currency', 'status', 'reference',
+                    'transaction_id', 'date_created']
+    list_filter = ['gateway', 'is_successful']
+    search_fields = ['order_number', 'reference', 'transaction_id']
+    readonly_fields = [
+        'gateway',
+        'operation',
+        'order_number',
+        'basket_id',
+        'amount',
+        'currency',
+        'status',
+        'is_successful',
+        'reference',
+        'transaction_id',
+        'audit_id',
+        'date_created',
+    ]
+
+
+admin.site.register(models.LedgerEntry, LedgerEntryAdmin)
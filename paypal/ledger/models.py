@@ -0,0 +1,179 @@
+from __future__ import unicode_literals
+
+from django.db import models
+from django.db.models import Q
+from django.utils.encoding import python_2_unicode_compatible
+from django.utils.translation import ugettext_lazy as _
+
+
+class LedgerEntryManager(models.Manager):
+
+    def for_order(self, order_number):
+        return self.get_queryset().filter(order_number=order_number)
+
+    def record(self, gateway, operation, audit_txn, order_number=None,
+               basket_id=None, reference=None, transaction_id=None,
+               amount=None, currency=None, status=None, is_successful=False):
+        """
+        Record a call made to one of the PayPal gateways.
+
+        Calls made before the order is placed (eg GetExpressCheckoutDetails)
+        only have the checkout's reference.  They're linked to the order, with
+        one update, when the call that places it is recorded with the order
+        number.  Calls made afterwards by transaction ID alone (eg DoCapture)
+        copy the order from the most recent entry for that ID.
+        """
+        placed = order_number is not None
+        if order_number is None and not reference and transaction_id:
+            previous = self._get_previous(gateway, transaction_id)
+            if previous is not None:
+                order_number = previous.order_number
+                basket_id = basket_id or previous.basket_id
+                reference = previous.reference
+
+        entry = self.create(
+            gateway=gateway,
+            operation=operation,
+            audit_id=audit_txn.pk,
+            order_number=order_number,
+            basket_id=basket_id,
+            reference=reference,
+            transaction_id=transaction_id,
+            amount=amount,
+            currency=currency,
+            status=status,
+            is_successful=is_successful)
+
+        if placed and reference:
+            self.link_order(gateway, reference, order_number, basket_id)
+        return entry
+
+    def record_many(self, entries):
+        """
+        Record a batch of calls with one insert.  ``entries`` is a list of
+        dicts of the arguments to ``record``.  Entries are linked to their
+        order in the same way, with one query for the whole batch.
+        """
+        entries = [dict(entry) for entry in entries]
+        links = set(
+            (entry['gateway'], entry['reference'], entry['order_number'],
+             entry.get('basket_id')) for entry in entries
+            if entry.get('order_number') is not None and
+            entry.get('reference'))
+        unlinked = [entry for entry in entries
+                    if entry.get('order_number') is None and
+                    not entry.get('reference') and
+                    entry.get('transaction_id')]
+        previous = self._get_previous_entries(unlinked)
+        for entry in unlinked:
+            key = (entry['gateway'], entry['transaction_id'])
+            if key in previous:
+                order_number, basket_id, reference = previous[key]
+                entry.update(order_number=order_number,
+                             basket_id=entry.get('basket_id') or basket_id,
+                             reference=reference)
+
+        self.bulk_create([
+            self.model(audit_id=entry.pop('audit_txn').pk, **entry)
+            for entry in entries])
+
+        for gateway, reference, order_number, basket_id in links:
+            self.link_order(gateway, reference, order_number, basket_id)
+
+    def link_order(self, gateway, reference, order_number, basket_id=None):
+        """
+        Link the earlier entries for a checkout to an order.  The order number
+        is only known once the order is being placed.
+        """
+        links = {'order_number': order_number}
+        if basket_id is not None:
+            links['basket_id'] = basket_id
+        return self.get_queryset().filter(
+            gateway=gateway, reference=reference,
+            order_number__isnull=True).update(**links)
+
+    def _get_previous_entries(self, entries):
+        # Returns a dict mapping (gateway, transaction ID) to the (order
+        # number, basket ID, reference) of the latest entry with that
+        # transaction ID.
+        query = Q()
+        for gateway in set(entry['gateway'] for entry in entries):
+            txn_ids = set(entry['transaction_id'] for entry in entries
+                          if entry['gateway'] == gateway)
+            query |= Q(gateway=gateway, transaction_id__in=txn_ids)
+        if not query:
+            return {}
+        rows = self.get_queryset().filter(query).order_by('id').values_list(
+            'gateway', 'transaction_id', 'order_number', 'basket_id',
+            'reference')
+        return dict(((gateway, txn_id), (order_number, basket_id, reference))
+                    for gateway, txn_id, order_number, basket_id, reference
+                    in rows)
+
+    def _get_previous(self, gateway, transaction_id):
+        qs = self.get_queryset().filter(
+            gateway=gateway, transaction_id=transaction_id)
+        try:
+            return qs.order_by('-id')[0]
+        except IndexError:
+            return None
+
+
+@python_2_unicode_compatible
+class LedgerEntry(models.Model):
+    """
+    A single payment operation against one of the PayPal gateways.
+
+    The gateway-specific transaction models keep the full audit data; this
+    model links the operations to an order/basket so the payment state of an
+    order can be read with one query.
+    """
+    EXPRESS, PAYFLOW, ADAPTIVE = 'Express', 'Payflow', 'Adaptive'
+    GATEWAY_CHOICES = (
+        (EXPRESS, _("PayPal Express")),
+        (PAYFLOW, _("Payflow Pro")),
+        (ADAPTIVE, _("Adaptive Payments")),
+    )
+    gateway = models.CharField(_("Gateway"), max_length=16,
+                               choices=GATEWAY_CHOICES)
+    # The PayPal method (Express/Adaptive) or TRXTYPE (Payflow)
+    operation = models.CharField(_("Operation"), max_length=32)
+
+    order_number = models.CharField(_("Order number"), max_length=128,
+                                    null=True, blank=True)
+    basket_id = models.PositiveIntegerField(_("Basket ID"), null=True,
+                                            blank=True, db_index=True)
+
+    amount = models.DecimalField(max_digits=12, decimal_places=2, null=True,
+                                 blank=True)
+    currency = models.CharField(max_length=8, null=True, blank=True)
+
+    # ACK (Express/Adaptive) or RESULT (Payflow)
+    status = models.CharField(_("Status"), max_length=32, null=True,
+                              blank=True)
+    is_successful = models.BooleanField(default=False)
+
+    # The checkout-level key: Express token or Adaptive pay key
+    reference = models.CharField(_("Reference"), max_length=64, null=True,
+                                 blank=True, db_index=True)
+    # PayPal's ID for the transaction created or acted upon (eg the Express
+    # authorization ID or the Payflow PNREF)
+    transaction_id = models.CharField(_("Transaction ID"), max_length=64,
+                                      null=True, blank=True, db_index=True)
+
+    # Primary key of the gateway-specific transaction model
+    audit_id = models.PositiveIntegerField(null=True, blank=True)
+
+    date_created = models.DateTimeField(auto_now_add=True)
+
+    objects = LedgerEntryManager()
+
+    class Meta:
+        ordering = ('-date_created',)
+        app_label = 'paypal'
+        index_together = [('order_number', 'date_created')]
+        verbose_name_plural = _("Ledger entries")
+
+    def __str__(self):
+        return '%s %s: order %s' % (self.gateway, self.operation,
+                                    self.order_number)
@@ -0,0 +1,41 @@
+from __future__ import unicode_literals
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from paypal import refunds
+
+
+class Command(BaseCommand):
+    args = '<input file> <output file>'
+    help = ("Refund the payments listed in a CSV or NDJSON file of "
+            "(reference, amount, currency) records, where the reference is "
+            "an order number or Express token.  The results are written to "
+            "the output file as they complete.")
+    option_list = BaseCommand.option_list + (
+        make_option('--format', choices=(refunds.CSV, refunds.NDJSON),
+                    help="Format of the input and output files (by default "
+                         "this is determined from the input file name)"),
+        make_option('--workers', type='int',
+                    help="Number of concurrent requests"),
+        make_option('--rate', type='float',
+                    help="Maximum number of requests per second"),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 2:
+            raise CommandError("Please specify an input and output file")
+        input_name, output_name = args
+        format = options['format']
+        if format is None:
+            format = refunds.CSV
+            if input_name.endswith(('.ndjson', '.jsonl', '.json')):
+                format = refunds.NDJSON
+
+        with open(input_name) as infile:
+            with open(output_name, 'w') as outfile:
+                num_refunded, num_failed = refunds.refund_file(
+                    infile, outfile, format=format,
+                    workers=options['workers'], rate=options['rate'])
+        self.stdout.write("%d refunded, %d failed - see %s for details" % (
+            num_refunded, num_failed, output_name))
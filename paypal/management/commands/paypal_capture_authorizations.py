@@ -0,0 +1,67 @@
+from __future__ import unicode_literals
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from paypal.express.bulk import capture_authorizations
+
+
+def read_lines(filename):
+    with open(filename) as f:
+        for line in f:
+            line = line.strip()
+            if line:
+                yield line
+
+
+class Command(BaseCommand):
+    args = '<token token ...>'
+    help = ("Capture the PayPal Express authorizations for the given tokens "
+            "(or order numbers).  Authorizations that have already been "
+            "captured are skipped so the command can be safely re-run.")
+    option_list = BaseCommand.option_list + (
+        make_option('--orders', action='store_true', default=False,
+                    help="Treat the arguments as order numbers"),
+        make_option('--file', dest='filename',
+                    help="Read the tokens (or order numbers) from a file, "
+                         "one per line"),
+        make_option('--workers', type='int',
+                    help="Number of concurrent requests"),
+        make_option('--rate', type='float',
+                    help="Maximum number of requests per second"),
+        make_option('--note', help="Note to send with each capture"),
+    )
+
+    def handle(self, *args, **options):
+        if options['filename']:
+            references = read_lines(options['filename'])
+        elif args:
+            references = args
+        else:
+            raise CommandError("Please specify some tokens or a file")
+
+        kwargs = {'note': options['note'],
+                  'workers': options['workers'],
+                  'rate': options['rate']}
+        if options['orders']:
+            kwargs['order_numbers'] = references
+        else:
+            kwargs['tokens'] = references
+
+        num_captured = num_skipped = num_failed = 0
+        for result in capture_authorizations(**kwargs):
+            authorization = result.item
+            reference = authorization.order_number or authorization.token
+            if result.error:
+                num_failed += 1
+                self.stderr.write("%s: %s" % (reference, result.error))
+            elif result.result is None:
+                num_skipped += 1
+                self.stdout.write("%s: already captured" % reference)
+            else:
+                num_captured += 1
+                self.stdout.write("%s: captured %s %s" % (
+                    reference, authorization.amount,
+                    authorization.currency))
+        self.stdout.write("%d captured, %d already captured, %d failed" % (
+            num_captured, num_skipped, num_failed))
@@ -0,0 +1,49 @@
+from __future__ import unicode_literals
+import datetime
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from paypal.payflow import settlement
+
+
+class Command(BaseCommand):
+    args = '<order_number order_number ...>'
+    help = ("Capture the Payflow authorizations that haven't been captured or "
+            "voided yet (for the given orders, or all of them).  Authorizations "
+            "that have already been captured are skipped so the command can "
+            "be safely re-run.")
+    option_list = BaseCommand.option_list + (
+        make_option('--days', type='int',
+                    help="Only capture authorizations at least this many "
+                         "days old"),
+        make_option('--workers', type='int',
+                    help="Number of concurrent requests"),
+        make_option('--rate', type='float',
+                    help="Maximum number of requests per second"),
+        make_option('--retries', type='int', default=settlement.RETRIES,
+                    help="Number of times to retry calls that fail to reach "
+                         "PayPal"),
+    )
+
+    def handle(self, *args, **options):
+        before = None
+        if options['days'] is not None:
+            before = timezone.now() - datetime.timedelta(days=options['days'])
+
+        summary = settlement.Summary()
+        results = settlement.settle(
+            order_numbers=args or None, before=before,
+            workers=options['workers'], rate=options['rate'],
+            retries=options['retries'])
+        for result in results:
+            summary.add(result)
+            authorization = result.item
+            if result.error:
+                self.stderr.write("Order %s: %s" % (
+                    authorization.order_number, result.error))
+            else:
+                self.stdout.write("Order %s: captured %s" % (
+                    authorization.order_number, authorization.amount))
+        self.stdout.write(summary.report())
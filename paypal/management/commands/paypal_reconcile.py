@@ -0,0 +1,87 @@
+from __future__ import unicode_literals
+import datetime
+from collections import defaultdict
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from paypal import reconciliation
+
+EXPRESS, PAYFLOW = 'express', 'payflow'
+STL, CSV = 'stl', 'csv'
+
+
+def parse_date(value):
+    try:
+        date = datetime.datetime.strptime(value, '%Y-%m-%d')
+    except ValueError:
+        raise CommandError("Dates must be in YYYY-MM-DD format")
+    return timezone.make_aware(date, timezone.utc)
+
+
+class Command(BaseCommand):
+    args = '<start-date> <end-date>'
+    help = ("Compare the transactions recorded between two dates (YYYY-MM-DD, "
+            "end date exclusive) with what PayPal settled, using "
+            "TransactionSearch or a settlement report file.")
+    option_list = BaseCommand.option_list + (
+        make_option('--gateway', choices=(EXPRESS, PAYFLOW), default=EXPRESS,
+                    help="Which transactions to reconcile"),
+        make_option('--file', dest='filename',
+                    help="Settlement file to reconcile against instead of "
+                         "TransactionSearch (required for Payflow)"),
+        make_option('--format', choices=(STL, CSV), default=STL,
+                    help="Format of the settlement file: a PayPal settlement "
+                         "report or a CSV file with a "
+                         "transaction_id,amount,currency header"),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 2:
+            raise CommandError("Please specify a start and end date")
+        start, end = parse_date(args[0]), parse_date(args[1])
+
+        if options['gateway'] == PAYFLOW:
+            if not options['filename']:
+                raise CommandError("Payflow reconciliation needs a --file")
+            local = reconciliation.payflow_entries(start, end)
+        else:
+            local = reconciliation.express_entries(start, end)
+
+        f = None
+        if options['filename']:
+            f = open(options['filename'])
+            if options['format'] == CSV:
+                paypal = reconciliation.read_csv(f)
+            else:
+                paypal = reconciliation.read_settlement_report(f)
+        else:
+            paypal = reconciliation.search_entries(start, end)
+
+        counts = defaultdict(int)
+        try:
+            discrepancies = reconciliation.reconcile(
+                local, reconciliation.sort_entries(paypal))
+            for discrepancy in discrepancies:
+                counts[discrepancy.kind] += 1
+                self.stdout.write("%s %s: local %s, PayPal %s" % (
+                    discrepancy.transaction_id, discrepancy.kind,
+                    self.format_entries(discrepancy.local),
+                    self.format_entries(discrepancy.paypal)))
+        finally:
+            if f is not None:
+                f.close()
+
+        if counts:
+            self.stdout.write(", ".join(
+                "%d %s" % (count, kind.replace('_', ' '))
+                for kind, count in sorted(counts.items())))
+        else:
+            self.stdout.write("No discrepancies found")
+
+    def format_entries(self, entries):
+        if not entries:
+            return "-"
+        return ", ".join("%s %s" % (entry.amount, entry.currency or '')
+                         for entry in entries).strip()
@@ -0,0 +1,45 @@
+from __future__ import unicode_literals
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from paypal import authorizations
+
+
+class Command(BaseCommand):
+    help = ("Void (or reauthorize) Express and Payflow authorizations that "
+            "haven't been captured and are about to expire.  Intended to be "
+            "run daily.")
+    option_list = BaseCommand.option_list + (
+        make_option('--policy',
+                    choices=(authorizations.VOID, authorizations.REAUTHORIZE),
+                    help="What to do with stale authorizations (defaults to "
+                         "PAYPAL_AUTHORIZATION_POLICY)"),
+        make_option('--days', type='int', default=3,
+                    help="Minimum age in days of authorizations to sweep"),
+        make_option('--max-days', type='int', default=29,
+                    help="Maximum age in days of authorizations to sweep"),
+        make_option('--workers', type='int',
+                    help="Number of concurrent requests"),
+        make_option('--rate', type='float',
+                    help="Maximum number of requests per second"),
+    )
+
+    def handle(self, *args, **options):
+        num_swept = num_failed = 0
+        results = authorizations.sweep(
+            policy=options['policy'], days=options['days'],
+            max_days=options['max_days'], workers=options['workers'],
+            rate=options['rate'])
+        for result in results:
+            hold = result.item
+            reference = '%s %s (order %s)' % (
+                hold.gateway, hold.transaction_id, hold.order_number)
+            if result.error:
+                num_failed += 1
+                self.stderr.write("%s: %s" % (reference, result.error))
+            else:
+                num_swept += 1
+                self.stdout.write("%s: done" % reference)
+        self.stdout.write("%d authorizations swept, %d failed" % (
+            num_swept, num_failed))
@@ -1,3 +1,4 @@
 from paypal.express.models import *
 from paypal.payflow.models import *
-from paypal.adaptive.models import *
\ No newline at end of file
+from paypal.adaptive.models import *
+from paypal.ledger.models import *
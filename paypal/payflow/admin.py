@@ -1,8 +1,16 @@
 from django.contrib import admin
+from django.contrib.admin.views.main import ChangeList
 
 from paypal.payflow import models
 
 
+class TxnChangeList(ChangeList):
+
+    def get_queryset(self, request):
+        # The raw audit data isn't shown in the list so don't load it
+        return super(TxnChangeList, self).get_queryset(request).summary()
+
+
 class TxnAdmin(admin.ModelAdmin):
     list_display = ['pnref', 'comment1', 'amount', 'get_trxtype_display',
                     'get_tender_display', 'result', 'respmsg', 'date_created']
@@ -28,5 +36,8 @@ class TxnAdmin(admin.ModelAdmin):
         'date_created',
     ]
 
+    def get_changelist(self, request, **kwargs):
+        return TxnChangeList
+
 
 admin.site.register(models.PayflowTransaction, TxnAdmin)
@@ -0,0 +1,286 @@
+"""
+Capturing Payflow authorizations in several parts, eg for split shipments.
+
+Only one DELAYED_CAPTURE can be made against an authorization, so any later
+captures are made as reference SALE transactions using the authorization's
+PNREF.  The planner picks the right one for each capture and checks that it
+doesn't exceed what is left of the authorization.
+
+The authorized and captured amounts for each order are kept in
+``CaptureBalance``.  A balance is built from the order's history the first
+time it's needed and is then updated as the gateway saves the order's
+transactions.  The amount of each capture is reserved on the (locked) balance
+before PayPal is called, so two processes can't capture more than was
+authorized between them.
+"""
+from __future__ import unicode_literals
+import datetime
+import logging
+from collections import namedtuple
+
+from django.db import IntegrityError, transaction
+from django.db.models import F
+from django.utils import timezone
+
+from paypal import bulk
+from paypal.exceptions import PayPalError
+from paypal.payflow import codes, gateway
+from paypal.payflow.models import CaptureBalance, PayflowTransaction
+
+logger = logging.getLogger('paypal.payflow')
+
+APPROVED = ('0', '126')
+
+# Number of results saved per database transaction
+FLUSH_SIZE = 50
+
+# How long a balance's reservations are kept without any activity.  Calls to
+# PayPal take seconds, so older ones belong to a run that was interrupted
+# before it could save its results.
+RESERVATION_TIMEOUT = datetime.timedelta(minutes=15)
+
+# A capture to make.  trxtype is DELAYED_CAPTURE for the first capture of an
+# authorization and SALE for the rest.
+Capture = namedtuple('Capture', 'order_number amount trxtype pnref')
+
+
+def _build_balances(order_numbers):
+    """
+    Return new balances for the orders that have been authorized, built from
+    their transactions with one query.
+    """
+    txns = PayflowTransaction.objects.filter(
+        comment1__in=order_numbers, result__in=APPROVED).order_by(
+            'date_created', 'pk').values_list(
+                'comment1', 'trxtype', 'pnref', 'amount')
+    balances = {}
+    for order_number, trxtype, pnref, amount in txns:
+        balance = balances.get(order_number)
+        if trxtype == codes.AUTHORIZATION:
+            # A new authorization (eg a reauthorization) replaces the old one
+            balances[order_number] = CaptureBalance(
+                order_number=order_number, pnref=pnref,
+                authorized=amount or 0)
+        elif balance is None:
+            # Sales and credits for orders that weren't authorized
+            continue
+        elif trxtype in (codes.DELAYED_CAPTURE, codes.SALE):
+            balance.captured += amount or 0
+            balance.num_captures += 1
+        elif trxtype == codes.VOID:
+            # Nothing more can be captured
+            balance.authorized = balance.captured
+    return list(balances.values())
+
+
+def _create_balances(order_numbers):
+    new_balances = _build_balances(order_numbers)
+    try:
+        with transaction.atomic():
+            CaptureBalance.objects.bulk_create(new_balances)
+    except IntegrityError:
+        # Another process has created some of them in the meantime, so
+        # create the rest one at a time.
+        for balance in new_balances:
+            try:
+                with transaction.atomic():
+                    balance.save()
+            except IntegrityError:
+                pass
+
+
+def get_balances(order_numbers, lock=False):
+    """
+    Return a dict of the ``CaptureBalance`` for each of the given orders that
+    has been authorized.  Missing balances are built from the orders'
+    transactions.
+
+    :lock: Whether to lock the balances until the end of the database
+           transaction.  Only use this inside ``transaction.atomic``.
+    """
+    def fetch(order_numbers):
+        qs = CaptureBalance.objects.filter(order_number__in=order_numbers)
+        if lock:
+            qs = qs.select_for_update()
+        return dict((balance.order_number, balance) for balance in qs)
+
+    order_numbers = set(order_numbers)
+    balances = fetch(order_numbers)
+    missing = order_numbers - set(balances)
+    if missing:
+        _create_balances(missing)
+        balances.update(fetch(missing))
+    return balances
+
+
+def plan(captures, balances):
+    """
+    Return the ``Capture`` for each (order number, amount) pair that can be
+    made now, a list of the (pair, error) for those that can't be made and a
+    list of the pairs that have to wait for an order's first capture.
+
+    An order's first capture is a DELAYED_CAPTURE and its later ones are
+    reference sales.  The sales aren't made until the DELAYED_CAPTURE has
+    completed, as it may be declined.
+
+    :balances: The orders' balances, as returned by ``get_balances``
+    """
+    remaining, num_captures = {}, {}
+    for order_number, balance in balances.items():
+        remaining[order_number] = balance.remaining
+        num_captures[order_number] = balance.num_captures
+
+    planned, errors, deferred = [], [], []
+    for order_number, amount in captures:
+        balance = balances.get(order_number)
+        if balance is None:
+            errors.append(((order_number, amount), PayPalError(
+                "No authorization found for order %s" % order_number)))
+            continue
+        if num_captures[order_number] == 0 and balance.num_reserved:
+            errors.append(((order_number, amount), PayPalError(
+                "The first capture for order %s is still in progress" %
+                order_number)))
+            continue
+        if amount > remaining[order_number]:
+            errors.append(((order_number, amount), PayPalError(
+                "Order %s only has %s left to capture" % (
+                    order_number, remaining[order_number]))))
+            continue
+        if num_captures[order_number] == 0:
+            planned.append(Capture(order_number, amount,
+                                   codes.DELAYED_CAPTURE, balance.pnref))
+            # Nothing else is planned for the order until this completes
+            num_captures[order_number] = None
+        elif num_captures[order_number] is None:
+            deferred.append((order_number, amount))
+            continue
+        else:
+            planned.append(Capture(order_number, amount, codes.SALE,
+                                   balance.pnref))
+        remaining[order_number] -= amount
+    return planned, errors, deferred
+
+
+def _expire_reservations(balances):
+    """
+    Clear the reservations of balances that haven't been updated for
+    RESERVATION_TIMEOUT, and rebuild their totals from the transactions that
+    were saved.  Only call this with the balances locked.
+    """
+    cutoff = timezone.now() - RESERVATION_TIMEOUT
+    expired = [balance for balance in balances.values()
+               if balance.num_reserved and balance.date_updated < cutoff]
+    if not expired:
+        return
+    logger.warning(
+        "Releasing expired capture reservations for orders %s",
+        ", ".join(sorted(balance.order_number for balance in expired)))
+    rebuilt = dict((balance.order_number, balance) for balance in
+                   _build_balances([b.order_number for b in expired]))
+    for balance in expired:
+        history = rebuilt.get(balance.order_number)
+        if history is not None:
+            balance.pnref = history.pnref
+            balance.authorized = history.authorized
+            balance.captured = history.captured
+            balance.num_captures = history.num_captures
+        balance.reserved = 0
+        balance.num_reserved = 0
+        balance.save()
+
+
+def _reserve(captures):
+    """
+    Plan the captures and reserve their amounts on the orders' balances.
+    """
+    with transaction.atomic():
+        balances = get_balances(
+            set(order_number for order_number, amount in captures),
+            lock=True)
+        _expire_reservations(balances)
+        planned, errors, deferred = plan(captures, balances)
+        for capture in planned:
+            balance = balances[capture.order_number]
+            balance.reserved += capture.amount
+            balance.num_reserved += 1
+        for order_number in set(capture.order_number for capture in planned):
+            balances[order_number].save()
+    return planned, errors, deferred
+
+
+def _release(captures):
+    for capture in captures:
+        CaptureBalance.objects.filter(
+            order_number=capture.order_number).update(
+                reserved=F('reserved') - capture.amount,
+                num_reserved=F('num_reserved') - 1,
+                date_updated=timezone.now())
+
+
+def _make_capture(capture):
+    # Called from a worker thread so mustn't touch the database
+    if capture.trxtype == codes.DELAYED_CAPTURE:
+        return gateway.delayed_capture(
+            capture.order_number, capture.pnref, capture.amount, commit=False)
+    return gateway.reference_transaction(
+        capture.order_number, capture.pnref, capture.amount, commit=False)
+
+
+def capture(captures, workers=None, rate=None):
+    """
+    Make partial captures for many orders concurrently and yield a
+    ``bulk.Result`` for each as it completes.  The item of each result is the
+    ``Capture`` made, or the (order number, amount) pair if it couldn't be
+    planned.
+
+    An order's first capture is made on its own, and its later captures once
+    it has completed.
+
+    :captures: Iterable of (order number, amount) pairs.  An order can appear
+               more than once.
+    """
+    captures = list(captures)
+    # Captures that have been reserved but haven't completed
+    in_flight = []
+    pending = []
+
+    def flush():
+        if not pending:
+            return
+        with transaction.atomic():
+            # Saving the transactions updates the balances, so the amounts
+            # are released in the same database transaction.
+            gateway.save_transactions(
+                [result.result for result in pending
+                 if result.result is not None])
+            _release(result.item for result in pending)
+        del pending[:]
+
+    try:
+        while captures:
+            planned, errors, captures = _reserve(captures)
+            for item, error in errors:
+                yield bulk.Result(item, None, error)
+            in_flight.extend(planned)
+            results = bulk.run_concurrently(
+                _make_capture, planned, workers=workers, rate=rate)
+            for result in results:
+                result = bulk.check(result)
+                in_flight.remove(result.item)
+                pending.append(result)
+                if len(pending) >= FLUSH_SIZE:
+                    flush()
+                yield result
+            # Deferred captures are planned against the updated balances
+            flush()
+    finally:
+        # Save whatever has been captured, even if the run is interrupted
+        flush()
+        if in_flight:
+            # These may have reached PayPal, so their amounts stay reserved
+            # until the reservations expire.
+            logger.warning(
+                "Captures interrupted for orders %s; their amounts are "
+                "reserved until the reservations expire",
+                ", ".join(sorted(set(c.order_number for c in in_flight))))
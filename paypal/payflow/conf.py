@@ -0,0 +1,65 @@
+"""
+Snapshot of the PAYPAL_PAYFLOW_* settings.
+
+As with ``paypal.express.conf``, the settings are read and validated once per
+process rather than for every transaction, and the snapshot is rebuilt if a
+PAYPAL_* setting is changed (eg by ``override_settings`` in tests).
+"""
+from __future__ import unicode_literals
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+try:
+    from django.core.signals import setting_changed
+except ImportError:
+    # Django < 1.8
+    from django.test.signals import setting_changed
+
+
+class PayflowSettings(object):
+
+    def __init__(self):
+        # At a minimum, we require a vendor ID and a password.
+        for setting in ('PAYPAL_PAYFLOW_VENDOR_ID',
+                        'PAYPAL_PAYFLOW_PASSWORD'):
+            if not hasattr(settings, setting):
+                raise ImproperlyConfigured(
+                    "You must define a %s setting" % setting)
+
+        # Included in every request
+        self.credentials = {
+            'VENDOR': settings.PAYPAL_PAYFLOW_VENDOR_ID,
+            'PWD': settings.PAYPAL_PAYFLOW_PASSWORD,
+            'USER': getattr(settings, 'PAYPAL_PAYFLOW_USER',
+                            settings.PAYPAL_PAYFLOW_VENDOR_ID),
+            'PARTNER': getattr(settings, 'PAYPAL_PAYFLOW_PARTNER', 'PayPal'),
+        }
+
+        if getattr(settings, 'PAYPAL_PAYFLOW_PRODUCTION_MODE', False):
+            self.url = 'https://payflowpro.paypal.com'
+        else:
+            self.url = 'https://pilot-payflowpro.paypal.com'
+
+        self.currency = getattr(settings, 'PAYPAL_PAYFLOW_CURRENCY', 'USD')
+
+
+_settings = None
+
+
+def get_settings():
+    global _settings
+    if _settings is None:
+        _settings = PayflowSettings()
+    return _settings
+
+
+def is_configured():
+    return hasattr(settings, 'PAYPAL_PAYFLOW_VENDOR_ID')
+
+
+def reset(**kwargs):
+    global _settings
+    if kwargs.get('setting', '').startswith('PAYPAL_'):
+        _settings = None
+
+setting_changed.connect(reset)
@@ -0,0 +1,28 @@
+from __future__ import unicode_literals
+
+from django import forms
+from django.utils.translation import ugettext_lazy as _
+
+from paypal.dashboard import TransactionSearchForm
+from paypal.payflow import codes
+
+TRXTYPE_CHOICES = [('', _("All"))] + sorted(
+    (trxtype, _(label)) for trxtype, label in codes.trxtype_map.items())
+
+
+class PayflowTransactionSearchForm(TransactionSearchForm):
+    trxtype = forms.ChoiceField(label=_("Transaction type"),
+                                choices=TRXTYPE_CHOICES, required=False)
+    result = forms.CharField(label=_("Response code"), max_length=32,
+                             required=False)
+
+    search_fields = ('comment1', 'pnref', 'ppref')
+
+    def filter(self, queryset):
+        queryset = super(PayflowTransactionSearchForm, self).filter(queryset)
+        data = self.cleaned_data
+        if data['trxtype']:
+            queryset = queryset.filter(trxtype=data['trxtype'])
+        if data['result']:
+            queryset = queryset.filter(result=data['result'])
+        return queryset
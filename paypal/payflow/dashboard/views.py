@@ -6,14 +6,16 @@ from django.conf import settings
 from django import http
 from django.utils.translation import ugettext as _
 
+from paypal import dashboard
 from paypal.payflow import models
 from paypal.payflow import facade
+from paypal.payflow.dashboard.forms import PayflowTransactionSearchForm
 
 
-class TransactionListView(generic.ListView):
+class TransactionListView(dashboard.TransactionListView):
     model = models.PayflowTransaction
     template_name = 'paypal/payflow/transaction_list.html'
-    context_object_name = 'transactions'
+    form_class = PayflowTransactionSearchForm
 
 
 class TransactionDetailView(generic.DetailView):
@@ -45,7 +47,11 @@ class TransactionDetailView(generic.DetailView):
 
     def capture(self, orig_txn):
         try:
-            txn = facade.delayed_capture(orig_txn.comment1)
+            # The authorization being viewed is captured, rather than the
+            # order's latest one
+            txn = facade.delayed_capture(
+                orig_txn.comment1,
+                orig_txn.pnref if orig_txn.can_be_captured else None)
         except Exception as e:
             messages.error(
                 self.request, _("Unable to settle transaction - %s") % e)
@@ -59,7 +65,9 @@ class TransactionDetailView(generic.DetailView):
 
     def credit(self, orig_txn):
         try:
-            txn = facade.credit(orig_txn.comment1)
+            txn = facade.credit(
+                orig_txn.comment1,
+                orig_txn.pnref if orig_txn.can_be_credited else None)
         except Exception as e:
             messages.error(self.request, _("Unable to credit transaction - %s") % e)
             return http.HttpResponseRedirect(reverse('paypal-payflow-detail',
@@ -2,9 +2,10 @@
 Bridging module between Oscar and the gateway module (which is Oscar agnostic)
 """
 from __future__ import unicode_literals
+from django.utils import six
 from oscar.apps.payment import exceptions
 
-from paypal.payflow import gateway, models, codes
+from paypal.payflow import captures, gateway, models, codes
 
 
 def authorize(order_number, amt, bankcard, billing_address=None):
@@ -100,13 +101,12 @@ def delayed_capture(order_number, pnref=None, amt=None):
     if pnref is None:
         # No PNREF specified, look-up the auth transaction for this order number
         # to get the PNREF from there.
-        try:
-            auth_txn = models.PayflowTransaction.objects.get(
-                comment1=order_number, trxtype=codes.AUTHORIZATION)
-        except models.PayflowTransaction.DoesNotExist:
+        auth_txn = _get_latest_txn(order_number, (codes.AUTHORIZATION,))
+        if auth_txn is None:
             raise exceptions.UnableToTakePayment(
-                "No authorization transaction found with PNREF=%s" % pnref)
-        pnref = auth_txn
+                "No approved authorization transaction found for order %s" %
+                order_number)
+        pnref = auth_txn.pnref
 
     txn = gateway.delayed_capture(order_number, pnref, amt)
     if not txn.is_approved:
@@ -114,6 +114,25 @@ def delayed_capture(order_number, pnref=None, amt=None):
     return txn
 
 
+def partial_capture(order_number, amt):
+    """
+    Capture part of the funds that have been authorized for an order, eg
+    when the first of several shipments is sent.
+
+    The first capture is made with a DELAYED_CAPTURE and any later ones with
+    reference sales.  Use ``paypal.payflow.captures`` to capture for many
+    orders at once.
+
+    :order_number: Order number
+    :amt: The amount to capture.  This can't be more than what is left of
+          the authorization.
+    """
+    result, = captures.capture([(order_number, amt)], workers=1)
+    if result.error:
+        raise exceptions.UnableToTakePayment(six.text_type(result.error))
+    return result.result
+
+
 def referenced_sale(order_number, pnref, amt):
     """
     Capture funds using the bank/address details of a previous transaction
@@ -159,24 +178,51 @@ def credit(order_number, pnref=None, amt=None):
     Return funds that have been previously settled.
 
     :order_number: Order number
-    :pnref: The PNREF of the authorization transaction to use.  If not
-            specified, the order number is used to retrieve the appropriate transaction.
+    :pnref: The PNREF of the settled transaction to credit.  If not
+            specified, the order number is used to retrieve the appropriate
+            transaction.  It must be given for orders that have been captured
+            more than once (eg with ``partial_capture``).
     :amt: A custom amount to capture.  If not specified, the entire transaction
           is refuneded.
     """
     if pnref is None:
-        # No PNREF specified, look-up the auth/sale transaction for this order number
-        # to get the PNREF from there.
-        try:
-            auth_txn = models.PayflowTransaction.objects.get(
-                comment1=order_number, trxtype__in=(codes.AUTHORIZATION,
-                                                    codes.SALE))
-        except models.PayflowTransaction.DoesNotExist:
+        # No PNREF specified, look-up the settled transaction for this order
+        # number to get the PNREF from there.
+        settled_txns = _get_approved_txns(
+            order_number, (codes.SALE, codes.DELAYED_CAPTURE))
+        if not settled_txns:
             raise exceptions.UnableToTakePayment(
-                "No authorization transaction found with PNREF=%s" % pnref)
-        pnref = auth_txn
+                "No approved settled transaction found for order %s" %
+                order_number)
+        if len(settled_txns) > 1:
+            raise exceptions.UnableToTakePayment(
+                "Order %s has been captured more than once, so the PNREF of "
+                "the transaction to credit must be given" % order_number)
+        pnref = settled_txns[0].pnref
 
     txn = gateway.credit(order_number, pnref, amt)
     if not txn.is_approved:
         raise exceptions.PaymentError(txn.respmsg)
     return txn
+
+
+def get_transactions(order_number):
+    """
+    Return the Payflow transactions for an order, most recent first, using a
+    single query.
+    """
+    return list(models.PayflowTransaction.objects.summary().filter(
+        comment1=order_number).order_by('-date_created', '-id'))
+
+
+def _get_approved_txns(order_number, trxtypes):
+    # Declined transactions can't be captured or credited, so they're skipped
+    return [txn for txn in get_transactions(order_number)
+            if txn.trxtype in trxtypes and txn.is_approved]
+
+
+def _get_latest_txn(order_number, trxtypes):
+    # An order can have more than one authorization (eg after a
+    # reauthorization) so use the most recent.
+    txns = _get_approved_txns(order_number, trxtypes)
+    return txns[0] if txns else None
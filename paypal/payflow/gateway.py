@@ -5,15 +5,26 @@ non-Oscar project.  All Oscar-related functionality should be in the facade.
 from __future__ import unicode_literals
 import logging
 
-from django.conf import settings
-from django.core import exceptions
+from django.db import transaction
 
 from paypal import gateway
+from paypal.ledger.models import LedgerEntry
 from paypal.payflow import models
 from paypal.payflow import codes
+from paypal.payflow.conf import get_settings
 
 logger = logging.getLogger('paypal.payflow')
 
+# The parameters that must be supplied for each type of transaction
+REQUIRED_PARAMS = {
+    codes.AUTHORIZATION: ('ACCT', 'AMT', 'EXPDATE'),
+    codes.SALE: ('AMT',),
+    codes.DELAYED_CAPTURE: ('ORIGID',),
+    codes.CREDIT: ('ORIGID',),
+    codes.VOID: ('ORIGID',),
+}
+REFERENCE_REQUIRED_PARAMS = ('ORIGID', 'AMT')
+
 
 def authorize(order_number, card_number, cvv, expiry_date, amt, **kwargs):
     """
@@ -69,11 +80,16 @@ def _submit_payment_details(trxtype, order_number, card_number, cvv, expiry_date
     return _transaction(params)
 
 
-def delayed_capture(order_number, pnref, amt=None):
+def delayed_capture(order_number, pnref, amt=None, commit=True,
+                    request_id=None):
     """
     Perform a DELAYED CAPTURE transaction.
 
     This captures money that was previously authorised.
+
+    :request_id: Optional ID that makes the call safe to retry.  PayPal
+                 returns the original response for a repeated request ID
+                 rather than capturing again.
     """
     params = {
         'COMMENT1': order_number,
@@ -82,10 +98,10 @@ def delayed_capture(order_number, pnref, amt=None):
     }
     if amt:
         params['AMT'] = amt
-    return _transaction(params)
+    return _transaction(params, commit=commit, request_id=request_id)
 
 
-def reference_transaction(order_number, pnref, amt):
+def reference_transaction(order_number, pnref, amt, commit=True):
     """
     Capture money using the card/address details of a previous transaction
 
@@ -100,10 +116,10 @@ def reference_transaction(order_number, pnref, amt):
         'ORIGID': pnref,
         'AMT': amt,
     }
-    return _transaction(params)
+    return _transaction(params, commit=commit)
 
 
-def credit(order_number, pnref, amt=None):
+def credit(order_number, pnref, amt=None, currency=None, commit=True):
     """
     Refund money back to a bankcard.
     """
@@ -114,10 +130,12 @@ def credit(order_number, pnref, amt=None):
     }
     if amt:
         params['AMT'] = amt
-    return _transaction(params)
+        if currency:
+            params['CURRENCY'] = currency
+    return _transaction(params, commit=commit)
 
 
-def void(order_number, pnref):
+def void(order_number, pnref, commit=True):
     """
     Prevent a transaction from being settled
     """
@@ -126,79 +144,78 @@ def void(order_number, pnref):
         'TRXTYPE': codes.VOID,
         'ORIGID': pnref
     }
-    return _transaction(params)
+    return _transaction(params, commit=commit)
 
 
-def _transaction(extra_params):
+def reference_authorization(order_number, pnref, amt, commit=True):
+    """
+    Authorize money using the card details of a previous transaction.  This
+    can be used to replace an authorization that is about to expire.
+    """
+    params = {
+        'COMMENT1': order_number,
+        'TRXTYPE': codes.AUTHORIZATION,
+        'TENDER': codes.BANKCARD,
+        'ORIGID': pnref,
+        'AMT': amt,
+    }
+    return _transaction(params, commit=commit)
+
+
+def _transaction(extra_params, commit=True, request_id=None):
     """
     Perform a transaction with PayPal.
 
     :extra_params: Additional parameters to include in the payload other than
     the user credentials.
+    :commit: Whether to save the transaction.  If False, the unsaved
+             transaction is returned and the caller is responsible for saving
+             it with ``save_transaction``.
+    :request_id: Sent as the X-VPS-REQUEST-ID header, which PayPal uses to
+                 detect duplicate requests.
     """
     if 'TRXTYPE' not in extra_params:
         raise RuntimeError("All transactions must specify a 'TRXTYPE' paramter")
 
-    # Validate constraints on parameters
-    constraints = {
-        codes.AUTHORIZATION: ('ACCT', 'AMT', 'EXPDATE'),
-        codes.SALE: ('AMT',),
-        codes.DELAYED_CAPTURE: ('ORIGID',),
-        codes.CREDIT: ('ORIGID',),
-        codes.VOID: ('ORIGID',),
-    }
     trxtype = extra_params['TRXTYPE']
-    for key in constraints[trxtype]:
+    required = REQUIRED_PARAMS[trxtype]
+    if trxtype == codes.AUTHORIZATION and 'ORIGID' in extra_params:
+        # Reference authorizations use the card details of the original txn
+        required = REFERENCE_REQUIRED_PARAMS
+    for key in required:
         if key not in extra_params:
             raise RuntimeError(
                 "A %s parameter must be supplied for a %s transaction" % (
                     key, trxtype))
 
-    # At a minimum, we require a vendor ID and a password.
-    for setting in ('PAYPAL_PAYFLOW_VENDOR_ID',
-                    'PAYPAL_PAYFLOW_PASSWORD'):
-        if not hasattr(settings, setting):
-            raise exceptions.ImproperlyConfigured(
-                "You must define a %s setting" % setting
-            )
-
-    # Set credentials
-    params = {
-        'VENDOR': settings.PAYPAL_PAYFLOW_VENDOR_ID,
-        'PWD': settings.PAYPAL_PAYFLOW_PASSWORD,
-        'USER': getattr(settings, 'PAYPAL_PAYFLOW_USER',
-                        settings.PAYPAL_PAYFLOW_VENDOR_ID),
-        'PARTNER': getattr(settings, 'PAYPAL_PAYFLOW_PARTNER',
-                           'PayPal')
-    }
+    config = get_settings()
+    params = dict(config.credentials)
     params.update(extra_params)
 
     # Ensure that any amounts have a currency and are formatted correctly
     if 'AMT' in params:
         if 'CURRENCY' not in params:
-            params['CURRENCY'] = getattr(settings,
-                                         'PAYPAL_PAYFLOW_CURRENCY', 'USD')
+            params['CURRENCY'] = config.currency
         params['AMT'] = "%.2f" % params['AMT']
 
-    if getattr(settings, 'PAYPAL_PAYFLOW_PRODUCTION_MODE', False):
-        url = 'https://payflowpro.paypal.com'
-    else:
-        url = 'https://pilot-payflowpro.paypal.com'
-
     logger.info("Performing %s transaction (trxtype=%s)",
                 codes.trxtype_map[trxtype], trxtype)
-    pairs = gateway.post(url, params)
+    headers = {}
+    if request_id:
+        headers['X-VPS-REQUEST-ID'] = request_id
+    pairs = gateway.post(config.url, params, headers)
 
-    # Beware - this log information will contain the Payflow credentials
-    # only use it in development, not production.
+    # The raw request has already had credentials and card details masked by
+    # the gateway.
     logger.debug("Raw request: %s", pairs['_raw_request'])
     logger.debug("Raw response: %s", pairs['_raw_response'])
 
-    return models.PayflowTransaction.objects.create(
+    txn = models.PayflowTransaction(
         comment1=params['COMMENT1'],
         trxtype=params['TRXTYPE'],
         tender=params.get('TENDER', None),
         amount=params.get('AMT', None),
+        currency=params.get('CURRENCY', None),
         pnref=pairs.get('PNREF', None),
         ppref=pairs.get('PPREF', None),
         cvv2match=pairs.get('CVV2MATCH', None),
@@ -211,3 +228,47 @@ def _transaction(extra_params):
         raw_response=pairs['_raw_response'],
         response_time=pairs['_response_time']
     )
+    if not commit:
+        return txn
+    save_transaction(txn)
+    return txn
+
+
+def save_transaction(txn):
+    """
+    Save a transaction and record it in the ledger.  This is needed for
+    transactions fetched with ``commit=False``.
+    """
+    txn.save()
+    LedgerEntry.objects.record(**_get_ledger_entry(txn))
+    models.CaptureBalance.objects.apply([txn])
+
+
+def save_transactions(txns):
+    """
+    Save a batch of transactions fetched with ``commit=False`` in one
+    database transaction, and record them in the ledger with one insert.
+    """
+    if not txns:
+        return
+    with transaction.atomic():
+        # The transactions are saved one at a time as the ledger's audit
+        # links need their primary keys, which bulk_create doesn't set.
+        for txn in txns:
+            txn.save()
+        LedgerEntry.objects.record_many(
+            [_get_ledger_entry(txn) for txn in txns])
+        models.CaptureBalance.objects.apply(txns)
+
+
+def _get_ledger_entry(txn):
+    return dict(
+        gateway=LedgerEntry.PAYFLOW,
+        operation=txn.trxtype,
+        audit_txn=txn,
+        order_number=txn.comment1,
+        transaction_id=txn.pnref,
+        amount=txn.amount,
+        currency=txn.currency,
+        status=txn.result,
+        is_successful=txn.is_approved)
@@ -1,7 +1,8 @@
 from __future__ import unicode_literals
-import re
 
 from django.db import models
+from django.db.models import F
+from django.utils import timezone
 from django.utils.encoding import python_2_unicode_compatible
 from django.utils.translation import ugettext_lazy as _
 from django.utils.translation import ugettext
@@ -20,11 +21,12 @@ class PayflowTransaction(base.ResponseModel):
     tender = models.CharField(_("Bankcard or PayPal"), max_length=12, null=True)
 
     amount = models.DecimalField(max_digits=12, decimal_places=2, null=True,
-                                 blank=True)
+                                 blank=True, db_index=True)
+    currency = models.CharField(max_length=8, null=True, blank=True)
 
     # Response params
     pnref = models.CharField(_("Payflow transaction ID"), max_length=32,
-                             null=True)
+                             null=True, db_index=True)
     ppref = models.CharField(_("Payment transaction ID"), max_length=32,
                              unique=True, null=True)
     result = models.CharField(max_length=32, null=True, blank=True)
@@ -43,12 +45,9 @@ class PayflowTransaction(base.ResponseModel):
     class Meta:
         ordering = ('-date_created',)
         app_label = 'paypal'
-
-    def save(self, *args, **kwargs):
-        self.raw_request = re.sub(r'PWD=.+?&', 'PWD=XXXXXX&', self.raw_request)
-        self.raw_request = re.sub(r'ACCT=\d+(\d{4})&', 'ACCT=XXXXXXXXXXXX\1&', self.raw_request)
-        self.raw_request = re.sub(r'CVV2=\d+&', 'CVV2=XXX&', self.raw_request)
-        return super(PayflowTransaction, self).save(*args, **kwargs)
+        # The indexes after the first are for the dashboard filters
+        index_together = [('trxtype', 'date_created'),
+                          ('result', 'date_created')]
 
     def get_trxtype_display(self):
         return ugettext(codes.trxtype_map.get(self.trxtype, self.trxtype))
@@ -91,3 +90,69 @@ class PayflowTransaction(base.ResponseModel):
         if self.trxtype != codes.AUTHORIZATION:
             return False
         return self.is_approved
+
+
+class CaptureBalanceManager(models.Manager):
+
+    def apply(self, txns):
+        """
+        Add approved transactions to the balances of their orders.  Orders
+        without a balance are skipped, as theirs is built from their history
+        when it's first needed.
+        """
+        for txn in txns:
+            if not txn.is_approved:
+                continue
+            balances = self.get_queryset().filter(order_number=txn.comment1)
+            amount = txn.amount or 0
+            if txn.trxtype == codes.AUTHORIZATION:
+                # A new authorization (eg a reauthorization) replaces the old
+                # one
+                balances.update(
+                    pnref=txn.pnref, authorized=amount, captured=0,
+                    num_captures=0, date_updated=timezone.now())
+            elif txn.trxtype in (codes.DELAYED_CAPTURE, codes.SALE):
+                balances.update(
+                    captured=F('captured') + amount,
+                    num_captures=F('num_captures') + 1,
+                    date_updated=timezone.now())
+            elif txn.trxtype == codes.VOID:
+                # Nothing more can be captured
+                balances.update(authorized=F('captured'),
+                                date_updated=timezone.now())
+
+
+@python_2_unicode_compatible
+class CaptureBalance(models.Model):
+    """
+    Running totals of the captures made against an order's authorization, so
+    that the balance left to capture can be read without summing the order's
+    transactions.  Kept up to date as transactions are saved by the gateway.
+    """
+    order_number = models.CharField(_("Order number"), max_length=128,
+                                    unique=True)
+    # The authorization that captures are made against
+    pnref = models.CharField(_("Authorization PNREF"), max_length=32)
+    authorized = models.DecimalField(max_digits=12, decimal_places=2)
+    captured = models.DecimalField(max_digits=12, decimal_places=2,
+                                   default=0)
+    num_captures = models.PositiveIntegerField(default=0)
+
+    # Captures that have been sent to PayPal but not saved yet
+    reserved = models.DecimalField(max_digits=12, decimal_places=2,
+                                   default=0)
+    num_reserved = models.PositiveIntegerField(default=0)
+    date_updated = models.DateTimeField(auto_now=True)
+
+    objects = CaptureBalanceManager()
+
+    class Meta:
+        app_label = 'paypal'
+
+    @property
+    def remaining(self):
+        return self.authorized - self.captured - self.reserved
+
+    def __str__(self):
+        return '%s: %s of %s captured' % (
+            self.order_number, self.captured, self.authorized)
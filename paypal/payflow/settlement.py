@@ -0,0 +1,184 @@
+"""
+Settling Payflow authorizations in bulk, eg once a day's orders have shipped.
+
+The authorizations that can be captured are found up front and
+captured with DELAYED_CAPTURE calls made concurrently (see ``paypal.bulk``).
+Calls that fail to reach PayPal are retried, and the results are saved in
+batches with ``bulk_create``.
+
+Each capture is sent with a request ID derived from the authorization, so
+PayPal treats a retry of a call that did get through as a duplicate rather
+than capturing twice.
+"""
+from __future__ import unicode_literals
+import logging
+import time
+from collections import namedtuple
+from decimal import Decimal as D
+
+from django.db import transaction
+from django.db.models import Q
+
+from paypal import bulk
+from paypal.exceptions import PayPalError
+from paypal.payflow import codes, gateway
+from paypal.payflow.models import CaptureBalance, PayflowTransaction
+
+logger = logging.getLogger('paypal.payflow')
+
+APPROVED = ('0', '126')
+
+# Number of results saved per database transaction
+FLUSH_SIZE = 50
+
+# Number of times a failed call is retried
+RETRIES = 2
+
+# An authorization to capture
+Authorization = namedtuple('Authorization', 'order_number pnref amount')
+
+
+def get_capturable(order_numbers=None, before=None):
+    """
+    Yield the approved authorizations that haven't been captured or voided.
+    If an order has more than one (eg after a reauthorization), only the most
+    recent is returned.
+
+    Orders that have been partly captured (see ``paypal.payflow.captures``),
+    or have a partial capture in progress, are left out so they aren't
+    captured twice.  The amount of each authorization is what is left of it
+    according to the order's ``CaptureBalance``, if it has one.
+
+    :order_numbers: Only include these orders
+    :before: Only include authorizations made before this datetime
+    """
+    closed = PayflowTransaction.objects.filter(
+        trxtype__in=(codes.DELAYED_CAPTURE, codes.VOID),
+        result__in=APPROVED).values('comment1')
+    busy = CaptureBalance.objects.filter(
+        Q(num_reserved__gt=0) | Q(captured__gt=0)).values('order_number')
+    qs = PayflowTransaction.objects.filter(
+        trxtype=codes.AUTHORIZATION, result__in=APPROVED).exclude(
+            comment1__in=closed).exclude(comment1__in=busy)
+    if order_numbers is not None:
+        qs = qs.filter(comment1__in=order_numbers)
+    if before is not None:
+        qs = qs.filter(date_created__lt=before)
+    # The rows are read up front as the results are saved while the
+    # authorizations are still being consumed.
+    rows = list(qs.order_by('comment1', '-id').values_list(
+        'comment1', 'pnref', 'amount'))
+    remaining = dict(
+        (balance.order_number, balance.remaining) for balance in
+        CaptureBalance.objects.filter(
+            order_number__in=qs.values('comment1')))
+    previous = None
+    for order_number, pnref, amount in rows:
+        if order_number != previous:
+            amount = remaining.get(order_number, amount)
+            if amount is None or amount > 0:
+                yield Authorization(order_number, pnref, amount)
+        previous = order_number
+
+
+def get_request_id(authorization):
+    """
+    Return the X-VPS-REQUEST-ID for capturing an authorization.  It stays
+    the same across retries and later runs.
+    """
+    return 'capture-%s' % authorization.pnref
+
+
+def _is_retryable(txn):
+    # Negative results are communication errors, which are safe to retry
+    try:
+        return int(txn.result) < 0
+    except (TypeError, ValueError):
+        return False
+
+
+def capture(authorization, retries=RETRIES):
+    """
+    Capture an authorization, retrying calls that fail to reach PayPal.
+    Returns the unsaved transaction.
+    """
+    attempt = 0
+    while True:
+        try:
+            txn = gateway.delayed_capture(
+                authorization.order_number, authorization.pnref,
+                authorization.amount, commit=False,
+                request_id=get_request_id(authorization))
+        except PayPalError:
+            if attempt >= retries:
+                raise
+        else:
+            if not _is_retryable(txn) or attempt >= retries:
+                return txn
+        attempt += 1
+        logger.info("Retrying capture for order %s (attempt %d)",
+                    authorization.order_number, attempt + 1)
+        time.sleep(2 ** attempt)
+
+
+def settle(order_numbers=None, before=None, workers=None, rate=None,
+           retries=RETRIES):
+    """
+    Capture the outstanding authorizations and yield a ``bulk.Result`` for
+    each (with the ``Authorization`` as its item) as it completes.
+    """
+    pending = []
+
+    def flush():
+        with transaction.atomic():
+            gateway.save_transactions(
+                [result.result for result in pending
+                 if result.result is not None])
+        del pending[:]
+
+    def process(authorization):
+        # Called from a worker thread so mustn't touch the database
+        return capture(authorization, retries)
+
+    try:
+        results = bulk.run_concurrently(
+            process, get_capturable(order_numbers, before),
+            workers=workers, rate=rate)
+        for result in results:
+            result = bulk.check(result)
+            pending.append(result)
+            if len(pending) >= FLUSH_SIZE:
+                flush()
+            yield result
+    finally:
+        # Save whatever has been captured, even if the run is interrupted
+        flush()
+
+
+class Summary(object):
+    """
+    Totals for a settlement run.
+    """
+
+    def __init__(self):
+        self.num_captured = 0
+        self.num_failed = 0
+        self.amount_captured = D('0.00')
+        self.failures = []
+
+    def add(self, result):
+        if result.error:
+            self.num_failed += 1
+            self.failures.append((result.item.order_number, result.error))
+        else:
+            self.num_captured += 1
+            self.amount_captured += result.item.amount or 0
+
+    def report(self):
+        lines = ["Captured %d authorizations totalling %s" % (
+            self.num_captured, self.amount_captured)]
+        if self.failures:
+            lines.append("%d failed:" % self.num_failed)
+            for order_number, error in self.failures:
+                lines.append("  Order %s: %s" % (order_number, error))
+        return "\n".join(lines)
@@ -0,0 +1,94 @@
+"""
+Recording PayPal payments against orders with as few queries as possible.
+
+Oscar's checkout looks up (or creates) the payment source and event types by
+name for every order.  These hardly ever change so are resolved once per
+process and then looked up in memory, like the countries in
+``paypal.express.addresses``.  ``PaymentRecordingMixin`` also writes the line
+quantities of each payment event in one insert rather than one per line.
+"""
+from __future__ import unicode_literals
+import threading
+
+from django.db import connection
+from django.db.models.signals import post_delete, post_save
+from oscar.core.loading import get_model
+
+SourceType = get_model('payment', 'SourceType')
+PaymentEvent = get_model('order', 'PaymentEvent')
+PaymentEventType = get_model('order', 'PaymentEventType')
+PaymentEventQuantity = get_model('order', 'PaymentEventQuantity')
+
+_types = {}
+_lock = threading.Lock()
+
+
+def _get_type(model, name):
+    """
+    Return the instance of a source or event type model with the given
+    name, creating it if need be.  The instances are shared between requests
+    so mustn't be modified.
+    """
+    key = (model, name)
+    instance = _types.get(key)
+    if instance is None:
+        # The query is made without holding the lock as saving a type sends
+        # the signals that reset the cache.  get_or_create handles another
+        # thread or process creating it at the same time.
+        instance, is_created = model._default_manager.get_or_create(name=name)
+        # A new row could still be rolled back (eg if the order can't be
+        # placed), so only cache it once it has been committed.
+        if not is_created or not connection.in_atomic_block:
+            with _lock:
+                instance = _types.setdefault(key, instance)
+    return instance
+
+
+def get_source_type(name='PayPal'):
+    return _get_type(SourceType, name)
+
+
+def get_event_type(name):
+    return _get_type(PaymentEventType, name)
+
+
+def reset(**kwargs):
+    # Creating a type can't make a cached one stale, and it happens inside
+    # _get_type
+    if kwargs.get('created'):
+        return
+    with _lock:
+        _types.clear()
+
+for _model in (SourceType, PaymentEventType):
+    post_save.connect(reset, sender=_model, dispatch_uid='paypal-types')
+    post_delete.connect(reset, sender=_model, dispatch_uid='paypal-types')
+
+
+class PaymentRecordingMixin(object):
+    """
+    Mixin for checkout views that record PayPal payments.  It uses the cached
+    event types and saves the line quantities of all the payment events in a
+    single query.
+    """
+
+    def add_payment_event(self, event_type_name, amount, reference=''):
+        if self._payment_events is None:
+            self._payment_events = []
+        event = PaymentEvent(event_type=get_event_type(event_type_name),
+                             amount=amount, reference=reference)
+        self._payment_events.append(event)
+
+    def save_payment_events(self, order):
+        if not self._payment_events:
+            return
+        lines = list(order.lines.all())
+        quantities = []
+        for event in self._payment_events:
+            event.order = order
+            event.save()
+            quantities.extend(
+                PaymentEventQuantity(event=event, line=line,
+                                     quantity=line.quantity)
+                for line in lines)
+        PaymentEventQuantity.objects.bulk_create(quantities)
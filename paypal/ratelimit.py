@@ -0,0 +1,144 @@
+"""
+Rate limiting of the calls made to PayPal, shared by every process.
+
+PayPal throttles API callers by credentials, and web traffic and bulk jobs
+(see ``paypal.bulk``) share the same credentials.  Each credential set and
+class of method (see ``METHOD_CLASSES``) has a bucket of tokens in Django's
+cache which is refilled at the start of each window.  A call takes a token
+before it is made, or waits for the next window if the bucket is empty.
+
+The buckets are only shared between processes if the cache is, so use a
+cache such as memcached or Redis rather than the local-memory cache.
+
+Calls made by bulk jobs run at a lower priority: they can't take the last
+tokens in a bucket (see PAYPAL_RATE_LIMIT_RESERVE), leaving them for
+interactive calls such as those made during checkout.  Interactive calls
+never wait longer than PAYPAL_RATE_LIMIT_MAX_WAIT.
+"""
+from __future__ import unicode_literals
+import hashlib
+import logging
+import math
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.core.cache import cache
+
+logger = logging.getLogger('paypal.ratelimit')
+
+INTERACTIVE, BATCH = 'interactive', 'batch'
+
+# Classes of method that are limited together.  Express and Adaptive methods
+# are keyed by name and Payflow ones by TRXTYPE.  Anything else is in the
+# 'default' class.
+METHOD_CLASSES = {
+    'SetExpressCheckout': 'checkout',
+    'GetExpressCheckoutDetails': 'checkout',
+    'DoExpressCheckoutPayment': 'checkout',
+    'DoCapture': 'payment',
+    'DoVoid': 'payment',
+    'DoReauthorization': 'payment',
+    'RefundTransaction': 'payment',
+    'TransactionSearch': 'search',
+}
+DEFAULT_CLASS = 'default'
+
+_local = threading.local()
+
+
+def get_limits():
+    """
+    Return a dict of the number of calls allowed per second for each method
+    class.  Classes that aren't included aren't limited.
+    """
+    return getattr(settings, 'PAYPAL_RATE_LIMITS', {})
+
+
+def get_reserve():
+    return getattr(settings, 'PAYPAL_RATE_LIMIT_RESERVE', 0.2)
+
+
+def get_max_wait():
+    return getattr(settings, 'PAYPAL_RATE_LIMIT_MAX_WAIT', 2)
+
+
+def get_priority():
+    return getattr(_local, 'priority', INTERACTIVE)
+
+
+@contextmanager
+def batch():
+    """
+    Run the calls made by the current thread at batch priority.
+    """
+    previous = get_priority()
+    _local.priority = BATCH
+    try:
+        yield
+    finally:
+        _local.priority = previous
+
+
+def get_method_class(method):
+    return METHOD_CLASSES.get(method, DEFAULT_CLASS)
+
+
+def _get_bucket(rate, reserve, priority):
+    """
+    Return the length of a window in seconds and the number of tokens the
+    priority can take in each one.
+    """
+    # Rates below one call per second use longer windows so there is always
+    # at least one token.
+    window = max(1.0, 1.0 / rate)
+    capacity = int(rate * window)
+    if priority == BATCH:
+        capacity = max(capacity - int(math.ceil(capacity * reserve)), 1)
+    return window, capacity
+
+
+def acquire(credentials, method):
+    """
+    Wait until a call to ``method`` with ``credentials`` (any string that
+    identifies the account, eg the API username) can be made.
+    """
+    method_class = get_method_class(method)
+    rate = get_limits().get(method_class)
+    if not rate:
+        return
+    priority = get_priority()
+    window, capacity = _get_bucket(rate, get_reserve(), priority)
+    max_wait = get_max_wait() if priority == INTERACTIVE else None
+    prefix = 'paypal-ratelimit-%s-%s' % (
+        hashlib.md5(credentials.encode('utf-8')).hexdigest(), method_class)
+
+    waited = 0
+    while True:
+        now = time.time()
+        number = int(now / window)
+        key = '%s-%d' % (prefix, number)
+        # The cache's incr is atomic (for memcached and Redis) so processes
+        # can't take the same token.
+        cache.add(key, 0, int(window) + 1)
+        try:
+            count = cache.incr(key)
+        except ValueError:
+            # The key was evicted between the add and the incr
+            count = 1
+        if count <= capacity:
+            return
+        # Put the token back so we don't use up the interactive calls' share
+        try:
+            cache.decr(key)
+        except ValueError:
+            pass
+
+        delay = (number + 1) * window - now
+        if max_wait is not None and waited + delay > max_wait:
+            logger.warning("Rate limit for %s calls exceeded, making the "
+                           "call anyway", method_class)
+            return
+        time.sleep(delay)
+        waited += delay
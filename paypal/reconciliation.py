@@ -0,0 +1,306 @@
+"""
+Reconciling local transactions against what PayPal actually settled.
+
+Both sides are streams of ``Entry`` tuples sorted by PayPal's transaction ID,
+which are merge-joined in a single pass.  Memory use depends on the number of
+entries sharing an ID rather than the size of the inputs:
+
+* Local entries are read from the database in keyset pages, ordered by ID.
+* PayPal's entries come from TransactionSearch or a downloaded settlement
+  report (STL) file.  These aren't in ID order so are sorted on disk first
+  (see ``sort_entries``).
+
+Any iterable of entries can be used for PayPal's side, eg a list in tests or
+a CSV export from another system (see ``read_csv``).
+"""
+from __future__ import unicode_literals
+import csv
+import heapq
+import itertools
+import json
+import tempfile
+from collections import namedtuple
+from decimal import Decimal as D
+
+from django.db.models import Q
+
+from paypal import bulk
+from paypal.express import gateway as express_gateway
+from paypal.express.models import ExpressTransaction
+from paypal.payflow import codes
+from paypal.payflow.models import PayflowTransaction
+
+# A settled transaction.  Refunds and credits have a negative amount.
+Entry = namedtuple('Entry', 'transaction_id amount currency')
+
+MISSING_LOCALLY = 'missing_locally'
+MISSING_AT_PAYPAL = 'missing_at_paypal'
+DUPLICATE = 'duplicate'
+AMOUNT_MISMATCH = 'amount_mismatch'
+
+# A difference between the two sides.  ``local`` and ``paypal`` are tuples of
+# the entries for the transaction ID on each side.
+Discrepancy = namedtuple('Discrepancy', 'kind transaction_id local paypal')
+
+# Number of local rows read per query
+PAGE_SIZE = 1000
+
+# Number of entries sorted in memory at a time
+SORT_CHUNK_SIZE = 50000
+
+# Only in the responses of checkouts with more than one payment
+PARALLEL_PAYMENT_KEY = 'PAYMENTINFO_1_AMT='
+
+# TransactionSearch types that move money
+SEARCH_TYPES = ('Payment', 'Refund')
+
+# Settlement report event codes for payments (T00xx) and refunds (T11xx)
+EVENT_CODE_PREFIXES = ('T00', 'T11')
+
+
+def _iterate(queryset, key, fields, page_size=PAGE_SIZE):
+    """
+    Yield rows of ``fields`` ordered by ``key``, reading a page per query.
+    Each page starts after the (key, pk) of the last row of the previous one,
+    so it doesn't matter how large the table is.
+    """
+    queryset = queryset.order_by(key, 'pk').values_list(key, 'pk', *fields)
+    last = None
+    while True:
+        qs = queryset
+        if last is not None:
+            qs = qs.filter(Q(**{'%s__gt' % key: last[0]}) |
+                           Q(**{key: last[0], 'pk__gt': last[1]}))
+        page = list(qs[:page_size])
+        if not page:
+            return
+        for row in page:
+            yield row
+        last = page[-1]
+
+
+def express_entries(start, end, page_size=PAGE_SIZE):
+    """
+    Yield entries for the successful Express payments, captures and refunds
+    made between two datetimes, in transaction ID order.
+
+    Authorizations don't move money so aren't included.  Each payment of a
+    parallel checkout is a separate entry.
+    """
+    qs = ExpressTransaction.objects.filter(
+        ack__in=(ExpressTransaction.SUCCESS,
+                 ExpressTransaction.SUCCESS_WITH_WARNING),
+        date_created__gte=start, date_created__lt=end)
+    parallel = qs.filter(
+        method=express_gateway.DO_EXPRESS_CHECKOUT,
+        raw_response__contains=PARALLEL_PAYMENT_KEY)
+    qs = qs.filter(
+        method__in=(express_gateway.DO_EXPRESS_CHECKOUT,
+                    express_gateway.DO_CAPTURE,
+                    express_gateway.REFUND_TRANSACTION),
+        transaction_id__isnull=False).exclude(
+            method=express_gateway.DO_EXPRESS_CHECKOUT,
+            raw_response__contains=PARALLEL_PAYMENT_KEY)
+    for reason in ('authorization', 'order'):
+        qs = qs.exclude(
+            method=express_gateway.DO_EXPRESS_CHECKOUT,
+            raw_response__contains='PAYMENTINFO_0_PENDINGREASON=%s' % reason)
+
+    def entries():
+        rows = _iterate(qs, 'transaction_id',
+                        ('method', 'amount', 'currency'), page_size)
+        for txn_id, __, method, amount, currency in rows:
+            if method == express_gateway.REFUND_TRANSACTION and amount:
+                amount = -amount
+            yield Entry(txn_id, amount, currency)
+
+    # Parallel checkouts are rare, and only record the ID of their first
+    # payment, so their payments are read from the responses and sorted
+    # separately.
+    parallel_entries = sort_entries(_parallel_entries(parallel, page_size))
+    merged = heapq.merge(_decorate(entries(), 0),
+                         _decorate(parallel_entries, 1))
+    for row in merged:
+        yield row[-1]
+
+
+def _decorate(entries, stream_number):
+    # The stream and position numbers stop entries being compared in a merge
+    for number, entry in enumerate(entries):
+        yield (entry.transaction_id, stream_number, number, entry)
+
+
+def _parallel_entries(queryset, page_size):
+    rows = _iterate(queryset, 'id', ('raw_response', 'currency'), page_size)
+    for __, __, raw_response, currency in rows:
+        txn = ExpressTransaction(raw_response=raw_response)
+        for payment in express_gateway.get_payment_info(txn):
+            if payment.pending_reason not in ('authorization', 'order'):
+                yield Entry(payment.transaction_id, payment.amount,
+                            payment.currency or currency)
+
+
+def payflow_entries(start, end, page_size=PAGE_SIZE):
+    """
+    Yield entries for the approved Payflow sales, delayed captures and
+    credits made between two datetimes, in PNREF order.
+
+    Payflow transactions don't record their currency, and delayed captures
+    of the full authorization don't record their amount, so these are None.
+    """
+    qs = PayflowTransaction.objects.filter(
+        trxtype__in=(codes.SALE, codes.DELAYED_CAPTURE, codes.CREDIT),
+        result__in=('0', '126'), pnref__isnull=False,
+        date_created__gte=start, date_created__lt=end)
+    rows = _iterate(qs, 'pnref', ('trxtype', 'amount'), page_size)
+    for pnref, __, trxtype, amount in rows:
+        if trxtype == codes.CREDIT and amount:
+            amount = -amount
+        yield Entry(pnref, amount, None)
+
+
+def search_entries(start, end):
+    """
+    Yield entries for the transactions returned by TransactionSearch, in the
+    order PayPal returns them (most recent first).
+    """
+    for result in express_gateway.search_transactions(start, end):
+        if result.type in SEARCH_TYPES:
+            yield Entry(result.transaction_id, result.amount, result.currency)
+
+
+def read_settlement_report(f):
+    """
+    Yield entries from a PayPal settlement report (STL) CSV file.
+
+    Each row starts with a type: 'CH' rows hold the column names and 'SB'
+    rows hold the transactions.  Amounts are in minor units (eg cents).
+    """
+    columns = None
+    for row in csv.reader(f):
+        if not row:
+            continue
+        if row[0] == 'CH':
+            columns = dict((name, i) for i, name in enumerate(row))
+        elif row[0] == 'SB' and columns is not None:
+            event_code = row[columns['Transaction Event Code']]
+            if not event_code.startswith(EVENT_CODE_PREFIXES):
+                continue
+            amount = D(row[columns['Gross Transaction Amount']]) / 100
+            if row[columns['Transaction Debit or Credit']] == 'DR':
+                amount = -amount
+            yield Entry(row[columns['Transaction ID']], amount,
+                        row[columns['Gross Transaction Currency']])
+
+
+def read_csv(f):
+    """
+    Yield entries from a CSV file with a ``transaction_id,amount,currency``
+    header.
+    """
+    for row in csv.DictReader(f):
+        yield Entry(row['transaction_id'],
+                    D(row['amount']) if row.get('amount') else None,
+                    row.get('currency') or None)
+
+
+def _write_run(entries):
+    run = tempfile.TemporaryFile(mode='w+')
+    for entry in entries:
+        amount = None if entry.amount is None else str(entry.amount)
+        run.write(json.dumps([entry.transaction_id, amount, entry.currency]))
+        run.write('\n')
+    run.seek(0)
+    return run
+
+
+def _read_run(run, run_number):
+    for line_number, line in enumerate(run):
+        txn_id, amount, currency = json.loads(line)
+        entry = Entry(txn_id, None if amount is None else D(amount), currency)
+        # The run and line numbers stop entries being compared in the merge
+        yield (txn_id, run_number, line_number, entry)
+
+
+def sort_entries(entries, chunk_size=SORT_CHUNK_SIZE):
+    """
+    Yield the entries in transaction ID order.
+
+    Inputs of up to ``chunk_size`` entries are sorted in memory.  Larger
+    ones are sorted a chunk at a time into temporary files which are then
+    merged, so only one chunk is held in memory at once.
+    """
+    def key(entry):
+        return entry.transaction_id
+
+    runs = []
+    try:
+        for chunk in bulk.chunked(entries, chunk_size):
+            chunk.sort(key=key)
+            if not runs and len(chunk) < chunk_size:
+                # Everything fitted in a single chunk
+                for entry in chunk:
+                    yield entry
+                return
+            runs.append(_write_run(chunk))
+        merged = heapq.merge(*[_read_run(run, i)
+                               for i, run in enumerate(runs)])
+        for row in merged:
+            yield row[-1]
+    finally:
+        for run in runs:
+            run.close()
+
+
+def _group(entries, side):
+    """
+    Yield (transaction ID, entries) for each ID in a sorted stream.
+    """
+    previous = None
+    for txn_id, group in itertools.groupby(
+            entries, key=lambda entry: entry.transaction_id):
+        if previous is not None and txn_id < previous:
+            raise ValueError("%s entries aren't sorted by transaction ID "
+                             "(%s follows %s)" % (side, txn_id, previous))
+        previous = txn_id
+        yield txn_id, tuple(group)
+
+
+def _compare(txn_id, local, paypal):
+    if len(local) > 1 or len(paypal) > 1:
+        return Discrepancy(DUPLICATE, txn_id, local, paypal)
+    ours, theirs = local[0], paypal[0]
+    # Unknown amounts and currencies (eg for Payflow) aren't compared
+    if (ours.amount is not None and theirs.amount is not None and
+            ours.amount != theirs.amount):
+        return Discrepancy(AMOUNT_MISMATCH, txn_id, local, paypal)
+    if (ours.currency and theirs.currency and
+            ours.currency != theirs.currency):
+        return Discrepancy(AMOUNT_MISMATCH, txn_id, local, paypal)
+    return None
+
+
+def reconcile(local, paypal):
+    """
+    Merge-join two streams of entries, both sorted by transaction ID, and
+    yield a ``Discrepancy`` for each transaction that doesn't match.
+
+    A ValueError is raised if either stream turns out not to be sorted.
+    """
+    local = _group(local, "Local")
+    paypal = _group(paypal, "PayPal")
+    ours = next(local, None)
+    theirs = next(paypal, None)
+    while ours is not None or theirs is not None:
+        if theirs is None or (ours is not None and ours[0] < theirs[0]):
+            yield Discrepancy(MISSING_AT_PAYPAL, ours[0], ours[1], ())
+            ours = next(local, None)
+        elif ours is None or theirs[0] < ours[0]:
+            yield Discrepancy(MISSING_LOCALLY, theirs[0], (), theirs[1])
+            theirs = next(paypal, None)
+        else:
+            discrepancy = _compare(ours[0], ours[1], theirs[1])
+            if discrepancy is not None:
+                yield discrepancy
+            ours = next(local, None)
+            theirs = next(paypal, None)
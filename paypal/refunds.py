@@ -0,0 +1,326 @@
+"""
+Bulk refunds from a file, eg after a product recall.
+
+Each record gives an order number (or Express token), an amount and a
+currency.  The records are streamed from the input file in batches: the
+original transactions for a batch are looked up with a few queries, the
+refunds are made concurrently (Express RefundTransaction or Payflow CREDIT)
+and the results are written to the output file as they complete.  Memory use
+doesn't depend on the size of the input.
+
+Both CSV (with a ``reference,amount,currency`` header) and newline-delimited
+JSON are supported.  The amount can be left blank to refund whatever is left
+of the payment.  Each refund is checked against the earlier refunds of its
+payment, so fully refunded payments are skipped when a file is run again
+after an interruption.
+
+An order paid with Payflow that was captured more than once has to be
+referenced by the PNREF of the capture to refund.
+"""
+from __future__ import unicode_literals
+import csv
+import json
+from collections import namedtuple
+from decimal import Decimal as D, InvalidOperation
+
+from django.db.models import Q
+from django.utils import six
+from django.utils.six.moves.urllib.parse import parse_qs
+
+from paypal import bulk
+from paypal.exceptions import PayPalError
+from paypal.express import gateway as express_gateway
+from paypal.express.models import ExpressTransaction
+from paypal.ledger.models import LedgerEntry
+from paypal.payflow import codes, gateway as payflow_gateway
+from paypal.payflow.conf import get_settings as get_payflow_settings
+from paypal.payflow.models import PayflowTransaction
+
+CSV, NDJSON = 'csv', 'ndjson'
+
+APPROVED = ('0', '126')
+
+# Number of records resolved and refunded at a time
+BATCH_SIZE = 200
+
+RESULT_FIELDS = ('reference', 'gateway', 'order_number', 'amount',
+                 'currency', 'status', 'transaction_id', 'error')
+
+# A refund resolved against the original transaction
+Refund = namedtuple(
+    'Refund', 'reference gateway order_number transaction_id amount '
+    'currency is_partial error')
+
+
+def read_records(f, format=CSV):
+    """
+    Yield (reference, amount, currency) tuples from an input file.
+    """
+    if format == NDJSON:
+        rows = (json.loads(line) for line in f if line.strip())
+    else:
+        rows = csv.DictReader(f)
+    for row in rows:
+        # JSON order numbers and amounts may be numbers rather than strings
+        reference = (row.get('reference') or row.get('token') or
+                     row.get('order_number') or '')
+        amount = row.get('amount')
+        if amount is not None and amount != '':
+            amount = six.text_type(amount)
+        yield (six.text_type(reference).strip(), amount or None,
+               row.get('currency') or None)
+
+
+class ResultWriter(object):
+    """
+    Write refund results to a file as they arrive.
+    """
+
+    def __init__(self, f, format=CSV):
+        self.f = f
+        self.format = format
+        if format == CSV:
+            self.writer = csv.writer(f)
+            self.writer.writerow(RESULT_FIELDS)
+
+    def write(self, result):
+        refund = result.item
+        txn = result.result
+        error = result.error or refund.error
+        row = {
+            'reference': refund.reference,
+            'gateway': refund.gateway,
+            'order_number': refund.order_number,
+            'amount': '' if refund.amount is None else str(refund.amount),
+            'currency': refund.currency,
+            'status': 'Failed' if error else 'Refunded',
+            'transaction_id': _get_refund_id(refund, txn),
+            'error': str(error) if error else '',
+        }
+        if self.format == CSV:
+            self.writer.writerow([row[key] or '' for key in RESULT_FIELDS])
+        else:
+            self.f.write(json.dumps(row) + '\n')
+        self.f.flush()
+
+
+def refund_records(records, workers=None, rate=None):
+    """
+    Refund each (reference, amount, currency) record and yield a
+    ``bulk.Result`` for each one (with the ``Refund`` as its item) as it
+    completes.  Each refund is saved before its result is yielded.
+    """
+    for chunk in bulk.chunked(records, BATCH_SIZE):
+        refunds = resolve(chunk)
+        to_refund = []
+        for refund in refunds:
+            if refund.error:
+                yield bulk.Result(refund, None, PayPalError(refund.error))
+            else:
+                to_refund.append(refund)
+
+        for result in bulk.run_concurrently(
+                _refund, to_refund, workers=workers, rate=rate):
+            result = bulk.check(result)
+            bulk.save_results([result])
+            yield result
+
+
+def refund_file(infile, outfile, format=CSV, workers=None, rate=None):
+    """
+    Refund the records in ``infile`` and write the results to ``outfile``.
+    Returns a tuple of the number of successful and failed refunds.
+    """
+    writer = ResultWriter(outfile, format)
+    num_refunded = num_failed = 0
+    for result in refund_records(read_records(infile, format),
+                                 workers=workers, rate=rate):
+        writer.write(result)
+        if result.error:
+            num_failed += 1
+        else:
+            num_refunded += 1
+    return num_refunded, num_failed
+
+
+def resolve(records):
+    """
+    Look up the original transactions for a batch of records.  References
+    starting with 'EC-' are Express tokens - anything else is an order number
+    or the PNREF of a Payflow capture.
+    """
+    tokens = set()
+    order_numbers = set()
+    for reference, __, __ in records:
+        if reference.startswith('EC-'):
+            tokens.add(reference)
+        elif reference:
+            order_numbers.add(reference)
+
+    # Express payments for the order numbers
+    token_orders = {}
+    if order_numbers:
+        token_orders = dict(
+            (token, number) for number, token in LedgerEntry.objects.filter(
+                gateway=LedgerEntry.EXPRESS,
+                operation=express_gateway.DO_EXPRESS_CHECKOUT,
+                is_successful=True, order_number__in=order_numbers,
+            ).values_list('order_number', 'reference'))
+        tokens.update(token_orders)
+
+    express_txns = {}
+    express_payments = {}
+    if tokens:
+        for txn in ExpressTransaction.objects.without_request().filter(
+                token__in=tokens,
+                method=express_gateway.DO_EXPRESS_CHECKOUT,
+                ack__in=(ExpressTransaction.SUCCESS,
+                         ExpressTransaction.SUCCESS_WITH_WARNING)):
+            express_txns[txn.token] = txn
+            express_payments[txn.token] = express_gateway.get_payment_info(
+                txn)
+    express_orders = dict((number, token)
+                          for token, number in token_orders.items())
+
+    # Amounts already refunded, by the ID of the payment they were made
+    # against
+    refunded = {}
+    if express_payments:
+        entries = LedgerEntry.objects.filter(
+            gateway=LedgerEntry.EXPRESS,
+            operation=express_gateway.REFUND_TRANSACTION, is_successful=True,
+            transaction_id__in=[
+                payment.transaction_id
+                for payments in express_payments.values()
+                for payment in payments],
+        ).values_list('transaction_id', 'amount')
+        for txn_id, amount in entries:
+            refunded[txn_id] = refunded.get(txn_id, 0) + (amount or 0)
+
+    # Settled Payflow transactions for the remaining references
+    payflow_txns = {}
+    payflow_orders = {}
+    payflow_refs = order_numbers - set(express_orders)
+    if payflow_refs:
+        for txn in PayflowTransaction.objects.summary().filter(
+                Q(comment1__in=payflow_refs) | Q(pnref__in=payflow_refs),
+                trxtype__in=(codes.SALE, codes.DELAYED_CAPTURE),
+                result__in=APPROVED).order_by('date_created'):
+            payflow_txns[txn.pnref] = txn
+            payflow_orders.setdefault(txn.comment1, []).append(txn)
+
+    # Credits are matched to the capture they were made against by the
+    # ORIGID they were sent with.  Full credits have no amount.
+    if payflow_txns:
+        credits = PayflowTransaction.objects.filter(
+            comment1__in=list(payflow_orders), trxtype=codes.CREDIT,
+            result__in=APPROVED).only('amount', 'raw_request')
+        for credit in credits:
+            pnref = _get_origid(credit)
+            if pnref in payflow_txns:
+                amount = credit.amount
+                if amount is None:
+                    amount = payflow_txns[pnref].amount or 0
+                refunded[pnref] = refunded.get(pnref, 0) + amount
+
+    return [_resolve_record(record, express_txns, express_payments,
+                            express_orders, token_orders, payflow_txns,
+                            payflow_orders, refunded)
+            for record in records]
+
+
+def _get_origid(txn):
+    return parse_qs(txn.raw_request).get('ORIGID', [None])[0]
+
+
+def _check_amount(refund, original, refunded):
+    """
+    Check the amount of a refund against what is left of the payment, and
+    refund what is left if no amount was given.
+    """
+    remaining = (original or 0) - refunded
+    if remaining <= 0:
+        return refund._replace(error="Already refunded")
+    if refund.amount is None:
+        if refunded:
+            refund = refund._replace(amount=remaining)
+    elif refund.amount > remaining:
+        return refund._replace(
+            error="Only %s is left to refund" % remaining)
+    return refund._replace(
+        is_partial=refund.amount is not None and refund.amount < original)
+
+
+def _resolve_record(record, express_txns, express_payments, express_orders,
+                    token_orders, payflow_txns, payflow_orders, refunded):
+    reference, amount, currency = record
+    refund = Refund(reference, None, None, None, None, currency, False, None)
+    if amount is not None:
+        try:
+            amount = D(amount)
+        except InvalidOperation:
+            return refund._replace(error="Invalid amount '%s'" % amount)
+        if amount <= 0:
+            return refund._replace(error="Invalid amount '%s'" % amount)
+        refund = refund._replace(amount=amount)
+
+    token = express_orders.get(reference, reference)
+    if token in express_txns:
+        txn = express_txns[token]
+        payments = express_payments[token]
+        if currency and currency != txn.currency:
+            return refund._replace(error="Currency doesn't match payment")
+        if not payments:
+            return refund._replace(error="No payment found")
+        if len(payments) > 1:
+            # Parallel payments are refunded separately
+            return refund._replace(
+                error="Order has more than one payment")
+        payment = payments[0]
+        refund = refund._replace(
+            gateway=LedgerEntry.EXPRESS,
+            order_number=token_orders.get(token),
+            transaction_id=payment.transaction_id,
+            currency=txn.currency)
+        return _check_amount(refund, payment.amount,
+                             refunded.get(payment.transaction_id, 0))
+
+    if reference in payflow_orders:
+        captures = payflow_orders[reference]
+        if len(captures) > 1:
+            return refund._replace(
+                error="Order has more than one capture; give the PNREF "
+                      "of the one to refund")
+        txn = captures[0]
+    elif reference in payflow_txns:
+        txn = payflow_txns[reference]
+    else:
+        return refund._replace(error="No payment found")
+    txn_currency = txn.currency or get_payflow_settings().currency
+    if currency and currency != txn_currency:
+        return refund._replace(error="Currency doesn't match payment")
+    refund = refund._replace(
+        gateway=LedgerEntry.PAYFLOW,
+        order_number=txn.comment1,
+        transaction_id=txn.pnref,
+        currency=txn_currency)
+    return _check_amount(refund, txn.amount, refunded.get(txn.pnref, 0))
+
+
+def _refund(refund):
+    # Called from a worker thread so mustn't touch the database
+    if refund.gateway == LedgerEntry.EXPRESS:
+        return express_gateway.refund_txn(
+            refund.transaction_id, refund.is_partial, refund.amount,
+            refund.currency, commit=False)
+    return payflow_gateway.credit(
+        refund.order_number, refund.transaction_id, refund.amount,
+        refund.currency, commit=False)
+
+
+def _get_refund_id(refund, txn):
+    if txn is None or not bulk.is_successful(txn):
+        return ''
+    if refund.gateway == LedgerEntry.EXPRESS:
+        return txn.value('REFUNDTRANSACTIONID', '')
+    return txn.pnref
@@ -0,0 +1,118 @@
+"""
+Sharing the response of identical read calls that are in flight at the same
+time.
+
+Double-clicks, browser prefetching and retries can send several requests for
+the same token at once.  Rather than each making its own call to PayPal (and
+saving its own audit row), the first caller makes the call and the others
+wait for its result.
+
+Within a process the callers are coordinated with a lock.  If
+PAYPAL_SINGLE_FLIGHT_CACHE is enabled, a lock in Django's cache is used as
+well so that callers in other processes share the result too.  This needs a
+cache that is shared between processes, such as memcached or Redis.
+
+Results are shared between callers so mustn't be modified.
+"""
+from __future__ import unicode_literals
+import hashlib
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+logger = logging.getLogger('paypal.singleflight')
+
+# How often to check the cache for another process's result
+POLL_INTERVAL = 0.1
+
+_calls = {}
+_lock = threading.Lock()
+
+
+def use_cache():
+    return getattr(settings, 'PAYPAL_SINGLE_FLIGHT_CACHE', False)
+
+
+def get_timeout():
+    return getattr(settings, 'PAYPAL_SINGLE_FLIGHT_TIMEOUT', 10)
+
+
+class _Call(object):
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+def do(key, func):
+    """
+    Return the result of ``func()``, sharing it with any other callers using
+    the same key at the same time.  If the call raises an exception, it is
+    raised for each of the waiting callers too.
+
+    :key: Tuple identifying the call, eg (method, token)
+    """
+    key = 'paypal-singleflight-%s' % hashlib.md5(
+        ':'.join(key).encode('utf8')).hexdigest()
+    with _lock:
+        call = _calls.get(key)
+        is_leader = call is None
+        if is_leader:
+            call = _calls[key] = _Call()
+
+    if not is_leader:
+        if call.done.wait(get_timeout()):
+            if call.error is not None:
+                raise call.error
+            return call.result
+        # The other call is taking too long so make our own
+        logger.warning("Timed out waiting for call %s", key)
+        return func()
+
+    try:
+        if use_cache():
+            call.result = _do_shared(key, func)
+        else:
+            call.result = func()
+    except Exception as e:
+        call.error = e
+        raise
+    finally:
+        with _lock:
+            del _calls[key]
+        call.done.set()
+    return call.result
+
+
+def _do_shared(key, func):
+    """
+    Coordinate with other processes through the cache.
+    """
+    timeout = get_timeout()
+    lock_key, result_key = '%s-lock' % key, '%s-result' % key
+    if not cache.add(lock_key, 1, timeout):
+        # Another process is making the call so wait for its result
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            time.sleep(POLL_INTERVAL)
+            result = cache.get(result_key)
+            if result is not None:
+                return result
+            if lock_key not in cache:
+                # It failed, so there's no result to share
+                break
+        return func()
+
+    try:
+        # Don't let waiters pick up the result of an earlier call
+        cache.delete(result_key)
+        result = func()
+        # Only kept for long enough for the waiting processes to see it
+        cache.set(result_key, result, timeout)
+        return result
+    finally:
+        cache.delete(lock_key)
@@ -2,12 +2,13 @@ from django.contrib import messages
 from django.http import HttpResponseRedirect
 from django.core.urlresolvers import reverse
 from oscar.apps.checkout import views
-from oscar.apps.payment import forms, models
+from oscar.apps.payment import forms
 
 from paypal.payflow import facade
+from paypal.payment import PaymentRecordingMixin, get_source_type
 
 
-class PaymentDetailsView(views.PaymentDetailsView):
+class PaymentDetailsView(PaymentRecordingMixin, views.PaymentDetailsView):
 
     def get_context_data(self, **kwargs):
         # Override method so the bankcard and billing address forms can be
@@ -72,8 +73,7 @@ class PaymentDetailsView(views.PaymentDetailsView):
             kwargs['bankcard'], kwargs['billing_address'])
 
         # Record payment source and event
-        source_type, is_created = models.SourceType.objects.get_or_create(
-            name='PayPal')
+        source_type = get_source_type()
         source = source_type.sources.model(
             source_type=source_type,
             amount_allocated=total.incl_tax, currency=total.currency)
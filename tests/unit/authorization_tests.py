@@ -0,0 +1,116 @@
+from __future__ import unicode_literals
+import datetime
+from decimal import Decimal as D
+
+from django.test import TestCase
+from django.utils import timezone
+from mock import patch
+
+from paypal import authorizations
+from paypal.ledger.models import LedgerEntry
+from paypal.payflow.models import PayflowTransaction
+from tests.unit.factories import create_express_txn, create_payflow_txn
+
+
+class TestFindingExpressHolds(TestCase):
+
+    def setUp(self):
+        now = timezone.now()
+        self.before = now - datetime.timedelta(days=3)
+        self.after = now - datetime.timedelta(days=29)
+        create_express_txn(
+            'EC-1', transaction_id='AUTH-1', days_ago=10,
+            raw_response='ACK=Success&PAYMENTINFO_0_TRANSACTIONID=AUTH-1'
+                         '&PAYMENTINFO_0_AMT=10.00'
+                         '&PAYMENTINFO_0_CURRENCYCODE=GBP'
+                         '&PAYMENTINFO_0_PENDINGREASON=authorization')
+        # A reauthorization made after the honor period ran out
+        reauthorization = create_express_txn(
+            method='DoReauthorization', transaction_id='AUTH-2', days_ago=6,
+            raw_response='ACK=Success')
+        entry = LedgerEntry.objects.record(
+            gateway=LedgerEntry.EXPRESS, operation='DoReauthorization',
+            audit_txn=reauthorization, transaction_id='AUTH-1',
+            is_successful=True)
+        LedgerEntry.objects.filter(pk=entry.pk).update(
+            date_created=timezone.now() - datetime.timedelta(days=6))
+
+    def find(self):
+        return [hold for page in authorizations.find_express_holds(
+            self.before, self.after) for hold in page]
+
+    def test_reauthorized_holds_have_the_new_id(self):
+        hold, = self.find()
+        self.assertEqual('AUTH-2', hold.transaction_id)
+
+    def test_ignores_holds_captured_after_reauthorization(self):
+        capture = create_express_txn(
+            method='DoCapture', transaction_id='CAPTURE-1', days_ago=1,
+            raw_response='ACK=Success')
+        LedgerEntry.objects.record(
+            gateway=LedgerEntry.EXPRESS, operation='DoCapture',
+            audit_txn=capture, transaction_id='AUTH-2', is_successful=True)
+        self.assertEqual([], self.find())
+
+    def test_finds_each_authorization_of_a_parallel_payment(self):
+        create_express_txn(
+            'EC-2', transaction_id='AUTH-3', days_ago=5,
+            raw_response='ACK=Success&PAYMENTINFO_0_TRANSACTIONID=AUTH-3'
+                         '&PAYMENTINFO_0_AMT=4.00'
+                         '&PAYMENTINFO_0_PENDINGREASON=authorization'
+                         '&PAYMENTINFO_1_TRANSACTIONID=AUTH-4'
+                         '&PAYMENTINFO_1_AMT=6.00'
+                         '&PAYMENTINFO_1_PENDINGREASON=authorization')
+        holds = dict((hold.transaction_id, hold.amount)
+                     for hold in self.find())
+        self.assertEqual(D('4.00'), holds['AUTH-3'])
+        self.assertEqual(D('6.00'), holds['AUTH-4'])
+
+
+class TestFindingPayflowHolds(TestCase):
+
+    def setUp(self):
+        now = timezone.now()
+        self.before = now - datetime.timedelta(days=3)
+        self.after = now - datetime.timedelta(days=29)
+
+    def find(self):
+        return [hold for page in authorizations.find_payflow_holds(
+            self.before, self.after) for hold in page]
+
+    def test_finds_open_authorizations(self):
+        create_payflow_txn('100001', 'A', 'PNREF-1', days_ago=5)
+        hold, = self.find()
+        self.assertEqual('100001', hold.order_number)
+        self.assertEqual('PNREF-1', hold.transaction_id)
+
+    def test_ignores_captured_authorizations(self):
+        create_payflow_txn('100001', 'A', 'PNREF-1', days_ago=5)
+        create_payflow_txn('100001', 'D', 'PNREF-2', days_ago=4)
+        self.assertEqual([], self.find())
+
+    def test_ignores_recent_authorizations(self):
+        create_payflow_txn('100001', 'A', 'PNREF-1', days_ago=1)
+        self.assertEqual([], self.find())
+
+
+class TestSweeping(TestCase):
+
+    def test_voids_open_authorizations(self):
+        create_payflow_txn('100001', 'A', 'PNREF-1', days_ago=5)
+
+        def void(order_number, pnref, commit):
+            return PayflowTransaction(
+                comment1=order_number, trxtype='V', pnref='PNREF-2',
+                result='0', respmsg='Approved', raw_request='',
+                raw_response='', response_time=0)
+
+        with patch('paypal.payflow.gateway.void', side_effect=void):
+            result, = authorizations.sweep(authorizations.VOID)
+        self.assertIsNone(result.error)
+        self.assertTrue(PayflowTransaction.objects.filter(
+            trxtype='V').exists())
+
+    def test_rejects_unknown_policy(self):
+        with self.assertRaises(ValueError):
+            list(authorizations.sweep('refund'))
@@ -0,0 +1,47 @@
+from __future__ import unicode_literals
+
+from django.test import TestCase
+from mock import patch
+
+from paypal import bulk
+from paypal.exceptions import PayPalError
+
+
+class TestChunking(TestCase):
+
+    def test_splits_iterable_into_lists(self):
+        self.assertEqual([[0, 1], [2, 3], [4]],
+                         list(bulk.chunked(iter(range(5)), 2)))
+
+
+class TestRunConcurrently(TestCase):
+
+    def test_returns_result_for_each_item(self):
+        results = bulk.run_concurrently(lambda x: x * 2, range(10), workers=3)
+        self.assertEqual(list(range(0, 20, 2)),
+                         sorted(r.result for r in results))
+
+    def test_errors_are_returned_not_raised(self):
+        def func(item):
+            raise PayPalError("Error")
+        results = list(bulk.run_concurrently(func, [1], workers=1))
+        self.assertIsNone(results[0].result)
+        self.assertIsInstance(results[0].error, PayPalError)
+
+
+class TestRateLimiter(TestCase):
+
+    def test_spaces_out_calls(self):
+        limiter = bulk.RateLimiter(rate=10)
+        with patch('paypal.bulk.time') as mock_time:
+            mock_time.time.return_value = 100
+            limiter.wait()
+            limiter.wait()
+        self.assertEqual(1, mock_time.sleep.call_count)
+        self.assertAlmostEqual(0.1, mock_time.sleep.call_args[0][0])
+
+    def test_no_rate_means_no_waiting(self):
+        limiter = bulk.RateLimiter()
+        with patch('paypal.bulk.time') as mock_time:
+            limiter.wait()
+        self.assertFalse(mock_time.sleep.called)
@@ -0,0 +1,100 @@
+from __future__ import unicode_literals
+from decimal import Decimal as D
+
+from django.test import TestCase
+from django.test.client import RequestFactory
+
+from paypal.express.dashboard.views import (
+    TransactionListView as ExpressListView)
+from paypal.ledger.models import LedgerEntry
+from paypal.payflow import codes
+from paypal.payflow.dashboard.views import (
+    TransactionListView as PayflowListView)
+from tests.unit.factories import create_express_txn, create_payflow_txn
+
+
+class ListViewTestCase(TestCase):
+    view_class = None
+
+    def get_page(self, page_size=25, **params):
+        view = self.view_class(page_size=page_size)
+        view.request = RequestFactory().get('/', params)
+        return view.get_page(view.get_queryset())
+
+
+class TestPayflowTransactionList(ListViewTestCase):
+    view_class = PayflowListView
+
+    def test_pages_through_transactions_newest_first(self):
+        txns = [create_payflow_txn('10000%d' % i) for i in range(5)]
+        page, newer, older = self.get_page(page_size=2)
+        self.assertEqual([txns[4], txns[3]], page)
+        self.assertIsNone(newer)
+
+        page, newer, older = self.get_page(page_size=2, before=older)
+        self.assertEqual([txns[2], txns[1]], page)
+
+        page, newer, older = self.get_page(page_size=2, before=older)
+        self.assertEqual([txns[0]], page)
+        self.assertIsNone(older)
+
+        page, newer, older = self.get_page(page_size=2, after=newer)
+        self.assertEqual([txns[2], txns[1]], page)
+
+    def test_pages_are_ordered_by_date_created(self):
+        newer = create_payflow_txn('100001')
+        older = create_payflow_txn('100002', days_ago=1)
+        page, _, cursor = self.get_page(page_size=1)
+        self.assertEqual([newer], page)
+        page, _, _ = self.get_page(page_size=1, before=cursor)
+        self.assertEqual([older], page)
+
+    def test_invalid_cursors_are_ignored(self):
+        txn = create_payflow_txn('100001')
+        self.assertEqual([txn], self.get_page(before='abc')[0])
+        self.assertEqual([txn], self.get_page(before='2014-01-01_x')[0])
+
+    def test_invalid_search_lists_nothing(self):
+        create_payflow_txn('100001')
+        page, newer, older = self.get_page(amount_min='lots')
+        self.assertEqual([], page)
+
+    def test_filters_by_trxtype_and_result(self):
+        create_payflow_txn('100001', trxtype=codes.SALE)
+        create_payflow_txn('100002', result='12')
+        txn = create_payflow_txn('100003')
+        page, _, _ = self.get_page(trxtype=codes.AUTHORIZATION, result='0')
+        self.assertEqual([txn], page)
+
+    def test_filters_by_amount(self):
+        create_payflow_txn('100001', amount=D('5.00'))
+        txn = create_payflow_txn('100002', amount=D('50.00'))
+        page, _, _ = self.get_page(amount_min='20')
+        self.assertEqual([txn], page)
+
+    def test_searches_by_pnref_or_order_number(self):
+        create_payflow_txn('100001')
+        txn = create_payflow_txn('100002')
+        self.assertEqual([txn], self.get_page(q='100002')[0])
+        self.assertEqual([txn], self.get_page(q='PNREF-100002')[0])
+
+
+class TestExpressTransactionList(ListViewTestCase):
+    view_class = ExpressListView
+
+    def test_filters_by_method_ack_and_currency(self):
+        create_express_txn('EC-1', method='SetExpressCheckout')
+        create_express_txn('EC-2', ack='Failure')
+        create_express_txn('EC-3', currency='USD')
+        txn = create_express_txn('EC-4')
+        page, _, _ = self.get_page(method='DoExpressCheckoutPayment',
+                                   ack='Success', currency='gbp')
+        self.assertEqual([txn], page)
+
+    def test_searches_by_order_number(self):
+        create_express_txn('EC-1')
+        txn = create_express_txn('EC-2')
+        LedgerEntry.objects.create(
+            gateway=LedgerEntry.EXPRESS, operation='DoExpressCheckoutPayment',
+            order_number='100001', reference='EC-2')
+        self.assertEqual([txn], self.get_page(q='100001')[0])
@@ -0,0 +1,65 @@
+from __future__ import unicode_literals
+
+from django.test import TestCase
+from mock import patch
+from oscar.core.loading import get_model
+
+from paypal.express import addresses
+
+Country = get_model('address', 'Country')
+
+
+class TestStateNormalisation(TestCase):
+
+    def test_converts_us_state_names_to_codes(self):
+        self.assertEqual('NY', addresses.normalise_state('US', 'New York '))
+        self.assertEqual('NY', addresses.normalise_state('us', 'ny'))
+
+    def test_leaves_other_states_alone(self):
+        self.assertEqual('West Midlands',
+                         addresses.normalise_state('GB', 'West Midlands'))
+
+
+class TestCountryIndex(TestCase):
+    fixtures = ['countries.json']
+
+    def setUp(self):
+        addresses.reset()
+
+    def tearDown(self):
+        addresses.reset()
+
+    def test_countries_are_looked_up_in_memory(self):
+        addresses.get_country('GB')
+        with self.assertNumQueries(0):
+            self.assertEqual('GB', addresses.get_country('gb').iso_3166_1_a2)
+
+    def test_unknown_country_returns_none(self):
+        self.assertIsNone(addresses.get_country('XX'))
+
+    def test_unknown_countries_are_only_queried_once(self):
+        addresses.get_country('XX')
+        with self.assertNumQueries(0):
+            self.assertIsNone(addresses.get_country('xx'))
+
+    def test_unknown_country_is_found_once_it_is_added(self):
+        addresses.get_country('XX')
+        Country.objects.create(iso_3166_1_a2='XX', name='Nowhere')
+        self.assertEqual('XX', addresses.get_country('XX').iso_3166_1_a2)
+
+    def test_index_is_rebuilt_when_a_country_changes(self):
+        addresses.get_country('GB')
+        country = Country.objects.get(iso_3166_1_a2='GB')
+        country.is_shipping_country = False
+        country.save()
+        with self.assertNumQueries(1):
+            self.assertFalse(addresses.get_country('GB').is_shipping_country)
+
+    def test_unknown_countries_added_elsewhere_are_found_later(self):
+        with patch.object(addresses, 'MISS_TIMEOUT', 0):
+            addresses.get_country('XX')
+            # bulk_create doesn't send the signals, like a change made by
+            # another process
+            Country.objects.bulk_create([
+                Country(iso_3166_1_a2='XX', name='Nowhere')])
+            self.assertEqual('XX', addresses.get_country('XX').iso_3166_1_a2)
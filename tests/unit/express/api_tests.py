@@ -1,14 +1,21 @@
 from __future__ import unicode_literals
+import datetime
 from decimal import Decimal as D
 from django.test import TestCase
+from django.utils.six.moves.urllib.parse import parse_qsl
 from mock import patch, Mock
 
 from oscar.apps.shipping.methods import Free, FixedPrice
+from oscar.core.loading import get_classes
 
 from paypal.express import gateway
 from paypal import exceptions
 from paypal.express.exceptions import InvalidBasket
 from paypal.express.models import ExpressTransaction as Transaction
+from paypal.ledger.models import LedgerEntry
+
+Product, ProductClass = get_classes('catalogue.models',
+                                    ('Product', 'ProductClass'))
 
 
 def create_mock_basket(amt=D('10.00')):
@@ -106,3 +113,290 @@ class TestOrderTotal(TestCase):
             with self.assertRaises(InvalidBasket):
                 gateway.set_txn(basket, shipping_methods, 'GBP',
                                 'http://example.com', 'http://example.com')
+
+
+class SettingsSnapshotTests(TestCase):
+
+    def test_snapshot_is_reused(self):
+        from paypal.express import conf
+        self.assertTrue(conf.get_settings() is conf.get_settings())
+
+    def test_snapshot_is_rebuilt_when_settings_change(self):
+        from django.test.utils import override_settings
+        from paypal.express import conf
+        with override_settings(PAYPAL_LOCALE='FR'):
+            self.assertEqual(
+                'FR', conf.get_settings().set_txn_defaults['LOCALECODE'])
+        self.assertFalse('LOCALECODE' in conf.get_settings().set_txn_defaults)
+
+    def test_api_version_is_still_available_from_the_gateway(self):
+        from paypal.express import conf
+        self.assertEqual(conf.get_settings().api_version, gateway.API_VERSION)
+
+    def test_invalid_locale_in_override_is_rejected(self):
+        from django.core.exceptions import ImproperlyConfigured
+        with self.assertRaises(ImproperlyConfigured):
+            gateway.set_txn(create_mock_basket(), [Free()], 'GBP',
+                            'http://localhost:8000/success',
+                            'http://localhost:8000/error',
+                            paypal_params={'LOCALECODE': 'XX'})
+
+
+class LargeBasketTests(MockedResponseTestCase):
+    """
+    Serialising a 1000-line basket should only format each product's
+    description once.
+    """
+    response_body = 'TOKEN=EC%2d6469953681606921P&TIMESTAMP=2012%2d03%2d26T17%3a19%3a38Z&CORRELATIONID=50a8d895e928f&ACK=Success&VERSION=60%2e0&BUILD=2649250'
+
+    def create_line(self, product):
+        line = Mock()
+        line.product = product
+        line.unit_price_incl_tax = D('1.00')
+        line.quantity = 1
+        return line
+
+    def test_descriptions_are_formatted_once_per_product(self):
+        products = []
+        for i in range(10):
+            product = Mock()
+            product.pk = 'large-basket-%d' % i
+            product.upc = str(i)
+            product.description = '<p>Product %d</p>' % i
+            products.append(product)
+        lines = [self.create_line(products[i % 10]) for i in range(1000)]
+        self.basket.id = 1
+        self.basket.all_lines = Mock(return_value=lines)
+        self.basket.total_incl_tax = D('1000.00')
+
+        response = self.create_mock_response(self.response_body)
+        response.content = self.response_body
+        with patch('requests.post') as post:
+            post.return_value = response
+            with patch('paypal.express.gateway._format_description',
+                       side_effect=lambda d: d) as format_description:
+                gateway.set_txn(self.basket, self.methods, 'GBP',
+                                'http://localhost:8000/success',
+                                'http://localhost:8000/error')
+        self.assertEqual(10, format_description.call_count)
+        payload = post.call_args[0][1]
+        self.assertTrue('L_PAYMENTREQUEST_0_NAME999' in payload)
+
+    def test_child_titles_are_read_from_their_parents(self):
+        parent_kwargs, child_kwargs = {}, {}
+        if hasattr(Product, 'CHILD'):
+            # Oscar 1.0+ marks the product structure explicitly
+            parent_kwargs['structure'] = Product.PARENT
+            child_kwargs['structure'] = Product.CHILD
+        product_class = ProductClass.objects.create(name='Shirts')
+        parent = Product.objects.create(
+            title='Shirt', product_class=product_class, **parent_kwargs)
+        children = [
+            Product.objects.create(
+                parent=parent, upc='SHIRT-%d' % i, **child_kwargs)
+            for i in range(3)]
+        with self.assertNumQueries(1):
+            titles = gateway._get_inherited_titles(children)
+        self.assertEqual(
+            dict((child.pk, 'Shirt') for child in children), titles)
+
+        self.basket.id = 1
+        self.basket.all_lines = Mock(
+            return_value=[self.create_line(child) for child in children])
+        self.basket.total_incl_tax = D('3.00')
+        with patch('paypal.express.gateway._fetch_response') as fetch:
+            gateway.set_txn(self.basket, self.methods, 'GBP',
+                            'http://localhost:8000/success',
+                            'http://localhost:8000/error')
+        params = fetch.call_args[0][1]
+        self.assertEqual('Shirt', params['L_PAYMENTREQUEST_0_NAME0'])
+
+
+class LineItemCompactionTests(TestCase):
+
+    def setUp(self):
+        self.items = [
+            gateway.LineItem(key=(1, D('2.00')), name='A', number='1', desc='',
+                             amount=D('2.00'), quantity=1),
+            gateway.LineItem(key=(2, D('3.33')), name='B', number='2', desc='',
+                             amount=D('3.33'), quantity=2),
+            gateway.LineItem(key=(1, D('2.00')), name='A', number='1', desc='',
+                             amount=D('2.00'), quantity=3),
+            gateway.LineItem(key=None, name='Offer', number=None, desc='',
+                             amount=D('-1.00'), quantity=1),
+        ]
+
+    def total(self, items):
+        return sum(item.amount * item.quantity for item in items)
+
+    def test_items_are_unchanged_by_default(self):
+        self.assertEqual(self.items, gateway.compact_line_items(self.items))
+
+    def test_merges_lines_for_the_same_product_and_price(self):
+        items = gateway.compact_line_items(self.items, merge=True)
+        self.assertEqual(3, len(items))
+        self.assertEqual(4, items[0].quantity)
+        self.assertEqual(self.total(self.items), self.total(items))
+
+    def test_rolls_extra_lines_into_one_line(self):
+        items = gateway.compact_line_items(self.items, max_items=2)
+        self.assertEqual(2, len(items))
+        self.assertEqual(1, items[1].quantity)
+        self.assertEqual(D('11.66'), items[1].amount)
+        self.assertEqual(self.total(self.items), self.total(items))
+        self.assertEqual('5 other items and discounts', items[1].name)
+
+    def test_names_a_line_of_only_discounts(self):
+        items = gateway.compact_line_items(
+            self.items + [self.items[-1]], merge=True, max_items=3)
+        self.assertEqual(3, len(items))
+        self.assertEqual('Other discounts', items[2].name)
+        self.assertEqual(D('-2.00'), items[2].amount)
+
+
+class ParallelPaymentTests(TestCase):
+
+    def create_line(self, pk, price, discounted_price):
+        line = Mock()
+        line.product.pk = pk
+        line.product.title = 'Product %d' % pk
+        line.product.upc = ''
+        line.product.description = ''
+        line.unit_price_incl_tax = price
+        line.line_price_incl_tax_incl_discounts = discounted_price
+        line.quantity = 1
+        return line
+
+    def set_txn(self, sellers, methods=None, shipping_discounts=()):
+        basket = create_mock_basket(D('25.00'))
+        basket.id = 1
+        basket.all_lines = Mock(return_value=[
+            line for __, lines in sellers for line in lines])
+        basket.shipping_discounts = list(shipping_discounts)
+        with patch('paypal.express.gateway.group_lines_by_seller',
+                   return_value=sellers):
+            with patch('paypal.express.gateway._fetch_response') as fetch:
+                gateway.set_txn(basket, methods or [Free()], 'GBP',
+                                'http://example.com', 'http://example.com',
+                                parallel=True)
+        return fetch.call_args[0][1]
+
+    def test_takes_a_payment_for_each_seller(self):
+        params = self.set_txn([
+            ('a@example.com', [self.create_line(1, D('10.00'), D('10.00'))]),
+            ('b@example.com', [self.create_line(2, D('20.00'), D('15.00'))]),
+        ])
+        self.assertEqual(D('10.00'), params['PAYMENTREQUEST_0_AMT'])
+        self.assertEqual('a@example.com',
+                         params['PAYMENTREQUEST_0_SELLERPAYPALACCOUNTID'])
+        self.assertEqual(D('15.00'), params['PAYMENTREQUEST_1_AMT'])
+        self.assertEqual('1-1', params['PAYMENTREQUEST_1_PAYMENTREQUESTID'])
+        # The seller's discount is a separate line
+        self.assertEqual(D('-5.00'), params['L_PAYMENTREQUEST_1_AMT1'])
+
+    def test_shipping_discounts_are_taken_off_the_first_payment(self):
+        params = self.set_txn([
+            ('a@example.com', [self.create_line(1, D('10.00'), D('10.00'))]),
+            ('b@example.com', [self.create_line(2, D('15.00'), D('15.00'))]),
+        ], methods=[FixedPrice(D('5.00'), D('5.00'))],
+            shipping_discounts=[{'name': 'Cheap shipping',
+                                 'discount': D('2.00')}])
+        self.assertEqual(D('3.00'), params['PAYMENTREQUEST_0_SHIPPINGAMT'])
+        self.assertEqual(D('13.00'), params['PAYMENTREQUEST_0_AMT'])
+        self.assertEqual(D('15.00'), params['PAYMENTREQUEST_1_AMT'])
+
+    def test_single_seller_basket_is_one_payment(self):
+        params = self.set_txn([
+            ('a@example.com', [self.create_line(1, D('25.00'), D('25.00'))]),
+        ])
+        self.assertFalse('PAYMENTREQUEST_0_SELLERPAYPALACCOUNTID' in params)
+        self.assertFalse('PAYMENTREQUEST_1_AMT' in params)
+
+    def test_confirms_each_payment(self):
+        payments = [
+            gateway.Payment(D('10.00'), 'GBP', 'a@example.com', '1-0'),
+            gateway.Payment(D('15.00'), 'GBP', 'b@example.com', '1-1'),
+        ]
+        with patch('paypal.express.gateway._fetch_response') as fetch:
+            gateway.do_txn('PAYER', 'EC-1', D('25.00'), 'GBP',
+                           payments=payments)
+        params = fetch.call_args[0][1]
+        self.assertEqual(D('15.00'), params['PAYMENTREQUEST_1_AMT'])
+        self.assertEqual('b@example.com',
+                         params['PAYMENTREQUEST_1_SELLERPAYPALACCOUNTID'])
+
+    def post(self, response):
+        pairs = dict(parse_qsl(response), _raw_request='',
+                     _raw_response=response, _response_time=0)
+        return patch('paypal.gateway.post', return_value=pairs)
+
+    def test_records_the_total_of_all_payments_on_set_up(self):
+        basket = create_mock_basket(D('25.00'))
+        basket.id = 1
+        sellers = [
+            ('a@example.com', [self.create_line(1, D('10.00'), D('10.00'))]),
+            ('b@example.com', [self.create_line(2, D('15.00'), D('15.00'))]),
+        ]
+        with patch('paypal.express.gateway.group_lines_by_seller',
+                   return_value=sellers):
+            with self.post('ACK=Success&TOKEN=EC-1'):
+                gateway.set_txn(basket, [Free()], 'GBP',
+                                'http://example.com', 'http://example.com',
+                                parallel=True)
+        txn = Transaction.objects.get(method='SetExpressCheckout')
+        self.assertEqual(D('25.00'), txn.amount)
+
+    def test_records_each_payment_in_the_ledger(self):
+        payments = [
+            gateway.Payment(D('10.00'), 'GBP', 'a@example.com', '1-0'),
+            gateway.Payment(D('15.00'), 'GBP', 'b@example.com', '1-1'),
+        ]
+        with self.post('ACK=Success'
+                       '&PAYMENTINFO_0_TRANSACTIONID=TXN-1'
+                       '&PAYMENTINFO_0_AMT=10.00'
+                       '&PAYMENTINFO_0_CURRENCYCODE=GBP'
+                       '&PAYMENTINFO_1_TRANSACTIONID=TXN-2'
+                       '&PAYMENTINFO_1_AMT=15.00'
+                       '&PAYMENTINFO_1_CURRENCYCODE=GBP'):
+            gateway.do_txn('PAYER', 'EC-1', D('25.00'), 'GBP',
+                           order_number='100001', payments=payments)
+        entries = LedgerEntry.objects.filter(
+            operation='DoExpressCheckoutPayment').order_by('transaction_id')
+        self.assertEqual([('TXN-1', D('10.00')), ('TXN-2', D('15.00'))],
+                         [(e.transaction_id, e.amount) for e in entries])
+
+
+def create_search_page(timestamps, truncated=False):
+    pairs = {'ACK': 'SuccessWithWarning' if truncated else 'Success'}
+    if truncated:
+        pairs['L_ERRORCODE0'] = gateway.SEARCH_TRUNCATED
+    for i, (txn_id, timestamp) in enumerate(timestamps):
+        pairs['L_TRANSACTIONID%d' % i] = txn_id
+        pairs['L_TIMESTAMP%d' % i] = timestamp
+    return pairs
+
+
+class SearchTransactionsTests(TestCase):
+
+    def search(self, pages):
+        with patch('paypal.gateway.post', side_effect=pages):
+            return list(gateway.search_transactions(
+                datetime.datetime(2014, 5, 1),
+                datetime.datetime(2014, 5, 2)))
+
+    def test_repeats_truncated_searches(self):
+        results = self.search([
+            create_search_page([('3', '2014-05-01T12:00:02Z'),
+                                ('2', '2014-05-01T12:00:01Z')],
+                               truncated=True),
+            create_search_page([('2', '2014-05-01T12:00:01Z'),
+                                ('1', '2014-05-01T12:00:00Z')])])
+        self.assertEqual(['3', '2', '1'],
+                         [result.transaction_id for result in results])
+
+    def test_raises_if_a_truncated_page_has_one_timestamp(self):
+        with self.assertRaises(exceptions.PayPalError):
+            self.search([
+                create_search_page([('2', '2014-05-01T12:00:00Z'),
+                                    ('1', '2014-05-01T12:00:00Z')],
+                                   truncated=True)])
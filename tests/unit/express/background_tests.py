@@ -0,0 +1,59 @@
+from __future__ import unicode_literals
+from decimal import Decimal as D
+
+from django.test import TestCase
+from mock import patch
+
+from paypal.exceptions import PayPalError
+from paypal.express import background
+from paypal.express.models import ExpressTransaction, PendingPayment
+
+
+@patch('paypal.express.background.connection')
+class TestTakePayment(TestCase):
+
+    def setUp(self):
+        self.payment = PendingPayment.objects.create(
+            token='EC-8P797793UC466090M', payer_id='12345', basket_id=1,
+            order_number='100001', amount=D('6.99'), currency='GBP')
+
+    def take_payment(self, **kwargs):
+        with patch('paypal.express.background.confirm_transaction',
+                   **kwargs):
+            background.take_payment(self.payment.pk)
+        return PendingPayment.objects.get(pk=self.payment.pk)
+
+    def test_successful_payment_is_complete(self, connection):
+        txn = ExpressTransaction.objects.create(
+            method='DoExpressCheckoutPayment', version='119', ack='Success',
+            raw_request='', raw_response='', response_time=0)
+        payment = self.take_payment(return_value=txn)
+        self.assertEqual(PendingPayment.COMPLETE, payment.status)
+        self.assertEqual(txn, payment.txn)
+
+    def test_payment_is_taken_with_idempotency_key(self, connection):
+        with patch('paypal.express.background.confirm_transaction',
+                   side_effect=PayPalError) as confirm:
+            background.take_payment(self.payment.pk)
+        self.assertEqual('paypal-pending-%d' % self.payment.pk,
+                         confirm.call_args[1]['msg_sub_id'])
+
+    def test_payment_that_is_not_pending_is_left_alone(self, connection):
+        PendingPayment.objects.filter(pk=self.payment.pk).update(
+            status=PendingPayment.PLACED)
+        with patch('paypal.express.background.confirm_transaction') as confirm:
+            background.take_payment(self.payment.pk)
+        self.assertFalse(confirm.called)
+        self.assertEqual(PendingPayment.PLACED, PendingPayment.objects.get(
+            pk=self.payment.pk).status)
+
+    def test_paypal_error_fails_payment(self, connection):
+        payment = self.take_payment(side_effect=PayPalError)
+        self.assertEqual(PendingPayment.FAILED, payment.status)
+
+    def test_completed_payment_can_only_be_claimed_once(self, connection):
+        self.payment.status = PendingPayment.COMPLETE
+        self.payment.save()
+        self.assertTrue(self.payment.claim())
+        self.assertFalse(PendingPayment.objects.get(
+            pk=self.payment.pk).claim())
@@ -0,0 +1,91 @@
+from __future__ import unicode_literals
+from decimal import Decimal as D
+
+from django.test import TestCase
+from mock import patch
+
+from paypal.express import bulk
+from paypal.express.models import ExpressTransaction
+from paypal.ledger.models import LedgerEntry
+
+
+class TestBulkCapture(TestCase):
+
+    def setUp(self):
+        self.txn = ExpressTransaction.objects.create(
+            method='DoExpressCheckoutPayment', version='119', ack='Success',
+            token='EC-1', amount=D('10.00'), currency='GBP',
+            raw_request='', response_time=0,
+            raw_response='ACK=Success&PAYMENTINFO_0_TRANSACTIONID=AUTH-1'
+                         '&PAYMENTINFO_0_AMT=10.00'
+                         '&PAYMENTINFO_0_CURRENCYCODE=GBP')
+        LedgerEntry.objects.record(
+            gateway=LedgerEntry.EXPRESS,
+            operation='DoExpressCheckoutPayment', audit_txn=self.txn,
+            order_number='100001', reference='EC-1',
+            transaction_id='AUTH-1', is_successful=True)
+
+    def capture(self, **kwargs):
+        def do_capture(txn_id, amount, currency, note=None, commit=True):
+            txn = ExpressTransaction(
+                method='DoCapture', version='119', ack='Success',
+                amount=amount, currency=currency, raw_request='',
+                raw_response='ACK=Success', response_time=0,
+                correlation_id='CORRELATION-%s' % txn_id)
+            txn.request_params = {'AUTHORIZATIONID': txn_id}
+            return txn
+        with patch('paypal.express.bulk.do_capture',
+                   side_effect=do_capture) as mock_capture:
+            results = list(bulk.capture_authorizations(workers=2, **kwargs))
+        return results, mock_capture
+
+    def test_captures_authorizations_by_order_number(self):
+        results, __ = self.capture(order_numbers=['100001'])
+        self.assertEqual('AUTH-1', results[0].item.authorization_id)
+        self.assertTrue(results[0].result.pk)
+        self.assertEqual(1, LedgerEntry.objects.filter(
+            operation='DoCapture', order_number='100001').count())
+
+    def test_captured_authorizations_are_skipped(self):
+        self.capture(tokens=['EC-1'])
+        results, mock_capture = self.capture(tokens=['EC-1'])
+        self.assertFalse(mock_capture.called)
+        self.assertIsNone(results[0].result)
+        self.assertIsNone(results[0].error)
+
+    def test_missing_authorizations_are_reported(self):
+        results, __ = self.capture(tokens=['EC-2'])
+        self.assertTrue(results[0].error)
+
+    def test_reauthorized_payments_are_captured_with_the_new_id(self):
+        reauthorization = ExpressTransaction.objects.create(
+            method='DoReauthorization', version='119', ack='Success',
+            amount=D('10.00'), currency='GBP', transaction_id='AUTH-2',
+            raw_request='', raw_response='ACK=Success', response_time=0)
+        LedgerEntry.objects.record(
+            gateway=LedgerEntry.EXPRESS, operation='DoReauthorization',
+            audit_txn=reauthorization, transaction_id='AUTH-1',
+            is_successful=True)
+        results, mock_capture = self.capture(tokens=['EC-1'])
+        self.assertEqual('AUTH-2', mock_capture.call_args[0][0])
+        self.assertEqual('AUTH-2', results[0].item.authorization_id)
+
+    def test_each_payment_of_a_parallel_checkout_is_captured(self):
+        ExpressTransaction.objects.create(
+            method='DoExpressCheckoutPayment', version='119', ack='Success',
+            token='EC-2', amount=D('10.00'), currency='GBP',
+            raw_request='', response_time=0,
+            raw_response='ACK=Success&PAYMENTINFO_0_TRANSACTIONID=AUTH-3'
+                         '&PAYMENTINFO_0_AMT=4.00'
+                         '&PAYMENTINFO_1_TRANSACTIONID=AUTH-4'
+                         '&PAYMENTINFO_1_AMT=6.00')
+        results, mock_capture = self.capture(tokens=['EC-2'])
+        self.assertEqual(
+            [('AUTH-3', D('4.00')), ('AUTH-4', D('6.00'))],
+            sorted(call[0][:2] for call in mock_capture.call_args_list))
+
+    def test_repeated_tokens_are_captured_once(self):
+        results, mock_capture = self.capture(tokens=['EC-1', 'EC-1'],
+                                             order_numbers=['100001'])
+        self.assertEqual(1, mock_capture.call_count)
+        self.assertEqual(1, len([r for r in results if r.result]))
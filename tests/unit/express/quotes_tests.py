@@ -0,0 +1,72 @@
+from __future__ import unicode_literals
+from decimal import Decimal as D
+
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from paypal.express import quotes
+
+
+class TestAddressNormalisation(TestCase):
+
+    def test_trivially_different_addresses_are_equal(self):
+        self.assertEqual(
+            quotes.normalise_address('gb', 'London ', 'n12 9et', 'London'),
+            quotes.normalise_address('GB', 'london', 'N129ET', ' LONDON'))
+
+    def test_missing_fields_are_allowed(self):
+        self.assertEqual(('GB', '', '', ''),
+                         quotes.normalise_address(country_code='GB'))
+
+
+class TestDeadline(TestCase):
+
+    @override_settings(PAYPAL_CALLBACK_TIMEOUT=3, PAYPAL_CALLBACK_MARGIN=1)
+    def test_leaves_margin_before_timeout(self):
+        self.assertEqual(102, quotes.get_deadline(start_time=100))
+
+    @override_settings(PAYPAL_CALLBACK_TIMEOUT=1, PAYPAL_CALLBACK_MARGIN=2)
+    def test_is_never_before_start(self):
+        self.assertEqual(100, quotes.get_deadline(start_time=100))
+
+
+class TestQuoteCache(TestCase):
+
+    def test_quotes_are_cached_per_address(self):
+        address = quotes.normalise_address('GB', '', 'N12 9ET', 'London')
+        quotes.set_quotes(1, 'abc', address, [('Standard', D('4.99'))])
+        self.assertEqual([('Standard', D('4.99'))],
+                         quotes.get_quotes(1, 'abc', address))
+        self.assertIsNone(quotes.get_quotes(
+            1, 'abc', quotes.normalise_address('US')))
+
+    def test_latest_quotes_become_the_default_for_the_country(self):
+        address = quotes.normalise_address('GB', postcode='N12 9ET')
+        quotes.set_quotes(2, 'abc', address, [('Standard', D('4.99'))])
+        self.assertEqual([('Standard', D('4.99'))],
+                         quotes.get_default_quotes(
+                             2, 'abc', quotes.normalise_address('GB')))
+        self.assertIsNone(quotes.get_default_quotes(
+            2, 'abc', quotes.normalise_address('US')))
+
+    def test_falls_back_to_the_default_shipping_method(self):
+        quotes.set_default_quotes(3, 'abc', [('Standard', D('4.99'))])
+        self.assertEqual([('Standard', D('4.99'))],
+                         quotes.get_default_quotes(
+                             3, 'abc', quotes.normalise_address('US')))
+
+    def test_partial_quotes_are_kept_apart(self):
+        address = quotes.normalise_address('GB', postcode='N12 9ET')
+        quotes.set_partial_quotes(4, 'abc', address,
+                                  [('Standard', D('4.99'))])
+        self.assertEqual([('Standard', D('4.99'))],
+                         quotes.get_partial_quotes(4, 'abc', address))
+        self.assertIsNone(quotes.get_quotes(4, 'abc', address))
+        self.assertIsNone(quotes.get_default_quotes(4, 'abc', address))
+
+    def test_defaults_only_fill_in_missing_methods(self):
+        merged = quotes.merge_quotes(
+            [('Standard', D('4.99'))],
+            [('Standard', D('5.99')), ('Express', D('9.99'))])
+        self.assertEqual([('Standard', D('4.99')), ('Express', D('9.99'))],
+                         merged)
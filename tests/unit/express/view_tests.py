@@ -1,11 +1,15 @@
 from __future__ import unicode_literals
+import datetime
 import random
 
 from decimal import Decimal as D
 
+from django.core.cache import cache
 from django.test import TestCase
 from django.test.client import Client
+from django.test.utils import override_settings
 from django.core.urlresolvers import reverse, NoReverseMatch
+from django.utils import timezone
 from mock import patch, Mock
 
 from oscar.apps.order.models import Order
@@ -14,6 +18,9 @@ from oscar.core.loading import get_classes
 
 from purl import URL
 
+from paypal.express import prefetch, snapshot
+from paypal.express.models import PendingPayment
+
 
 Partner, StockRecord = get_classes('partner.models', ('Partner',
                                                       'StockRecord'))
@@ -60,6 +67,9 @@ def create_product(price=None, title="Dummy title",
     return item
 
 
+GET_RESPONSE = 'TOKEN=EC%2d6WY34243AN3588740&CHECKOUTSTATUS=PaymentActionCompleted&TIMESTAMP=2012%2d04%2d19T10%3a07%3a46Z&CORRELATIONID=7e9c5efbda3c0&ACK=Success&VERSION=88%2e0&BUILD=2808426&EMAIL=david%2e_1332854868_per%40gmail%2ecom&PAYERID=7ZTRBDFYYA47W&PAYERSTATUS=verified&FIRSTNAME=David&LASTNAME=Winterbottom&COUNTRYCODE=GB&SHIPTONAME=David%20Winterbottom&SHIPTOSTREET=1%20Main%20Terrace&SHIPTOSTREET2=line2&SHIPTOCITY=Wolverhampton&SHIPTOSTATE=West%20Midlands&SHIPTOZIP=W12%204LQ&SHIPTOCOUNTRYCODE=GB&SHIPTOCOUNTRYNAME=United%20Kingdom&ADDRESSSTATUS=Confirmed&CURRENCYCODE=GBP&AMT=33%2e98&SHIPPINGAMT=0%2e00&HANDLINGAMT=0%2e00&TAXAMT=0%2e00&INSURANCEAMT=0%2e00&SHIPDISCAMT=0%2e00&PAYMENTREQUEST_0_CURRENCYCODE=GBP&PAYMENTREQUEST_0_AMT=33%2e98&PAYMENTREQUEST_0_SHIPPINGAMT=0%2e00&PAYMENTREQUEST_0_HANDLINGAMT=0%2e00&PAYMENTREQUEST_0_TAXAMT=0%2e00&PAYMENTREQUEST_0_INSURANCEAMT=0%2e00&PAYMENTREQUEST_0_SHIPDISCAMT=0%2e00&PAYMENTREQUEST_0_TRANSACTIONID=51963679RW630412N&PAYMENTREQUEST_0_INSURANCEOPTIONOFFERED=false&PAYMENTREQUEST_0_SHIPTONAME=David%20Winterbottom&PAYMENTREQUEST_0_SHIPTOSTREET=1%20Main%20Terrace&PAYMENTREQUEST_0_SHIPTOSTREET2=line2&PAYMENTREQUEST_0_SHIPTOCITY=Wolverhampton&PAYMENTREQUEST_0_SHIPTOSTATE=West%20Midlands&PAYMENTREQUEST_0_SHIPTOZIP=W12%204LQ&PAYMENTREQUEST_0_SHIPTOCOUNTRYCODE=GB&PAYMENTREQUEST_0_SHIPTOCOUNTRYNAME=United%20Kingdom&PAYMENTREQUESTINFO_0_TRANSACTIONID=51963679RW630412N&PAYMENTREQUESTINFO_0_ERRORCODE=0'
+
+
 class MockedPayPalTests(TestCase):
     fixtures = ['countries.json']
     response_body = None
@@ -152,6 +162,85 @@ class RedirectToPayPalTests(MockedPayPalTests):
         self.assertTrue(self.url.has_query_params(params))
 
 
+@override_settings(PAYPAL_PREFETCH_TOKEN=True)
+class PrefetchTokenTests(MockedPayPalTests):
+    response_body = RedirectToPayPalTests.response_body
+
+    def perform_action(self):
+        self.add_product_to_basket()
+        self.client.post(reverse('paypal-prefetch'))
+
+    def tearDown(self):
+        cache.clear()
+
+    def test_redirect_uses_prefetched_token(self):
+        with patch('requests.post') as post:
+            response = self.client.get(reverse('paypal-redirect'))
+        self.assertFalse(post.called)
+        url = URL.from_string(response['Location'])
+        self.assertEqual('www.sandbox.paypal.com', url.host())
+
+    def test_changing_basket_invalidates_prefetched_token(self):
+        self.add_product_to_basket()
+        with patch('requests.post') as post:
+            post.return_value = self.get_mock_response()
+            self.client.get(reverse('paypal-redirect'))
+        self.assertTrue(post.called)
+
+    def test_prefetched_token_is_only_claimed_once(self):
+        basket = Basket.objects.all()[0]
+        # Two requests that both read the URL before either deletes it
+        with patch.object(cache, 'delete'):
+            self.assertIsNotNone(prefetch.pop_url(basket))
+            self.assertIsNone(prefetch.pop_url(basket))
+
+
+class BasketSnapshotTests(MockedPayPalTests):
+    response_body = RedirectToPayPalTests.response_body
+
+    def perform_action(self):
+        self.add_product_to_basket(price=D('6.99'))
+        self.client.get(reverse('paypal-redirect'))
+        self.basket = Basket.objects.all()[0]
+
+    def tearDown(self):
+        cache.clear()
+
+    def get_preview(self):
+        url = reverse('paypal-success-response',
+                      kwargs={'basket_id': self.basket.id})
+        url = URL().path(url)\
+                   .query_param('PayerID', '12345')\
+                   .query_param('token', 'EC-8P797793UC466090M')
+        with patch('requests.post') as post:
+            post.return_value = self.get_mock_response(
+                PreviewOrderTests.response_body)
+            return self.client.get(str(url))
+
+    def test_offers_are_not_reapplied_on_preview(self):
+        with patch('paypal.express.views.Applicator') as applicator:
+            response = self.get_preview()
+        self.assertFalse(applicator.called)
+        self.assertEqual(D('6.99'),
+                         response.context['basket'].total_incl_tax)
+
+    def test_offers_are_reapplied_without_snapshot(self):
+        cache.clear()
+        with patch('paypal.express.views.Applicator') as applicator:
+            self.get_preview()
+        self.assertTrue(applicator.called)
+
+    def test_offers_are_reapplied_when_an_offer_is_unavailable(self):
+        # Eg the offer has reached its limit since the basket was frozen
+        key = snapshot._get_key(self.basket.id)
+        data = cache.get(key)
+        data['applications'] = [(-1, {'freq': 1, 'voucher': None})]
+        cache.set(key, data)
+        with patch('paypal.express.views.Applicator') as applicator:
+            self.get_preview()
+        self.assertTrue(applicator.called)
+
+
 class FailedTxnTests(MockedPayPalTests):
     response_body = 'TOKEN=EC%2d8P797793UC466090M&CHECKOUTSTATUS=PaymentActionNotInitiated&TIMESTAMP=2012%2d04%2d16T11%3a51%3a57Z&CORRELATIONID=ab8a263eb440&ACK=Failed&VERSION=60%2e0&BUILD=2808426&EMAIL=david%2e_1332854868_per%40gmail%2ecom&PAYERID=7ZTRBDFYYA47W&PAYERSTATUS=verified&FIRSTNAME=David&LASTNAME=Winterbottom&COUNTRYCODE=GB&SHIPTONAME=David%20Winterbottom&SHIPTOSTREET=1%20Main%20Terrace&SHIPTOCITY=Wolverhampton&SHIPTOSTATE=West%20Midlands&SHIPTOZIP=W12%204LQ&SHIPTOCOUNTRYCODE=GB&SHIPTOCOUNTRYNAME=United%20Kingdom&ADDRESSSTATUS=Confirmed&CURRENCYCODE=GBP&AMT=6%2e99&SHIPPINGAMT=0%2e00&HANDLINGAMT=0%2e00&TAXAMT=0%2e00&INSURANCEAMT=0%2e00&SHIPDISCAMT=0%2e00'
 
@@ -212,7 +301,7 @@ class SubmitOrderTests(MockedPayPalTests):
         self.order = Order.objects.all()[0]
 
     def patch_http_post(self, post):
-        get_response = 'TOKEN=EC%2d6WY34243AN3588740&CHECKOUTSTATUS=PaymentActionCompleted&TIMESTAMP=2012%2d04%2d19T10%3a07%3a46Z&CORRELATIONID=7e9c5efbda3c0&ACK=Success&VERSION=88%2e0&BUILD=2808426&EMAIL=david%2e_1332854868_per%40gmail%2ecom&PAYERID=7ZTRBDFYYA47W&PAYERSTATUS=verified&FIRSTNAME=David&LASTNAME=Winterbottom&COUNTRYCODE=GB&SHIPTONAME=David%20Winterbottom&SHIPTOSTREET=1%20Main%20Terrace&SHIPTOSTREET2=line2&SHIPTOCITY=Wolverhampton&SHIPTOSTATE=West%20Midlands&SHIPTOZIP=W12%204LQ&SHIPTOCOUNTRYCODE=GB&SHIPTOCOUNTRYNAME=United%20Kingdom&ADDRESSSTATUS=Confirmed&CURRENCYCODE=GBP&AMT=33%2e98&SHIPPINGAMT=0%2e00&HANDLINGAMT=0%2e00&TAXAMT=0%2e00&INSURANCEAMT=0%2e00&SHIPDISCAMT=0%2e00&PAYMENTREQUEST_0_CURRENCYCODE=GBP&PAYMENTREQUEST_0_AMT=33%2e98&PAYMENTREQUEST_0_SHIPPINGAMT=0%2e00&PAYMENTREQUEST_0_HANDLINGAMT=0%2e00&PAYMENTREQUEST_0_TAXAMT=0%2e00&PAYMENTREQUEST_0_INSURANCEAMT=0%2e00&PAYMENTREQUEST_0_SHIPDISCAMT=0%2e00&PAYMENTREQUEST_0_TRANSACTIONID=51963679RW630412N&PAYMENTREQUEST_0_INSURANCEOPTIONOFFERED=false&PAYMENTREQUEST_0_SHIPTONAME=David%20Winterbottom&PAYMENTREQUEST_0_SHIPTOSTREET=1%20Main%20Terrace&PAYMENTREQUEST_0_SHIPTOSTREET2=line2&PAYMENTREQUEST_0_SHIPTOCITY=Wolverhampton&PAYMENTREQUEST_0_SHIPTOSTATE=West%20Midlands&PAYMENTREQUEST_0_SHIPTOZIP=W12%204LQ&PAYMENTREQUEST_0_SHIPTOCOUNTRYCODE=GB&PAYMENTREQUEST_0_SHIPTOCOUNTRYNAME=United%20Kingdom&PAYMENTREQUESTINFO_0_TRANSACTIONID=51963679RW630412N&PAYMENTREQUESTINFO_0_ERRORCODE=0'
+        get_response = GET_RESPONSE
         do_response = 'TOKEN=EC%2d6WY34243AN3588740&SUCCESSPAGEREDIRECTREQUESTED=false&TIMESTAMP=2012%2d04%2d19T10%3a07%3a47Z&CORRELATIONID=3db1d5276ddfd&ACK=Success&VERSION=88%2e0&BUILD=2808426&INSURANCEOPTIONSELECTED=false&SHIPPINGOPTIONISDEFAULT=false&PAYMENTINFO_0_TRANSACTIONID=51963679RW630412N&PAYMENTINFO_0_TRANSACTIONTYPE=expresscheckout&PAYMENTINFO_0_PAYMENTTYPE=instant&PAYMENTINFO_0_ORDERTIME=2012%2d04%2d19T09%3a42%3a50Z&PAYMENTINFO_0_AMT=33%2e98&PAYMENTINFO_0_FEEAMT=1%2e36&PAYMENTINFO_0_TAXAMT=0%2e00&PAYMENTINFO_0_CURRENCYCODE=GBP&PAYMENTINFO_0_PAYMENTSTATUS=Pending&PAYMENTINFO_0_PENDINGREASON=paymentreview&PAYMENTINFO_0_REASONCODE=None&PAYMENTINFO_0_PROTECTIONELIGIBILITY=Ineligible&PAYMENTINFO_0_PROTECTIONELIGIBILITYTYPE=None&PAYMENTINFO_0_SECUREMERCHANTACCOUNTID=YYH7BB4UHPKC4&PAYMENTINFO_0_ERRORCODE=0&PAYMENTINFO_0_ACK=Success'
 
         def side_effect(url, payload, **kwargs):
@@ -248,7 +337,7 @@ class SubmitOrderErrorsTests(MockedPayPalTests):
                   'token': 'EC-8P797793UC466090M'})
 
     def patch_http_post(self, post):
-        get_response = 'TOKEN=EC%2d6WY34243AN3588740&CHECKOUTSTATUS=PaymentActionCompleted&TIMESTAMP=2012%2d04%2d19T10%3a07%3a46Z&CORRELATIONID=7e9c5efbda3c0&ACK=Success&VERSION=88%2e0&BUILD=2808426&EMAIL=david%2e_1332854868_per%40gmail%2ecom&PAYERID=7ZTRBDFYYA47W&PAYERSTATUS=verified&FIRSTNAME=David&LASTNAME=Winterbottom&COUNTRYCODE=GB&SHIPTONAME=David%20Winterbottom&SHIPTOSTREET=1%20Main%20Terrace&SHIPTOSTREET2=line2&SHIPTOCITY=Wolverhampton&SHIPTOSTATE=West%20Midlands&SHIPTOZIP=W12%204LQ&SHIPTOCOUNTRYCODE=GB&SHIPTOCOUNTRYNAME=United%20Kingdom&ADDRESSSTATUS=Confirmed&CURRENCYCODE=GBP&AMT=33%2e98&SHIPPINGAMT=0%2e00&HANDLINGAMT=0%2e00&TAXAMT=0%2e00&INSURANCEAMT=0%2e00&SHIPDISCAMT=0%2e00&PAYMENTREQUEST_0_CURRENCYCODE=GBP&PAYMENTREQUEST_0_AMT=33%2e98&PAYMENTREQUEST_0_SHIPPINGAMT=0%2e00&PAYMENTREQUEST_0_HANDLINGAMT=0%2e00&PAYMENTREQUEST_0_TAXAMT=0%2e00&PAYMENTREQUEST_0_INSURANCEAMT=0%2e00&PAYMENTREQUEST_0_SHIPDISCAMT=0%2e00&PAYMENTREQUEST_0_TRANSACTIONID=51963679RW630412N&PAYMENTREQUEST_0_INSURANCEOPTIONOFFERED=false&PAYMENTREQUEST_0_SHIPTONAME=David%20Winterbottom&PAYMENTREQUEST_0_SHIPTOSTREET=1%20Main%20Terrace&PAYMENTREQUEST_0_SHIPTOSTREET2=line2&PAYMENTREQUEST_0_SHIPTOCITY=Wolverhampton&PAYMENTREQUEST_0_SHIPTOSTATE=West%20Midlands&PAYMENTREQUEST_0_SHIPTOZIP=W12%204LQ&PAYMENTREQUEST_0_SHIPTOCOUNTRYCODE=GB&PAYMENTREQUEST_0_SHIPTOCOUNTRYNAME=United%20Kingdom&PAYMENTREQUESTINFO_0_TRANSACTIONID=51963679RW630412N&PAYMENTREQUESTINFO_0_ERRORCODE=0'
+        get_response = GET_RESPONSE
         error_response = 'Error'
         def side_effect(url, payload, **kwargs):
             if 'GetExpressCheckoutDetails' in payload:
@@ -264,3 +353,69 @@ class SubmitOrderErrorsTests(MockedPayPalTests):
         self.assertEqual(error, "A problem occurred while processing payment for this "
                       "order - no payment has been taken.  Please "
                       "contact customer services if this problem persists")
+
+
+@override_settings(PAYPAL_ASYNC_PAYMENT=True)
+class DeferredPaymentTests(MockedPayPalTests):
+    token = 'EC-8P797793UC466090M'
+
+    def perform_action(self):
+        self.add_product_to_basket(price=D('6.99'))
+        self.basket = Basket.objects.all()[0]
+        self.basket.freeze()
+
+    def patch_http_post(self, post):
+        post.return_value = self.get_mock_response(GET_RESPONSE)
+
+    def place_order(self):
+        url = reverse('paypal-place-order',
+                      kwargs={'basket_id': self.basket.id})
+        with patch('requests.post') as post:
+            self.patch_http_post(post)
+            return self.client.post(url, {'action': 'place_order',
+                                          'payer_id': '12345',
+                                          'token': self.token})
+
+    def get_status(self):
+        return self.client.get(
+            reverse('paypal-payment-status',
+                    kwargs={'basket_id': self.basket.id}),
+            {'token': self.token, 'PayerID': '12345'})
+
+    def create_payment(self, status=PendingPayment.PENDING):
+        return PendingPayment.objects.create(
+            token=self.token, payer_id='12345', basket_id=self.basket.id,
+            order_number='100001', amount=D('6.99'), currency='GBP',
+            status=status)
+
+    @patch('paypal.express.background.confirm_payment')
+    def test_payment_is_queued_and_customer_sent_to_status_page(
+            self, confirm_payment):
+        response = self.place_order()
+        payment = PendingPayment.objects.get()
+        confirm_payment.assert_called_once_with(payment)
+        self.assertTrue(reverse('paypal-payment-status', kwargs={
+            'basket_id': self.basket.id}) in response['Location'])
+
+    @patch('paypal.express.background.confirm_payment')
+    def test_repeated_submission_takes_payment_once(self, confirm_payment):
+        self.place_order()
+        self.place_order()
+        self.assertEqual(1, PendingPayment.objects.count())
+        self.assertEqual(1, confirm_payment.call_count)
+
+    def test_status_page_shows_latest_payment_that_has_not_failed(self):
+        self.create_payment()
+        self.create_payment(status=PendingPayment.FAILED)
+        response = self.get_status()
+        self.assertEqual(PendingPayment.PENDING,
+                         response.context['payment'].status)
+
+    @patch('paypal.express.background._queue')
+    def test_stale_payment_is_queued_again(self, queue):
+        payment = self.create_payment()
+        PendingPayment.objects.filter(pk=payment.pk).update(
+            date_updated=timezone.now() - datetime.timedelta(minutes=5))
+        self.get_status()
+        self.get_status()
+        queue.assert_called_once_with(payment.pk)
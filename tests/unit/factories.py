@@ -0,0 +1,38 @@
+from __future__ import unicode_literals
+from decimal import Decimal as D
+import datetime
+
+from django.utils import timezone
+
+from paypal.express.models import ExpressTransaction
+from paypal.payflow import codes
+from paypal.payflow.models import PayflowTransaction
+
+
+def _set_days_ago(txn, days_ago):
+    # date_created is set automatically so has to be changed afterwards
+    txn.date_created = timezone.now() - datetime.timedelta(days=days_ago)
+    type(txn).objects.filter(pk=txn.pk).update(date_created=txn.date_created)
+
+
+def create_express_txn(token=None, method='DoExpressCheckoutPayment',
+                       transaction_id=None, amount=D('10.00'), currency='GBP',
+                       ack='Success', raw_response='', days_ago=None):
+    txn = ExpressTransaction.objects.create(
+        method=method, version='119', ack=ack, token=token,
+        transaction_id=transaction_id, amount=amount, currency=currency,
+        raw_request='', raw_response=raw_response, response_time=0)
+    if days_ago is not None:
+        _set_days_ago(txn, days_ago)
+    return txn
+
+
+def create_payflow_txn(comment1, trxtype=codes.AUTHORIZATION, pnref=None,
+                       amount=D('10.00'), result='0', days_ago=None):
+    txn = PayflowTransaction.objects.create(
+        comment1=comment1, trxtype=trxtype, amount=amount,
+        pnref=pnref or 'PNREF-%s' % comment1, result=result,
+        respmsg='Approved', raw_request='', raw_response='', response_time=0)
+    if days_ago is not None:
+        _set_days_ago(txn, days_ago)
+    return txn
@@ -2,7 +2,7 @@ from __future__ import unicode_literals
 from django.test import TestCase
 import mock
 
-from paypal.gateway import post
+from paypal.gateway import post, redact
 
 # Fixtures
 ERROR_RESPONSE = 'RESULT=126&PNREF=V25A2BB645A7&RESPMSG=Under review by Fraud Service&AUTHCODE=525PNI&PREFPSMSG=Review: More than one rule was triggered for Review&POSTFPSMSG=Review'
@@ -38,3 +38,37 @@ class TestErrorResponse(TestCase):
                     '_response_time']
         for key in expected:
             self.assertTrue(key in self.pairs)
+
+
+class TestRedaction(TestCase):
+
+    def test_credentials_are_masked(self):
+        pairs = dict(redact({'PWD': 'not-numeric!', 'SIGNATURE': 'abc',
+                             'USER': 'merchant'}))
+        self.assertEqual('XXXXXX', pairs['PWD'])
+        self.assertEqual('XXXXXX', pairs['SIGNATURE'])
+        self.assertEqual('merchant', pairs['USER'])
+
+    def test_card_number_keeps_last_four_digits(self):
+        pairs = dict(redact([('ACCT', '5555555555554444'), ('CVV2', '123'),
+                             ('EXPDATE', '0113')]))
+        self.assertEqual('XXXXXXXXXXXX4444', pairs['ACCT'])
+        self.assertEqual('XXXXXX', pairs['CVV2'])
+        self.assertEqual('XXXXXX', pairs['EXPDATE'])
+
+    def test_adaptive_security_headers_are_masked(self):
+        pairs = dict(redact({'X-PAYPAL-SECURITY-PASSWORD': 'secret',
+                             'X-PAYPAL-SECURITY-USERID': 'merchant'}))
+        self.assertEqual('XXXXXX', pairs['X-PAYPAL-SECURITY-PASSWORD'])
+        self.assertEqual('merchant', pairs['X-PAYPAL-SECURITY-USERID'])
+
+    def test_raw_request_is_redacted(self):
+        with mock.patch('requests.post') as mock_post:
+            response = mock.Mock()
+            response.status_code = 200
+            response.content = response.text = ERROR_RESPONSE
+            mock_post.return_value = response
+            pairs = post('http://example.com', {'PWD': 'p4ss&word',
+                                                'USER': 'merchant'})
+        self.assertTrue('p4ss' not in pairs['_raw_request'])
+        self.assertTrue('p4ss' in mock_post.call_args[0][1])
@@ -0,0 +1,69 @@
+from __future__ import unicode_literals
+from decimal import Decimal as D
+
+from django.test import TestCase
+
+from paypal.ledger.models import LedgerEntry
+from paypal.express.models import ExpressTransaction
+
+
+class TestRecordingEntries(TestCase):
+
+    def setUp(self):
+        self.audit_txn = ExpressTransaction.objects.create(
+            raw_request='', raw_response='', response_time=0)
+
+    def record(self, operation, **kwargs):
+        return LedgerEntry.objects.record(
+            gateway=LedgerEntry.EXPRESS, operation=operation,
+            audit_txn=self.audit_txn, **kwargs)
+
+    def test_calls_before_the_order_is_placed_are_linked_once(self):
+        self.record('SetExpressCheckout', basket_id=10, reference='EC-1')
+        # Only the insert
+        with self.assertNumQueries(1):
+            self.record('GetExpressCheckoutDetails', reference='EC-1')
+        self.record('DoExpressCheckoutPayment', order_number='100001',
+                    basket_id=10, reference='EC-1', transaction_id='AUTH-1')
+        details = LedgerEntry.objects.get(
+            operation='GetExpressCheckoutDetails')
+        self.assertEqual('100001', details.order_number)
+        self.assertEqual(10, details.basket_id)
+
+    def test_order_number_is_linked_to_earlier_entries(self):
+        self.record('SetExpressCheckout', basket_id=10, reference='EC-1')
+        self.record('DoExpressCheckoutPayment', order_number='100001',
+                    reference='EC-1', transaction_id='AUTH-1',
+                    amount=D('10.00'))
+        entries = LedgerEntry.objects.for_order('100001')
+        self.assertEqual(2, entries.count())
+
+    def test_capture_is_linked_via_transaction_id(self):
+        self.record('DoExpressCheckoutPayment', order_number='100001',
+                    reference='EC-1', transaction_id='AUTH-1')
+        # One query for the earlier entry and the insert, without linking
+        # the order again
+        with self.assertNumQueries(2):
+            entry = self.record('DoCapture', transaction_id='AUTH-1')
+        self.assertEqual('100001', entry.order_number)
+        self.assertEqual('EC-1', entry.reference)
+
+    def test_batches_are_linked_in_the_same_way(self):
+        self.record('DoExpressCheckoutPayment', order_number='100001',
+                    reference='EC-1', transaction_id='AUTH-1')
+        self.record('SetExpressCheckout', basket_id=10, reference='EC-2')
+        # One query for the earlier entries, one insert and one update to
+        # link the order that was placed
+        with self.assertNumQueries(3):
+            LedgerEntry.objects.record_many([
+                dict(gateway=LedgerEntry.EXPRESS, operation='DoCapture',
+                     audit_txn=self.audit_txn, transaction_id='AUTH-1'),
+                dict(gateway=LedgerEntry.EXPRESS,
+                     operation='DoExpressCheckoutPayment',
+                     audit_txn=self.audit_txn, order_number='100002',
+                     reference='EC-2', transaction_id='TXN-2')])
+        capture = LedgerEntry.objects.get(operation='DoCapture')
+        self.assertEqual('100001', capture.order_number)
+        self.assertEqual('EC-1', capture.reference)
+        checkout = LedgerEntry.objects.get(operation='SetExpressCheckout')
+        self.assertEqual('100002', checkout.order_number)
@@ -0,0 +1,192 @@
+from __future__ import unicode_literals
+import datetime
+from decimal import Decimal as D
+
+from django.test import TestCase
+from django.utils import timezone
+from mock import patch
+
+from paypal import bulk
+from paypal.payflow import captures, codes, gateway
+from paypal.payflow.models import CaptureBalance, PayflowTransaction
+from tests.unit.factories import create_payflow_txn
+
+
+def fake_call(trxtype):
+    def call(order_number, pnref, amt, commit=True):
+        return PayflowTransaction(
+            comment1=order_number, trxtype=trxtype, amount=amt,
+            pnref='%s-%s-%s' % (trxtype, order_number, amt), result='0',
+            respmsg='Approved', raw_request='', raw_response='',
+            response_time=0)
+    return call
+
+
+class TestBalances(TestCase):
+
+    def test_are_built_from_history(self):
+        create_payflow_txn('100001', codes.AUTHORIZATION,
+                           'PNREF-1', D('100.00'))
+        create_payflow_txn('100001', codes.DELAYED_CAPTURE,
+                           'PNREF-2', D('30.00'))
+        create_payflow_txn('100001', codes.SALE, 'PNREF-3', D('20.00'))
+        create_payflow_txn('100001', codes.SALE,
+                           'PNREF-4', D('20.00'), result='12')
+        balance = captures.get_balances(['100001'])['100001']
+        self.assertEqual('PNREF-1', balance.pnref)
+        self.assertEqual(D('50.00'), balance.remaining)
+        self.assertEqual(2, balance.num_captures)
+
+    def test_are_updated_as_transactions_are_saved(self):
+        create_payflow_txn('100001', codes.AUTHORIZATION,
+                           'PNREF-1', D('100.00'))
+        captures.get_balances(['100001'])
+        gateway.save_transactions(
+            [fake_call(codes.DELAYED_CAPTURE)('100001', 'PNREF-1',
+                                              D('30.00'))])
+        balance = captures.get_balances(['100001'])['100001']
+        self.assertEqual(D('30.00'), balance.captured)
+        self.assertEqual(1, CaptureBalance.objects.count())
+
+    def test_are_not_duplicated_when_created_concurrently(self):
+        create_payflow_txn('100001', codes.AUTHORIZATION,
+                           'PNREF-1', D('100.00'))
+        create_payflow_txn('100002', codes.AUTHORIZATION,
+                           'PNREF-2', D('100.00'))
+        # Another process creates one of the balances first
+        CaptureBalance.objects.create(
+            order_number='100001', pnref='PNREF-1', authorized=D('100.00'))
+        captures._create_balances(['100001', '100002'])
+        self.assertEqual(2, CaptureBalance.objects.count())
+
+
+class TestPlanning(TestCase):
+
+    def setUp(self):
+        create_payflow_txn('100001', codes.AUTHORIZATION,
+                           'PNREF-1', D('100.00'))
+        self.balances = captures.get_balances(['100001', '100002'])
+
+    def test_first_capture_is_made_before_reference_sales(self):
+        planned, errors, deferred = captures.plan(
+            [('100001', D('40.00')), ('100001', D('60.00'))], self.balances)
+        self.assertEqual([codes.DELAYED_CAPTURE],
+                         [capture.trxtype for capture in planned])
+        self.assertEqual([('100001', D('60.00'))], deferred)
+        self.assertEqual([], errors)
+
+    def test_later_captures_are_reference_sales(self):
+        balance = self.balances['100001']
+        balance.captured, balance.num_captures = D('40.00'), 1
+        planned, errors, deferred = captures.plan(
+            [('100001', D('10.00')), ('100001', D('20.00'))], self.balances)
+        self.assertEqual([codes.SALE, codes.SALE],
+                         [capture.trxtype for capture in planned])
+        self.assertEqual(['PNREF-1', 'PNREF-1'],
+                         [capture.pnref for capture in planned])
+
+    def test_rejects_captures_over_the_remaining_balance(self):
+        self.balances['100001'].reserved = D('50.00')
+        planned, errors, deferred = captures.plan(
+            [('100001', D('60.00'))], self.balances)
+        self.assertEqual([], planned)
+        (item, error), = errors
+        self.assertEqual(('100001', D('60.00')), item)
+
+    def test_waits_for_a_first_capture_in_progress(self):
+        self.balances['100001'].num_reserved = 1
+        planned, errors, deferred = captures.plan(
+            [('100001', D('10.00'))], self.balances)
+        self.assertEqual([], planned)
+        self.assertEqual(1, len(errors))
+
+    def test_rejects_orders_without_an_authorization(self):
+        planned, errors, deferred = captures.plan(
+            [('100002', D('10.00'))], self.balances)
+        self.assertEqual([], planned)
+        self.assertEqual(1, len(errors))
+
+
+class TestCapturing(TestCase):
+
+    @patch('paypal.payflow.gateway.reference_transaction',
+           side_effect=fake_call(codes.SALE))
+    @patch('paypal.payflow.gateway.delayed_capture',
+           side_effect=fake_call(codes.DELAYED_CAPTURE))
+    def test_saves_captures_and_updates_balances(self, delayed_capture,
+                                                 reference_transaction):
+        create_payflow_txn('100001', codes.AUTHORIZATION,
+                           'PNREF-1', D('100.00'))
+        create_payflow_txn('100002', codes.AUTHORIZATION,
+                           'PNREF-2', D('100.00'))
+        results = list(captures.capture(
+            [('100001', D('40.00')), ('100001', D('10.00')),
+             ('100002', D('100.00'))], workers=2))
+
+        self.assertFalse([result for result in results if result.error])
+        self.assertEqual(2, delayed_capture.call_count)
+        self.assertEqual(1, reference_transaction.call_count)
+        balances = dict((balance.order_number, balance)
+                        for balance in CaptureBalance.objects.all())
+        self.assertEqual(D('50.00'), balances['100001'].remaining)
+        self.assertEqual(2, balances['100001'].num_captures)
+        self.assertEqual(D('0.00'), balances['100002'].remaining)
+        self.assertEqual(D('0.00'), balances['100001'].reserved)
+
+    @patch('paypal.payflow.gateway.reference_transaction',
+           side_effect=fake_call(codes.SALE))
+    @patch('paypal.payflow.gateway.delayed_capture',
+           side_effect=fake_call(codes.DELAYED_CAPTURE))
+    def test_reference_sales_wait_for_the_delayed_capture(
+            self, delayed_capture, reference_transaction):
+        create_payflow_txn('100001', codes.AUTHORIZATION,
+                           'PNREF-1', D('100.00'))
+        with patch('paypal.bulk.run_concurrently',
+                   wraps=bulk.run_concurrently) as run_concurrently:
+            results = list(captures.capture(
+                [('100001', D('40.00')), ('100001', D('10.00'))],
+                workers=2))
+        self.assertEqual([codes.DELAYED_CAPTURE, codes.SALE],
+                         [result.item.trxtype for result in results])
+        # The sale is only planned once the delayed capture has been saved
+        self.assertEqual(2, run_concurrently.call_count)
+
+    @patch('paypal.payflow.gateway.delayed_capture')
+    def test_releases_reserved_amounts_of_failed_captures(self,
+                                                         delayed_capture):
+        create_payflow_txn('100001', codes.AUTHORIZATION,
+                           'PNREF-1', D('100.00'))
+        txn = fake_call(codes.DELAYED_CAPTURE)('100001', 'PNREF-1', D('40.00'))
+        txn.result = '12'
+        delayed_capture.return_value = txn
+        result, = captures.capture([('100001', D('40.00'))], workers=1)
+        self.assertTrue(result.error)
+        balance = CaptureBalance.objects.get()
+        self.assertEqual(D('100.00'), balance.remaining)
+        self.assertEqual(0, balance.num_reserved)
+
+    @patch('paypal.payflow.gateway.delayed_capture',
+           side_effect=fake_call(codes.DELAYED_CAPTURE))
+    def test_expired_reservations_are_released(self, delayed_capture):
+        create_payflow_txn('100001', codes.AUTHORIZATION,
+                           'PNREF-1', D('100.00'))
+        # Left by a run that died before saving its capture
+        CaptureBalance.objects.create(
+            order_number='100001', pnref='PNREF-1', authorized=D('100.00'),
+            reserved=D('40.00'), num_reserved=1)
+        CaptureBalance.objects.update(
+            date_updated=timezone.now() - datetime.timedelta(hours=1))
+        result, = captures.capture([('100001', D('100.00'))], workers=1)
+        self.assertIsNone(result.error)
+        balance = CaptureBalance.objects.get()
+        self.assertEqual(D('0.00'), balance.remaining)
+        self.assertEqual(0, balance.num_reserved)
+
+    def test_recent_reservations_are_kept(self):
+        create_payflow_txn('100001', codes.AUTHORIZATION,
+                           'PNREF-1', D('100.00'))
+        CaptureBalance.objects.create(
+            order_number='100001', pnref='PNREF-1', authorized=D('100.00'),
+            reserved=D('40.00'), num_reserved=1)
+        result, = captures.capture([('100001', D('10.00'))], workers=1)
+        self.assertTrue(result.error)
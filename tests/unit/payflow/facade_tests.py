@@ -9,6 +9,7 @@ from oscar.apps.payment import exceptions
 import mock
 
 from paypal.payflow import facade, models, codes
+from tests.unit.factories import create_payflow_txn
 
 """
 See page 49 of the PDF for information on PayPal's testing set-up
@@ -83,6 +84,7 @@ class TestDelayedCapture(TestCase):
             trxtype=codes.AUTHORIZATION,
             comment1='1234',
             pnref='V19A3A079142',
+            result='0',
             response_time=0,
         )
         with mock.patch('paypal.payflow.gateway.delayed_capture') as mock_f:
@@ -90,3 +92,49 @@ class TestDelayedCapture(TestCase):
                 result='0'
             )
             facade.delayed_capture('1234')
+
+    def test_raises_exception_when_authorization_was_declined(self):
+        models.PayflowTransaction.objects.create(
+            trxtype=codes.AUTHORIZATION,
+            comment1='1234',
+            pnref='V19A3A079142',
+            result='12',
+            response_time=0,
+        )
+        with mock.patch('paypal.payflow.gateway.delayed_capture') as mock_f:
+            with self.assertRaises(exceptions.UnableToTakePayment):
+                facade.delayed_capture('1234')
+        self.assertFalse(mock_f.called)
+
+
+class TestTransactionLookup(TestCase):
+
+    def test_transactions_are_loaded_with_one_query(self):
+        create_payflow_txn('1234', codes.AUTHORIZATION, 'PNREF-1')
+        create_payflow_txn('1234', codes.DELAYED_CAPTURE, 'PNREF-2')
+        with self.assertNumQueries(1):
+            txns = facade.get_transactions('1234')
+        self.assertEqual(['PNREF-2', 'PNREF-1'], [txn.pnref for txn in txns])
+
+    def test_credit_uses_latest_settled_transaction(self):
+        create_payflow_txn('1234', codes.AUTHORIZATION, 'PNREF-1')
+        create_payflow_txn('1234', codes.DELAYED_CAPTURE, 'PNREF-2')
+        create_payflow_txn('1234', codes.DELAYED_CAPTURE,
+                           'PNREF-3', result='12')
+        with mock.patch('paypal.payflow.gateway.credit') as mock_f:
+            mock_f.return_value = models.PayflowTransaction(
+                comment1='1234', result='0')
+            facade.credit('1234')
+        mock_f.assert_called_with('1234', 'PNREF-2', None)
+
+    def test_credit_needs_pnref_when_order_was_captured_twice(self):
+        create_payflow_txn('1234', codes.AUTHORIZATION, 'PNREF-1')
+        create_payflow_txn('1234', codes.DELAYED_CAPTURE, 'PNREF-2')
+        create_payflow_txn('1234', codes.SALE, 'PNREF-3')
+        with mock.patch('paypal.payflow.gateway.credit') as mock_f:
+            with self.assertRaises(exceptions.UnableToTakePayment):
+                facade.credit('1234')
+            mock_f.return_value = models.PayflowTransaction(
+                comment1='1234', result='0')
+            facade.credit('1234', 'PNREF-2')
+        mock_f.assert_called_once_with('1234', 'PNREF-2', None)
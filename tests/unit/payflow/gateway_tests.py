@@ -1,10 +1,14 @@
 from __future__ import unicode_literals
 from decimal import Decimal as D
 
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
 from django.test import TestCase
+from django.test.utils import override_settings
 import mock
 
-from paypal.payflow import gateway
+from paypal.ledger.models import LedgerEntry
+from paypal.payflow import codes, conf, gateway, models
 
 
 class TestAuthorizeFunction(TestCase):
@@ -30,17 +34,11 @@ class TestAuthorizeFunction(TestCase):
         self.assertTrue(txn.is_approved)
 
     def test_hides_card_details(self):
-        with mock.patch('paypal.gateway.post') as mock_post:
-            mock_post.return_value = {
-                'RESULT': '126',
-                'PNREF': 'V25A2BB645A7',
-                'RESPMSG': 'Under review by Fraud Service',
-                'AUTHCODE': '525PNI',
-                'POSTFPSMSG': 'Review',
-                '_raw_request': 'VENDOR=oscarpaypal&TRXTYPE=A&ZIP=n12+9et&LASTNAME=&COMMENT1=100010&EXPDATE=0113&COMMENT2=&STATE=&STREET=Flat+1+Caxton+Court&USER=oscarpaypal&CVV2=123&TENDER=C&ACCT=5555555555554444&CITY=&FIRSTNAME=&PWD=secret&AMT=6.99',
-                '_raw_response': '',
-                '_response_time': 1000
-            }
+        with mock.patch('requests.post') as mock_post:
+            response = mock.Mock()
+            response.status_code = 200
+            response.content = response.text = 'RESULT=126&PNREF=V25A2BB645A7&RESPMSG=Under review by Fraud Service'
+            mock_post.return_value = response
             txn = gateway.authorize(
                 order_number='1234',
                 card_number='5555555555554444',
@@ -48,8 +46,14 @@ class TestAuthorizeFunction(TestCase):
                 expiry_date='0113',
                 amt=D('6.99'))
 
+        # The real values are still sent to PayPal...
+        payload = mock_post.call_args[0][1]
+        self.assertTrue('5555555555554444' in payload)
+        # ...but not stored
         self.assertTrue('5555555555554444' not in txn.raw_request)
-        self.assertTrue('123' not in txn.raw_request)
+        self.assertTrue('4444' in txn.raw_request)
+        self.assertTrue('CVV2=123' not in txn.raw_request)
+        self.assertTrue('EXPDATE=0113' not in txn.raw_request)
 
     def test_error_handled_gracefully(self):
         with mock.patch('paypal.gateway.post') as mock_post:
@@ -82,3 +86,59 @@ class TestReferenceTransaction(TestCase):
             gateway.reference_transaction(order_number='12345',
                                           pnref='111222',
                                           amt=D('12.23'))
+
+
+class TestDelayedCapture(TestCase):
+
+    def test_sends_request_id(self):
+        with mock.patch('paypal.gateway.post') as mock_post:
+            mock_post.return_value = {
+                'RESULT': '0',
+                'PNREF': 'V25A2BB645A8',
+                'RESPMSG': 'Approved',
+                '_raw_request': '',
+                '_raw_response': '',
+                '_response_time': 1000
+            }
+            txn = gateway.delayed_capture('12345', 'V25A2BB645A7',
+                                          D('12.23'), request_id='abc')
+        headers = mock_post.call_args[0][2]
+        self.assertEqual('abc', headers['X-VPS-REQUEST-ID'])
+        self.assertEqual('USD', txn.currency)
+
+
+class TestSavingTransactions(TestCase):
+
+    def create_txn(self, pnref, result='0'):
+        return models.PayflowTransaction(
+            comment1='100001', trxtype=codes.DELAYED_CAPTURE, pnref=pnref,
+            amount=D('10.00'), result=result, raw_request='', raw_response='',
+            response_time=0)
+
+    def test_ledger_entries_are_linked_to_their_own_transactions(self):
+        # A retried call returns the same PNREF, and declines may have none
+        txns = [self.create_txn('PNREF-1'), self.create_txn('PNREF-1'),
+                self.create_txn(None, result='12')]
+        gateway.save_transactions(txns)
+        entries = LedgerEntry.objects.order_by('id')
+        self.assertEqual([txn.pk for txn in txns],
+                         [entry.audit_id for entry in entries])
+
+
+class TestSettingsSnapshot(TestCase):
+
+    def test_snapshot_is_reused(self):
+        self.assertTrue(conf.get_settings() is conf.get_settings())
+
+    def test_snapshot_is_rebuilt_when_settings_change(self):
+        with override_settings(PAYPAL_PAYFLOW_PRODUCTION_MODE=True):
+            self.assertEqual('https://payflowpro.paypal.com',
+                             conf.get_settings().url)
+        self.assertEqual('https://pilot-payflowpro.paypal.com',
+                         conf.get_settings().url)
+
+    def test_missing_password_is_rejected(self):
+        with override_settings(PAYPAL_PAYFLOW_PASSWORD=None):
+            del settings.PAYPAL_PAYFLOW_PASSWORD
+            with self.assertRaises(ImproperlyConfigured):
+                conf.get_settings()
@@ -17,3 +17,12 @@ class TestTransactionModel(TestCase):
             result='126'
         )
         self.assertTrue(txn.is_approved)
+
+    def test_summary_queryset_defers_audit_data(self):
+        PayflowTransaction.objects.create(
+            comment1='1234', trxtype='A', raw_request='TRXTYPE=A',
+            raw_response='RESULT=0', response_time=0)
+        txn = PayflowTransaction.objects.summary().get(comment1='1234')
+        self.assertFalse('raw_request' in txn.__dict__)
+        self.assertFalse('raw_response' in txn.__dict__)
+        self.assertEqual('RESULT=0', txn.raw_response)
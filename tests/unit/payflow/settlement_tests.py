@@ -0,0 +1,104 @@
+from __future__ import unicode_literals
+from decimal import Decimal as D
+
+from django.test import TestCase
+from mock import patch
+
+from paypal.ledger.models import LedgerEntry
+from paypal.payflow import codes, facade, settlement
+from paypal.payflow.models import CaptureBalance, PayflowTransaction
+from tests.unit.factories import create_payflow_txn
+
+
+def fake_capture(order_number, pnref, amt=None, commit=True,
+                 request_id=None):
+    return PayflowTransaction(
+        comment1=order_number, trxtype=codes.DELAYED_CAPTURE, amount=amt,
+        pnref='CAPTURE-%s' % pnref, result='0', respmsg='Approved',
+        raw_request='', raw_response='', response_time=0)
+
+
+class TestGettingCapturableAuthorizations(TestCase):
+
+    def test_excludes_captured_orders(self):
+        create_payflow_txn('100001', codes.AUTHORIZATION, 'PNREF-1')
+        create_payflow_txn('100001', codes.DELAYED_CAPTURE, 'PNREF-2')
+        create_payflow_txn('100002', codes.AUTHORIZATION, 'PNREF-3')
+        self.assertEqual(['100002'], [
+            auth.order_number for auth in settlement.get_capturable()])
+
+    def test_returns_latest_authorization_for_each_order(self):
+        create_payflow_txn('100001', codes.AUTHORIZATION, 'PNREF-1')
+        create_payflow_txn('100001', codes.AUTHORIZATION, 'PNREF-2')
+        create_payflow_txn('100001', codes.AUTHORIZATION,
+                           'PNREF-3', result='12')
+        auth, = settlement.get_capturable()
+        self.assertEqual('PNREF-2', auth.pnref)
+
+    def test_excludes_orders_with_partial_captures(self):
+        create_payflow_txn('100001', codes.AUTHORIZATION, 'PNREF-1')
+        create_payflow_txn('100002', codes.AUTHORIZATION, 'PNREF-2')
+        create_payflow_txn('100003', codes.AUTHORIZATION, 'PNREF-3')
+        CaptureBalance.objects.create(
+            order_number='100001', pnref='PNREF-1', authorized=D('10.00'),
+            captured=D('4.00'), num_captures=1)
+        CaptureBalance.objects.create(
+            order_number='100002', pnref='PNREF-2', authorized=D('10.00'),
+            reserved=D('4.00'), num_reserved=1)
+        self.assertEqual(['100003'], [
+            auth.order_number for auth in settlement.get_capturable()])
+
+    def test_captures_what_is_left_of_the_balance(self):
+        create_payflow_txn('100001', codes.AUTHORIZATION, 'PNREF-1')
+        CaptureBalance.objects.create(
+            order_number='100001', pnref='PNREF-1', authorized=D('8.00'))
+        auth, = settlement.get_capturable()
+        self.assertEqual(D('8.00'), auth.amount)
+
+
+class TestSettling(TestCase):
+
+    @patch('paypal.payflow.gateway.delayed_capture', side_effect=fake_capture)
+    def test_saves_captures_and_ledger_entries(self, delayed_capture):
+        create_payflow_txn('100001', codes.AUTHORIZATION, 'PNREF-1')
+        create_payflow_txn('100002', codes.AUTHORIZATION, 'PNREF-2')
+        summary = settlement.Summary()
+        for result in settlement.settle(workers=1):
+            summary.add(result)
+
+        self.assertEqual(2, summary.num_captured)
+        self.assertEqual(D('20.00'), summary.amount_captured)
+        self.assertEqual(2, PayflowTransaction.objects.filter(
+            trxtype=codes.DELAYED_CAPTURE).count())
+        entry = LedgerEntry.objects.get(transaction_id='CAPTURE-PNREF-1')
+        self.assertEqual('100001', entry.order_number)
+        self.assertIsNotNone(entry.audit_id)
+        self.assertFalse(list(settlement.get_capturable()))
+
+    @patch('time.sleep')
+    @patch('paypal.payflow.gateway.delayed_capture')
+    def test_retries_communication_errors(self, delayed_capture, sleep):
+        failed = fake_capture('100001', 'PNREF-1')
+        failed.result = '-1'
+        delayed_capture.side_effect = [
+            failed, fake_capture('100001', 'PNREF-1', D('10.00'))]
+        authorization = settlement.Authorization(
+            '100001', 'PNREF-1', D('10.00'))
+        txn = settlement.capture(authorization)
+        self.assertEqual('0', txn.result)
+        self.assertEqual(2, delayed_capture.call_count)
+        # The retry is sent with the same request ID, so PayPal won't
+        # capture twice if the first call got through
+        request_ids = set(call[1]['request_id']
+                          for call in delayed_capture.call_args_list)
+        self.assertEqual(set(['capture-PNREF-1']), request_ids)
+
+
+class TestDelayedCaptureLookup(TestCase):
+
+    @patch('paypal.payflow.gateway.delayed_capture', side_effect=fake_capture)
+    def test_uses_pnref_of_latest_authorization(self, delayed_capture):
+        create_payflow_txn('100001', codes.AUTHORIZATION, 'PNREF-1')
+        create_payflow_txn('100001', codes.AUTHORIZATION, 'PNREF-2')
+        facade.delayed_capture('100001')
+        delayed_capture.assert_called_with('100001', 'PNREF-2', None)
@@ -0,0 +1,40 @@
+from __future__ import unicode_literals
+
+from django.test import TestCase
+from oscar.core.loading import get_model
+
+from paypal import payment
+
+SourceType = get_model('payment', 'SourceType')
+
+
+class TestSourceTypes(TestCase):
+
+    def setUp(self):
+        payment.reset()
+        # Cached instances would outlive the test's transaction
+        self.addCleanup(payment.reset)
+
+    def test_creates_type_when_missing(self):
+        source_type = payment.get_source_type()
+        self.assertEqual('PayPal', source_type.name)
+        self.assertTrue(SourceType.objects.filter(name='PayPal').exists())
+
+    def test_later_lookups_do_not_query(self):
+        SourceType.objects.create(name='PayPal')
+        payment.get_source_type()
+        with self.assertNumQueries(0):
+            payment.get_source_type()
+
+    def test_cache_is_cleared_when_a_type_is_deleted(self):
+        SourceType.objects.create(name='PayPal')
+        payment.get_source_type().delete()
+        source_type = payment.get_source_type()
+        self.assertTrue(SourceType.objects.filter(pk=source_type.pk).exists())
+
+    def test_creating_a_type_does_not_clear_the_cache(self):
+        SourceType.objects.create(name='PayPal')
+        source_type = payment.get_source_type()
+        payment.get_event_type('Settled')
+        with self.assertNumQueries(0):
+            self.assertEqual(source_type, payment.get_source_type())
@@ -0,0 +1,49 @@
+from __future__ import unicode_literals
+
+from django.core.cache import cache
+from django.test import TestCase
+from django.test.utils import override_settings
+from mock import patch
+
+from paypal import ratelimit
+
+
+@override_settings(PAYPAL_RATE_LIMITS={'payment': 5},
+                   PAYPAL_RATE_LIMIT_RESERVE=0.2,
+                   PAYPAL_RATE_LIMIT_MAX_WAIT=0)
+class TestRateLimit(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        # Keep every call in the same window
+        patcher = patch('time.time', return_value=1000.5)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def take(self, n, method='DoCapture'):
+        with patch('time.sleep') as sleep:
+            for __ in range(n):
+                ratelimit.acquire('user', method)
+        return sleep.call_count
+
+    def test_interactive_calls_can_use_whole_bucket(self):
+        self.assertEqual(0, self.take(5))
+
+    def test_interactive_calls_do_not_wait_longer_than_max_wait(self):
+        self.take(5)
+        self.assertEqual(0, self.take(1))
+
+    def test_batch_calls_leave_reserve_for_interactive_calls(self):
+        with ratelimit.batch():
+            self.assertEqual(0, self.take(4))
+            with patch('time.sleep', side_effect=RuntimeError):
+                with self.assertRaises(RuntimeError):
+                    ratelimit.acquire('user', 'DoCapture')
+        with patch('paypal.ratelimit.logger') as logger:
+            self.take(1)
+        self.assertFalse(logger.warning.called)
+
+    def test_unlimited_classes_are_not_counted(self):
+        with patch.object(cache, 'incr') as incr:
+            self.take(10, 'SetExpressCheckout')
+        self.assertFalse(incr.called)
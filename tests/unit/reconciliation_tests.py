@@ -0,0 +1,106 @@
+from __future__ import unicode_literals
+import datetime
+from decimal import Decimal as D
+
+from django.test import TestCase
+from django.utils import timezone
+from django.utils.six import StringIO
+
+from paypal import reconciliation
+from paypal.reconciliation import Entry
+from tests.unit.factories import create_express_txn
+
+
+class TestReconciling(TestCase):
+
+    def reconcile(self, local, paypal):
+        return [(d.kind, d.transaction_id)
+                for d in reconciliation.reconcile(local, paypal)]
+
+    def test_matching_entries_have_no_discrepancies(self):
+        entries = [Entry('A', D('10.00'), 'GBP'),
+                   Entry('B', D('-5.00'), 'GBP')]
+        self.assertEqual([], self.reconcile(entries, entries))
+
+    def test_reports_each_kind_of_discrepancy(self):
+        local = [Entry('A', D('10.00'), 'GBP'),
+                 Entry('B', D('10.00'), 'GBP'),
+                 Entry('C', D('10.00'), 'GBP'),
+                 Entry('C', D('10.00'), 'GBP')]
+        paypal = [Entry('B', D('12.00'), 'GBP'),
+                  Entry('C', D('10.00'), 'GBP'),
+                  Entry('D', D('10.00'), 'GBP')]
+        self.assertEqual([
+            (reconciliation.MISSING_AT_PAYPAL, 'A'),
+            (reconciliation.AMOUNT_MISMATCH, 'B'),
+            (reconciliation.DUPLICATE, 'C'),
+            (reconciliation.MISSING_LOCALLY, 'D'),
+        ], self.reconcile(local, paypal))
+
+    def test_unknown_amounts_are_not_compared(self):
+        self.assertEqual([], self.reconcile(
+            [Entry('A', None, None)], [Entry('A', D('10.00'), 'GBP')]))
+
+    def test_unsorted_input_is_rejected(self):
+        with self.assertRaises(ValueError):
+            self.reconcile([], [Entry('B', D('1'), 'GBP'),
+                                Entry('A', D('1'), 'GBP')])
+
+
+class TestSortingEntries(TestCase):
+
+    def test_sorts_in_chunks(self):
+        entries = [Entry(txn_id, D('1.00'), 'GBP') for txn_id in 'DBECA']
+        self.assertEqual(
+            list('ABCDE'),
+            [e.transaction_id for e in reconciliation.sort_entries(
+                entries, chunk_size=2)])
+
+
+class TestReadingSettlementReport(TestCase):
+
+    def test_reads_payments_and_refunds(self):
+        f = StringIO(
+            '"RH","2014/05/01 03:00:00 +0000","A","MERCHANT",011\n'
+            '"CH","Transaction ID","Transaction Event Code",'
+            '"Transaction Debit or Credit","Gross Transaction Amount",'
+            '"Gross Transaction Currency"\n'
+            '"SB","TXN-1","T0006","CR","1050","GBP"\n'
+            '"SB","TXN-2","T1107","DR","500","GBP"\n'
+            '"SB","TXN-3","T0400","DR","10000","GBP"\n')
+        self.assertEqual([Entry('TXN-1', D('10.50'), 'GBP'),
+                          Entry('TXN-2', D('-5.00'), 'GBP')],
+                         list(reconciliation.read_settlement_report(f)))
+
+
+class TestLocalEntries(TestCase):
+
+    def test_reads_settled_express_transactions_in_order(self):
+        create_express_txn(transaction_id='TXN-2')
+        create_express_txn(method='RefundTransaction', transaction_id='TXN-1',
+                           amount=D('4.00'))
+        create_express_txn(
+            transaction_id='AUTH-1',
+            raw_response='PAYMENTINFO_0_PENDINGREASON=authorization')
+        now = timezone.now()
+        entries = reconciliation.express_entries(
+            now - datetime.timedelta(days=1), now + datetime.timedelta(days=1),
+            page_size=1)
+        self.assertEqual([Entry('TXN-1', D('-4.00'), 'GBP'),
+                          Entry('TXN-2', D('10.00'), 'GBP')], list(entries))
+
+    def test_reads_each_payment_of_a_parallel_checkout(self):
+        create_express_txn(method='DoCapture', transaction_id='TXN-2',
+                           amount=D('5.00'))
+        create_express_txn(
+            transaction_id='TXN-1',
+            raw_response='PAYMENTINFO_0_TRANSACTIONID=TXN-1'
+                         '&PAYMENTINFO_0_AMT=4.00'
+                         '&PAYMENTINFO_1_TRANSACTIONID=TXN-3'
+                         '&PAYMENTINFO_1_AMT=6.00')
+        now = timezone.now()
+        entries = reconciliation.express_entries(
+            now - datetime.timedelta(days=1), now + datetime.timedelta(days=1))
+        self.assertEqual([Entry('TXN-1', D('4.00'), 'GBP'),
+                          Entry('TXN-2', D('5.00'), 'GBP'),
+                          Entry('TXN-3', D('6.00'), 'GBP')], list(entries))
@@ -0,0 +1,130 @@
+from __future__ import unicode_literals
+from decimal import Decimal as D
+
+from django.test import TestCase
+from django.test.utils import override_settings
+from django.utils.six import StringIO
+from mock import patch
+
+from paypal import refunds
+from paypal.express.models import ExpressTransaction
+from paypal.ledger.models import LedgerEntry
+from paypal.payflow.models import PayflowTransaction
+
+
+class TestReadingRecords(TestCase):
+
+    def test_reads_csv(self):
+        f = StringIO('reference,amount,currency\n100001,5.00,GBP\n')
+        self.assertEqual([('100001', '5.00', 'GBP')],
+                         list(refunds.read_records(f)))
+
+    def test_reads_ndjson(self):
+        f = StringIO('{"token": "EC-1", "amount": "5.00"}\n\n')
+        self.assertEqual([('EC-1', '5.00', None)],
+                         list(refunds.read_records(f, refunds.NDJSON)))
+
+    def test_reads_numbers_from_ndjson(self):
+        f = StringIO('{"order_number": 100001, "amount": 5}\n')
+        self.assertEqual([('100001', '5', None)],
+                         list(refunds.read_records(f, refunds.NDJSON)))
+
+
+class TestResolvingRecords(TestCase):
+
+    def setUp(self):
+        ExpressTransaction.objects.create(
+            method='DoExpressCheckoutPayment', version='119', ack='Success',
+            token='EC-1', amount=D('10.00'), currency='GBP',
+            raw_request='', response_time=0,
+            raw_response='ACK=Success&PAYMENTINFO_0_TRANSACTIONID=TXN-1'
+                         '&PAYMENTINFO_0_AMT=10.00'
+                         '&PAYMENTINFO_0_CURRENCYCODE=GBP')
+        PayflowTransaction.objects.create(
+            comment1='100002', trxtype='S', amount=D('20.00'),
+            pnref='PNREF-1', result='0', respmsg='Approved',
+            raw_request='', raw_response='', response_time=0)
+
+    def test_resolves_express_and_payflow_payments(self):
+        with self.assertNumQueries(5):
+            express, payflow, missing = refunds.resolve([
+                ('EC-1', '5.00', 'GBP'),
+                ('100002', None, None),
+                ('100003', None, None)])
+        self.assertEqual('TXN-1', express.transaction_id)
+        self.assertTrue(express.is_partial)
+        self.assertEqual('PNREF-1', payflow.transaction_id)
+        self.assertTrue(missing.error)
+
+    def test_currency_must_match(self):
+        refund, = refunds.resolve([('EC-1', '5.00', 'USD')])
+        self.assertTrue(refund.error)
+
+    @override_settings(PAYPAL_PAYFLOW_CURRENCY='GBP')
+    def test_payflow_currency_must_match(self):
+        refund, = refunds.resolve([('100002', '5.00', 'USD')])
+        self.assertTrue(refund.error)
+
+    def create_credit(self, amount=None, origid='PNREF-1'):
+        PayflowTransaction.objects.create(
+            comment1='100002', trxtype='C', amount=amount, pnref='PNREF-C',
+            result='0', respmsg='Approved', raw_request='ORIGID=%s' % origid,
+            raw_response='', response_time=0)
+
+    def test_refunded_payments_are_skipped(self):
+        LedgerEntry.objects.create(
+            gateway=LedgerEntry.EXPRESS, operation='RefundTransaction',
+            transaction_id='TXN-1', amount=D('10.00'), is_successful=True)
+        self.create_credit()
+        express, payflow = refunds.resolve([('EC-1', None, None),
+                                            ('100002', None, None)])
+        self.assertEqual("Already refunded", express.error)
+        self.assertEqual("Already refunded", payflow.error)
+
+    def test_partly_refunded_payments_can_be_refunded_again(self):
+        LedgerEntry.objects.create(
+            gateway=LedgerEntry.EXPRESS, operation='RefundTransaction',
+            transaction_id='TXN-1', amount=D('4.00'), is_successful=True)
+        self.create_credit(D('5.00'))
+        express, payflow = refunds.resolve([('EC-1', '6.00', None),
+                                            ('100002', None, None)])
+        self.assertIsNone(express.error)
+        self.assertTrue(express.is_partial)
+        # A blank amount refunds what is left
+        self.assertIsNone(payflow.error)
+        self.assertEqual(D('15.00'), payflow.amount)
+
+    def test_amount_cannot_exceed_what_is_left(self):
+        LedgerEntry.objects.create(
+            gateway=LedgerEntry.EXPRESS, operation='RefundTransaction',
+            transaction_id='TXN-1', amount=D('4.00'), is_successful=True)
+        refund, = refunds.resolve([('EC-1', '7.00', None)])
+        self.assertEqual("Only 6.00 is left to refund", refund.error)
+
+    def test_orders_with_several_captures_need_a_pnref(self):
+        PayflowTransaction.objects.create(
+            comment1='100002', trxtype='S', amount=D('5.00'),
+            pnref='PNREF-2', result='0', respmsg='Approved',
+            raw_request='', raw_response='', response_time=0)
+        self.create_credit(origid='PNREF-1')
+        by_order, by_pnref, credited = refunds.resolve([
+            ('100002', None, None), ('PNREF-2', None, None),
+            ('PNREF-1', None, None)])
+        self.assertTrue(by_order.error)
+        self.assertEqual('PNREF-2', by_pnref.transaction_id)
+        self.assertEqual('100002', by_pnref.order_number)
+        self.assertEqual("Already refunded", credited.error)
+
+    def test_writes_result_for_each_record(self):
+        def credit(order_number, pnref, amt, currency, commit):
+            return PayflowTransaction(
+                comment1=order_number, trxtype='C', pnref='PNREF-2',
+                result='0', respmsg='Approved', raw_request='',
+                raw_response='', response_time=0)
+        infile = StringIO('reference,amount,currency\n100002,,\n100003,,\n')
+        outfile = StringIO()
+        with patch('paypal.payflow.gateway.credit', side_effect=credit):
+            self.assertEqual((1, 1), refunds.refund_file(infile, outfile))
+        self.assertEqual(3, len(outfile.getvalue().splitlines()))
+        self.assertTrue(PayflowTransaction.objects.filter(
+            trxtype='C').exists())
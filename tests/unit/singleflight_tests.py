@@ -0,0 +1,69 @@
+from __future__ import unicode_literals
+import threading
+
+from django.core.cache import cache
+from django.test import TestCase
+from django.test.utils import override_settings
+from mock import patch
+
+from paypal import singleflight
+
+
+class TestSingleFlight(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.calls = []
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def slow_call(self):
+        self.calls.append(1)
+        self.started.set()
+        self.release.wait(5)
+        return len(self.calls)
+
+    def call_in_thread(self, results):
+        thread = threading.Thread(target=lambda: results.append(
+            singleflight.do(('GetExpressCheckoutDetails', 'EC-1'),
+                            self.slow_call)))
+        thread.start()
+        return thread
+
+    def test_concurrent_calls_share_one_result(self):
+        waiting = threading.Event()
+
+        def get_timeout():
+            # Only called by callers that wait for another's result
+            waiting.set()
+            return 5
+
+        results = []
+        with patch('paypal.singleflight.get_timeout', side_effect=get_timeout):
+            leader = self.call_in_thread(results)
+            self.started.wait(5)
+            follower = self.call_in_thread(results)
+            waiting.wait(5)
+            self.release.set()
+        leader.join()
+        follower.join()
+        self.assertEqual([1, 1], results)
+        self.assertEqual(1, len(self.calls))
+
+    def test_errors_are_raised(self):
+        def fail():
+            raise ValueError("PayPal is down")
+        with self.assertRaises(ValueError):
+            singleflight.do(('GetExpressCheckoutDetails', 'EC-1'), fail)
+
+    def test_later_calls_are_made_again(self):
+        self.release.set()
+        singleflight.do(('GetExpressCheckoutDetails', 'EC-1'), self.slow_call)
+        singleflight.do(('GetExpressCheckoutDetails', 'EC-1'), self.slow_call)
+        self.assertEqual(2, len(self.calls))
+
+    @override_settings(PAYPAL_SINGLE_FLIGHT_CACHE=True)
+    def test_cache_lock_is_released(self):
+        self.release.set()
+        singleflight.do(('GetExpressCheckoutDetails', 'EC-1'), self.slow_call)
+        self.assertFalse([key for key in cache._cache if 'lock' in key])